@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Отдельный процесс получения и пересчета данных одного прибора x55
+#
+# Процесс принимает поток пиков прибора, пересчитывает их в измерения и публикует результат в кольцевой буфер
+# в разделяемой памяти (UPK_shm_ring.ShmRingBuffer). Основной процесс (сеть, усреднение, архивы) читает записи
+# из буфера, поэтому медленная запись на диск или сборка мусора в нем не задерживают прием пиков.
+#
+# Запись буфера: [время, поля устройства 0 ..., поля устройства N, F1 устройства 0, F2 устройства 0, ...],
+# отсутствующие значения - NaN.
+
+import asyncio
+import datetime
+import logging
+from pathlib import Path
+
+from UPK_lazy import lazy_import
+from UPK_shm_ring import ShmRingBuffer
+from UPK_conversion import convert_samples, peaks_by_channel_from_packet, output_measurements_order2
+from UPK_device_table import DeviceTable
+
+np = lazy_import('numpy')
+hyperion = lazy_import('hyperion')
+
+stop_check_interval_sec = 0.5  # период проверки команды остановки процесса
+
+
+def record_width(devices_num):
+    return 1 + devices_num * (len(output_measurements_order2) + 2)
+
+
+def make_records(rows, raw_rows, devices_num):
+    """ строки пересчета convert_samples() -> записи кольцевого буфера """
+    fields_end = 1 + devices_num * len(output_measurements_order2)
+    records = np.empty((len(rows), record_width(devices_num)))
+    records[:, :fields_end] = np.array(rows, dtype=float)
+    records[:, fields_end:] = np.array([raw_row[1:] for raw_row in raw_rows], dtype=float)
+    return records
+
+
+def split_records(records, devices_num):
+    """ записи кольцевого буфера -> (rows, raw_rows) в формате convert_samples() """
+    fields_end = 1 + devices_num * len(output_measurements_order2)
+    rows = records[:, :fields_end].tolist()
+    raw_rows = np.concatenate((records[:, :1], records[:, fields_end:]), axis=1).tolist()
+    return rows, raw_rows
+
+
+def acquisition_process_main(instrument_ip, devices, shm_name, stop_event, peak_queue_capacity, log_dir='.'):
+    """ точка входа процесса получения данных прибора
+    :param instrument_ip: str(), адрес прибора
+    :param devices: list(), устройства ODTiT прибора
+    :param shm_name: str(), имя кольцевого буфера, созданного основным процессом
+    :param stop_event: multiprocessing.Event(), команда остановки
+    """
+    log_file_name = Path(log_dir) / datetime.datetime.now().strftime(
+        f'UPK_acquisition_{instrument_ip}_%Y%m%d%H%M%S.log')
+    logging.basicConfig(format=u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s',
+                        level=logging.INFO, filename=str(log_file_name))
+    logging.info(f'Acquisition process for {instrument_ip} starts, {len(devices)} devices')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ring = ShmRingBuffer(shm_name)
+    try:
+        loop.run_until_complete(acquisition_coroutine(loop, instrument_ip, devices, ring, stop_event,
+                                                      peak_queue_capacity))
+    except Exception as e:
+        logging.critical(f'Acquisition process for {instrument_ip} failed - exception: {e.__doc__}')
+    finally:
+        ring.close()
+        logging.info(f'Acquisition process for {instrument_ip} is finished, {ring.dropped_count} records dropped')
+
+
+async def acquisition_coroutine(loop, instrument_ip, devices, ring, stop_event, peak_queue_capacity):
+    queue = asyncio.Queue(maxsize=peak_queue_capacity, loop=loop)
+    peak_stream = hyperion.HCommTCPPeaksStreamer(instrument_ip, loop, queue)
+    stream_task = loop.create_task(peak_stream.stream_data())
+
+    device_table = DeviceTable(devices)
+    t_recommended = None
+    try:
+        while not stop_event.is_set():
+            try:
+                peak_data = await asyncio.wait_for(queue.get(), timeout=stop_check_interval_sec)
+            except asyncio.TimeoutError:
+                continue
+
+            # забираем все накопившиеся пакеты и пересчитываем их одной пачкой
+            samples = list()
+            while True:
+                if not peak_data['data']:
+                    # If the queue returns None, then the streamer has stopped.
+                    return
+                samples.append((peak_data['timestamp'], peaks_by_channel_from_packet(peak_data['data'])))
+                if queue.empty():
+                    break
+                peak_data = queue.get_nowait()
+
+            try:
+                rows, raw_rows, t_recommended = convert_samples(device_table, samples, t_recommended)
+                ring.write(make_records(rows, raw_rows, len(devices)))
+            except Exception as e:
+                logging.error(f'Some error during wls to measurements conversion - exception: {e.__doc__}')
+    finally:
+        peak_stream.stop_streaming()
+        stream_task.cancel()
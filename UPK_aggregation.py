@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Иерархическое усреднение измерений по нескольким интервалам
+#
+# Блок измерений хранится накопителем (BlockAccumulator): по каждому устройству и полю - количество значений, сумма,
+# сумма квадратов отклонений от среднего (M2), минимум и максимум. Блок базового уровня (1/SampleRate) строится
+# по измерениям, блоки старших уровней (например, 60, 600, 3600 с) - объединением накопителей закрытых блоков
+# предыдущего уровня, без обращения к измерениям. Среднее и СКО объединенного блока совпадают с рассчитанными
+# по всем его измерениям.
+#
+# Запись любого уровня имеет тот же состав, что и усредненная запись базового уровня (averaged_record()).
+
+from UPK_lazy import lazy_import
+from UPK_conversion import output_measurements_order2
+
+np = lazy_import('numpy')
+
+ice_threshold = 1  # виртуальный гололед, мм, для границ нормального тяжения
+
+
+class BlockAccumulator:
+    """ накопитель блока измерений, массивы shape (количество устройств, количество полей) """
+
+    def __init__(self, count, total, m2, minimum, maximum):
+        self.count = count
+        self.total = total
+        self.m2 = m2
+        self.minimum = minimum  # NaN - значений нет
+        self.maximum = maximum
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        :param values: np.ndarray(), измерения блока, shape (количество измерений, устройств, полей), нет значения - NaN
+        """
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        total = np.where(valid, values, 0).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+        m2 = np.where(valid, (values - mean) ** 2, 0).sum(axis=0)
+
+        empty = count == 0
+        minimum = np.where(valid, values, np.inf).min(axis=0, initial=np.inf)
+        maximum = np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf)
+        minimum[empty] = np.nan
+        maximum[empty] = np.nan
+        return cls(count, total, m2, minimum, maximum)
+
+    def merge(self, other):
+        """ накопитель блока, объединяющего два блока (параллельный алгоритм Чана для M2) """
+        count = self.count + other.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = other.total / other.count - self.total / self.count
+            m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        m2 = np.where(self.count == 0, other.m2, np.where(other.count == 0, self.m2, m2))
+        return BlockAccumulator(count, self.total + other.total, m2,
+                                np.fmin(self.minimum, other.minimum), np.fmax(self.maximum, other.maximum))
+
+    @property
+    def mean(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.total / self.count
+
+    @property
+    def std(self):
+        """ выборочное СКО (как pandas.Series.std()), меньше двух значений - NaN """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+
+def averaged_record(block_end_time, accumulator, devices, fields=output_measurements_order2):
+    """ усредненная запись блока: время конца блока, для каждого устройства - количество измерений, среднее и СКО
+    каждого поля, границы нормального тяжения (при котором виртуальный гололед не более ice_threshold)
+    :param accumulator: BlockAccumulator, shape (len(devices), len(fields))
+    :param devices: list(), устройства ODTiT (коэффициенты моделей тяжения и гололеда)
+    :return: list()
+    """
+    t_field = fields.index('T_degC')
+    t_min = accumulator.minimum[:, t_field]
+    t_max = accumulator.maximum[:, t_field]
+
+    i1 = np.array([device.icemodel_i1 for device in devices], dtype=float)
+    i2 = np.array([device.icemodel_i2 for device in devices], dtype=float)
+    f0 = np.array([device.fmodel_f0 for device in devices], dtype=float)
+    f1 = np.array([device.fmodel_f1 for device in devices], dtype=float)
+    f2 = np.array([device.fmodel_f2 for device in devices], dtype=float)
+
+    # fok = f_extra(ice_threshold)
+    fok = 10 * (i1 * ice_threshold + i2 * (ice_threshold ** 2))
+    fok_min = 10 * (f2 * (t_min ** 2) + f1 * t_min + f0) - fok
+    fok_max = 10 * (f2 * (t_max ** 2) + f1 * t_max + f0) + fok
+
+    mean_std = np.stack((accumulator.mean, accumulator.std), axis=2).reshape(len(devices), 2 * len(fields))
+    record = np.column_stack((accumulator.count[:, t_field], mean_std, fok_min, fok_max))
+    return [block_end_time] + record.ravel().tolist()
+
+
+class HierarchicalAggregator:
+    """ старшие уровни усреднения: каждый уровень объединяет закрытые блоки предыдущего уровня """
+
+    def __init__(self, base_interval_sec, intervals_sec):
+        """
+        :param base_interval_sec: float(), интервал базового уровня (блоки, передаваемые в add())
+        :param intervals_sec: list(), интервалы старших уровней, каждый кратен предыдущему
+        """
+        self.base_interval_sec = base_interval_sec
+        self.intervals_sec = sorted(intervals_sec)
+
+        lower_interval = base_interval_sec
+        for interval_sec in self.intervals_sec:
+            ratio = interval_sec / lower_interval
+            if ratio < 2 or abs(ratio - round(ratio)) > 1E-9:
+                raise ValueError(f'Averaging interval {interval_sec} s is not a multiple of {lower_interval} s')
+            lower_interval = interval_sec
+
+        # открытый блок каждого уровня: время начала и накопитель
+        self.block_starts = [None] * len(self.intervals_sec)
+        self.accumulators = [None] * len(self.intervals_sec)
+        self.late_count = 0  # блоки, пришедшие после закрытия блока уровня, в который они попадают
+
+    def state(self):
+        """ открытые блоки уровней (для контрольной точки) """
+        return {'base_interval_sec': self.base_interval_sec, 'intervals_sec': list(self.intervals_sec),
+                'block_starts': list(self.block_starts), 'accumulators': list(self.accumulators)}
+
+    def restore(self, state):
+        """ восстановление открытых блоков уровней, сохраненных state()
+        :raise ValueError: уровни усреднения отличаются
+        """
+        if state['base_interval_sec'] != self.base_interval_sec or state['intervals_sec'] != self.intervals_sec:
+            raise ValueError(f'Averaging levels {state["intervals_sec"]} differ from {self.intervals_sec}')
+        self.block_starts = list(state['block_starts'])
+        self.accumulators = list(state['accumulators'])
+
+    def add(self, block_end_time, accumulator):
+        """ закрытый блок базового уровня
+        :return: list(), закрытые им блоки старших уровней [(интервал, время конца блока, BlockAccumulator), ...]
+        """
+        closed = list()
+        self._add(0, block_end_time - self.base_interval_sec, accumulator, closed)
+        return closed
+
+    def _add(self, level_num, block_start_time, accumulator, closed):
+        if level_num >= len(self.intervals_sec):
+            return
+        interval_sec = self.intervals_sec[level_num]
+        level_block_start = block_start_time - block_start_time % interval_sec
+
+        if self.block_starts[level_num] is None:
+            self.block_starts[level_num] = level_block_start
+            self.accumulators[level_num] = accumulator
+        elif level_block_start == self.block_starts[level_num]:
+            self.accumulators[level_num] = self.accumulators[level_num].merge(accumulator)
+        elif level_block_start < self.block_starts[level_num]:
+            self.late_count += 1
+        else:
+            # блок уровня закрыт - передаем его следующему уровню
+            closed_start, closed_accumulator = self.block_starts[level_num], self.accumulators[level_num]
+            self.block_starts[level_num] = level_block_start
+            self.accumulators[level_num] = accumulator
+            closed.append((interval_sec, closed_start + interval_sec, closed_accumulator))
+            self._add(level_num + 1, closed_start, closed_accumulator, closed)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# Ограниченные по размеру буферы измерений и общий бюджет памяти
+#
+# Буфер - это словарь {'is_ready': bool, 'data': dict()} (как и раньше), дополненный параметрами ограничения:
+#   capacity - максимальное количество записей,
+#   overflow_policy - что делать при переполнении,
+#   priority - приоритет при нехватке общего бюджета памяти (0 - самый важный, освобождается последним).
+# Ключи data - время измерения, записи добавляются в порядке возрастания времени, поэтому первый ключ - самый старый.
+#
+# При выгрузке на диск (OVERFLOW_SPILL_TO_DISK) каждая порция записей пишется в свой файл-сегмент
+# spill_<буфер>_<время первой записи>.jsonl (не больше spill_segment_records записей). Подгрузка забирает сегменты
+# целиком, начиная с самых старых, и удаляет их - файлы не копируются и не переписываются, поэтому стоимость выгрузки
+# и подгрузки не зависит от объема, уже выгруженного за время долгого отсутствия связи.
+# Буфер с потоком записи (disk_writer в make_buffer()) только ставит готовый сегмент в его очередь, обращений к диску
+# в цикле событий нет; сегмент, запись которого еще не закончена, не подгружается. Чтение и удаление сегментов
+# (load_spilled(), buffer_clear()) выполняются в отдельном потоке, в буфер подгруженное вставляет insert_spilled().
+
+import os
+import sys
+import json
+import logging
+import threading
+from pathlib import Path
+
+from UPK_disk_writer import MODE_APPEND
+
+OVERFLOW_DROP_OLDEST = 'drop-oldest'  # удаляется самая старая запись
+OVERFLOW_DROP_NEWEST = 'drop-newest'  # новая запись не принимается
+OVERFLOW_SPILL_TO_DISK = 'spill-to-disk'  # старшая половина буфера выгружается в файл, потом подгружается обратно
+OVERFLOW_DECIMATE = 'decimate'  # из буфера удаляется каждая вторая запись
+overflow_policies = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_SPILL_TO_DISK, OVERFLOW_DECIMATE)
+
+spill_file_template = 'spill_{}.jsonl'  # единый файл выгрузки прежних версий - подгружается первым
+spill_segment_template = 'spill_{}_{:.6f}.jsonl'
+spill_segment_records = 1000  # максимальное количество записей в сегменте выгрузки
+spill_wait_sec = 10  # ожидание записи поставленных в очередь сегментов при очистке буфера
+
+
+def make_buffer(name, capacity, overflow_policy, priority, disk_writer=None):
+    """ создание буфера
+    :param name: str(), имя буфера - используется в метриках и в имени файла выгрузки
+    :param capacity: int(), максимальное количество записей
+    :param overflow_policy: str(), одна из overflow_policies
+    :param priority: int(), 0 - самый важный буфер
+    :param disk_writer: UPK_disk_writer.DiskWriter(), поток записи сегментов выгрузки, None - запись на месте
+    :return: dict(), буфер
+    """
+    if overflow_policy not in overflow_policies:
+        raise ValueError(f'Unexpected overflow policy {overflow_policy}')
+
+    buffer = dict()
+    buffer['is_ready'] = True
+    buffer['data'] = dict()
+    buffer['name'] = name
+    buffer['capacity'] = capacity
+    buffer['overflow_policy'] = overflow_policy
+    buffer['priority'] = priority
+    buffer['record_size'] = 0  # оценка объема одной записи, байт
+    buffer['overflow_count'] = 0  # количество переполнений с момента последнего опроса метрик
+    buffer['lost_count'] = 0  # количество потерянных записей с момента последнего опроса метрик
+    buffer['disk_writer'] = disk_writer
+    buffer['spill_pending'] = dict()  # сегменты в очереди disk_writer: {имя файла: threading.Event()}
+    return buffer
+
+
+def estimate_size(value):
+    """ грубая оценка объема, занимаемого в памяти записью из чисел, списков, словарей и массивов numpy """
+    if hasattr(value, 'nbytes'):
+        # представление массива (например, срез данных пакета пиков) не включает объем данных в sys.getsizeof()
+        return sys.getsizeof(value) + (value.nbytes if getattr(value, 'base', None) is not None else 0)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(x) for x in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(x) for x in value.values())
+    return sys.getsizeof(value)
+
+
+def _json_default(value):
+    """ приведение значений numpy (np.int64, np.float64, массивы) к типам json при выгрузке на диск """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def _write_segment(file_name, data):
+    """ запись сегмента выгрузки через временный файл - сегмент появляется на диске только целиком """
+    tmp_file_name = str(file_name) + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file_name, file_name)
+
+
+def buffer_put(buffer, key, value):
+    """ добавление записи в буфер с учетом ограничения по размеру
+    :return: bool(), False - запись не принята
+    """
+    data = buffer['data']
+    if key not in data and len(data) >= buffer['capacity']:
+        if not buffer_overflow(buffer):
+            return False
+
+    data[key] = value
+
+    # оценка объема записи - скользящее среднее, чтобы не считать объем всего буфера
+    if buffer['record_size']:
+        buffer['record_size'] = 0.99 * buffer['record_size'] + 0.01 * estimate_size(value)
+    else:
+        buffer['record_size'] = estimate_size(value)
+    return True
+
+
+def buffer_overflow(buffer):
+    """ освобождение места в буфере согласно его политике переполнения
+    :return: bool(), можно ли после этого принять новую запись
+    """
+    data = buffer['data']
+    policy = buffer['overflow_policy']
+    buffer['overflow_count'] += 1
+
+    if policy == OVERFLOW_DROP_NEWEST or not data:
+        buffer['lost_count'] += 1
+        return False
+
+    if policy == OVERFLOW_DROP_OLDEST:
+        data.pop(next(iter(data)))
+        buffer['lost_count'] += 1
+
+    elif policy == OVERFLOW_DECIMATE:
+        keys = list(data.keys())
+        # последнюю запись сохраняем, если она не единственная
+        keys_to_delete = keys[-2::-2] or keys[:1]
+        for key in keys_to_delete:
+            data.pop(key)
+        buffer['lost_count'] += len(keys_to_delete)
+
+    elif policy == OVERFLOW_SPILL_TO_DISK:
+        keys = list(data.keys())[:max(1, len(data) // 2)]
+        segment_records = max(1, min(spill_segment_records, buffer['capacity'] // 2))
+        # записанные сегменты больше не ждут - новый словарь, чтобы не менять читаемый потоком подгрузки
+        buffer['spill_pending'] = dict((file_name, event) for file_name, event in buffer['spill_pending'].items()
+                                       if not event.is_set())
+        for start in range(0, len(keys), segment_records):
+            segment_keys = keys[start:start + segment_records]
+            file_name = spill_segment_template.format(buffer['name'], segment_keys[0])
+            try:
+                # записи переводятся в текст до обращения к файлу - ошибка не оставляет сегмент недописанным
+                lines = [json.dumps([key, data[key]], default=_json_default) + '\n' for key in segment_keys]
+                segment = ''.join(lines).encode('utf-8')
+                if buffer['disk_writer'] is None:
+                    _write_segment(file_name, segment)
+                    continue
+                done_event = threading.Event()
+                if buffer['disk_writer'].write(file_name, segment, MODE_APPEND, done_event=done_event):
+                    buffer['spill_pending'][file_name] = done_event
+                else:
+                    logging.error(f'Disk writer queue is full - {len(segment_keys)} records of buffer '
+                                  f'{buffer["name"]} are not spilled')
+                    buffer['lost_count'] += len(segment_keys)
+            except (OSError, TypeError, ValueError) as e:
+                # диск недоступен или запись не переводится в json - остается только терять самые старые данные
+                logging.error(f'Error during spilling buffer {buffer["name"]} - exception: {e}')
+                buffer['lost_count'] += len(segment_keys)
+        for key in keys:
+            data.pop(key)
+
+    return True
+
+
+def spill_file_name(buffer):
+    return spill_file_template.format(buffer['name'])
+
+
+def spill_files(buffer):
+    """ файлы выгрузки буфера, самые старые - первыми (файл прежних версий, затем сегменты по времени первой записи) """
+    prefix = f'spill_{buffer["name"]}_'
+    segments = list()
+    for file_name in Path('.').glob(prefix + '*.jsonl'):
+        try:
+            segments.append((float(file_name.name[len(prefix):-len('.jsonl')]), file_name))
+        except ValueError:
+            continue
+    legacy = [Path(spill_file_name(buffer))] if Path(spill_file_name(buffer)).is_file() else list()
+    return legacy + [file_name for _, file_name in sorted(segments)]
+
+
+def buffer_refill(buffer, max_records=None):
+    """ подгрузка выгруженных на диск записей обратно в буфер (самые старые - первыми)
+    :param max_records: int(), сколько записей подгрузить, по умолчанию - сколько поместится
+    :return: int(), количество подгруженных записей
+    """
+    free_space = buffer['capacity'] - len(buffer['data'])
+    if max_records is not None:
+        free_space = min(free_space, max_records)
+    records = load_spilled(buffer, free_space)
+    insert_spilled(buffer, records)
+    return len(records)
+
+
+def load_spilled(buffer, max_records):
+    """ чтение и удаление сегментов выгрузки, самых старых, целиком, пока их записи помещаются в max_records
+    (только диск, буфер не меняется - можно выполнять в отдельном потоке)
+    :return: list(), [[ключ, запись], ...]
+    """
+    records = list()
+    spill_pending = buffer['spill_pending']
+    for file_name in spill_files(buffer):
+        # сегмент еще дописывается потоком записи - он и более новые подгрузятся в следующий раз
+        done_event = spill_pending.get(str(file_name))
+        if done_event is not None and not done_event.is_set():
+            break
+        with open(file_name, 'r') as f:
+            lines = f.readlines()
+        # сегмент, который не помещается, остается до следующей подгрузки (первый - подгружается всегда,
+        # иначе большой файл прежних версий не подгрузится никогда)
+        if max_records <= 0 or (records and len(records) + len(lines) > max_records):
+            break
+        records.extend(json.loads(line) for line in lines)
+        os.remove(file_name)
+    return records
+
+
+def insert_spilled(buffer, records):
+    """ подгруженные записи старше находящихся в буфере - вставляем их в начало """
+    if not records:
+        return
+    data = buffer['data']
+    newer_records = list(data.items())
+    data.clear()
+    data.update((key, value) for key, value in records)
+    data.update(newer_records)
+
+
+def buffer_clear(buffer):
+    """ удаление всех записей буфера, в том числе выгруженных на диск (поставленные в очередь сегменты сначала
+    дописываются, иначе они появились бы на диске уже после очистки)
+    """
+    buffer['data'].clear()
+    for done_event in list(buffer['spill_pending'].values()):
+        done_event.wait(spill_wait_sec)
+    buffer['spill_pending'] = dict()
+    for file_name in spill_files(buffer):
+        os.remove(file_name)
+
+
+def buffer_size_bytes(buffer):
+    return int(len(buffer['data']) * buffer['record_size'])
+
+
+class MemoryBudget:
+    """ общий бюджет памяти на все буферы - при превышении освобождаются наименее важные буферы """
+
+    def __init__(self, budget_bytes, buffers):
+        self.budget_bytes = budget_bytes
+        self.buffers = sorted(buffers, key=lambda b: b['priority'], reverse=True)
+
+    def add_buffer(self, buffer):
+        if not any(b is buffer for b in self.buffers):
+            self.buffers.append(buffer)
+            self.buffers.sort(key=lambda b: b['priority'], reverse=True)
+
+    def remove_buffer(self, buffer):
+        self.buffers = [b for b in self.buffers if b is not buffer]
+
+    def used_bytes(self):
+        return sum(buffer_size_bytes(buffer) for buffer in self.buffers)
+
+    def enforce(self):
+        """ применение политик переполнения, начиная с наименее важного буфера, пока не уложимся в бюджет
+        :return: int(), оценка освобожденной памяти, байт
+        """
+        used_bytes = self.used_bytes()
+        freed_bytes = 0
+        for buffer in self.buffers:
+            if buffer['overflow_policy'] == OVERFLOW_DROP_NEWEST:
+                # буфер не умеет освобождать место
+                continue
+            while used_bytes - freed_bytes > self.budget_bytes and buffer['data'] and buffer['is_ready']:
+                size_before = buffer_size_bytes(buffer)
+                buffer['is_ready'] = False
+                try:
+                    released = buffer_overflow(buffer)
+                finally:
+                    buffer['is_ready'] = True
+                if not released or buffer_size_bytes(buffer) >= size_before:
+                    break
+                freed_bytes += size_before - buffer_size_bytes(buffer)
+        return freed_bytes
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Контрольные точки состояния конвейера обработки
+#
+# Сервер периодически сохраняет состояние, которое иначе теряется при перезапуске (checkpoint_coroutine()):
+# неусредненные измерения открытого блока, открытые блоки старших уровней усреднения, рекомендованные температуры
+# приборов и разделов пересчета и собранные устройства задания. Файл небольшой и заменяется целиком (через временный
+# файл потоком записи на диск), поэтому после сбоя на диске остается последняя полностью записанная контрольная точка.
+#
+# Не отправленные на ОСМ записи (до capacity буфера) в контрольную точку не входят: новые записи дописываются
+# в журнал UPK_checkpoint_unsent.jsonl, а контрольная точка хранит время самой старой не отправленной записи в памяти
+# (unsent_from) - записи журнала старше него отправлены или уже выгружены в файл выгрузки буфера (UPK_buffers.py).
+# Журнал переписывается только не отправленными записями, когда в нем больше отправленных, чем не отправленных.
+#
+# При запуске контрольная точка загружается до применения задания с диска: собранные устройства попадают в кэш
+# сборки (UPK_device_schema.preload_compiled()), остальное восстанавливается после применения задания, если задание
+# совпадает с тем, при котором контрольная точка сохранена.
+#
+# Формат - pickle (в состоянии есть объекты ODTiT, массивы numpy и pandas.DataFrame), файл читается только из папки
+# сервера. Контрольная точка другой версии формата не загружается.
+
+import json
+import time
+import pickle
+import logging
+from pathlib import Path
+
+checkpoint_version = 2
+checkpoint_file_name = 'UPK_checkpoint.pickle'
+unsent_file_name = 'UPK_checkpoint_unsent.jsonl'
+
+
+def checkpoint_bytes(state):
+    """ данные контрольной точки для записи на диск
+    :param state: dict(), состояние конвейера
+    :return: bytes()
+    """
+    checkpoint = {'version': checkpoint_version, 'saved_time': time.time()}
+    checkpoint.update(state)
+    return pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def unsent_bytes(records):
+    """ строки журнала не отправленных на ОСМ записей
+    :param records: list(), [(время записи, строка записи), ...]
+    :return: bytes()
+    """
+    return ''.join([json.dumps([timestamp, line]) + '\n' for timestamp, line in records]).encode('utf-8')
+
+
+def load_unsent(from_time, file_name=unsent_file_name):
+    """ записи журнала, не отправленные на момент сохранения контрольной точки
+    :param from_time: float(), время самой старой не отправленной записи (unsent_from контрольной точки)
+    :return: list(), [(время записи, строка записи), ...]
+    """
+    if not Path(file_name).is_file():
+        return list()
+    records = dict()
+    with open(file_name, 'r') as f:
+        for line in f:
+            try:
+                timestamp, record = json.loads(line)
+            except (ValueError, TypeError):
+                # строка, недописанная при сбое
+                continue
+            if timestamp >= from_time:
+                records[timestamp] = record
+    return sorted(records.items())
+
+
+def load_checkpoint(file_name=checkpoint_file_name, unsent_file=unsent_file_name):
+    """ контрольная точка с диска
+    :return: dict(), состояние конвейера (с ключами version, saved_time и unsent - не отправленные записи журнала)
+        или None - нет файла, файл поврежден или другой версии
+    """
+    if not Path(file_name).is_file():
+        return None
+    try:
+        with open(file_name, 'rb') as f:
+            checkpoint = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError,
+            ValueError) as e:
+        logging.error(f'Checkpoint {file_name} is not loaded - exception: {e}')
+        return None
+
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') != checkpoint_version:
+        logging.error(f'Checkpoint {file_name} has unexpected format, ignored')
+        return None
+
+    try:
+        checkpoint['unsent'] = load_unsent(checkpoint['unsent_from'], unsent_file)
+    except (OSError, UnicodeDecodeError) as e:
+        logging.error(f'Unsent records journal {unsent_file} is not loaded - exception: {e}')
+        checkpoint['unsent'] = list()
+    return checkpoint
+
+
+def checkpoint_age_sec(checkpoint):
+    """ время с сохранения контрольной точки, с """
+    return time.time() - checkpoint['saved_time']
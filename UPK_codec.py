@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Сериализация JSON-сообщений websocket-соединения: стандартный модуль json или orjson (если установлен)
+#
+# Кодек выбирается ключом запуска --json=orjson, по умолчанию - стандартный json.
+# Оба кодека принимают числа numpy (их возвращает усреднение pandas) и возвращают str для текстовых кадров websocket.
+# NaN и бесконечность оба кодека пишут как null (как orjson; стандартный json иначе пишет NaN - это не JSON).
+
+import sys
+import json
+import math
+import asyncio
+import logging
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _numpy_default(obj):
+    """ сериализация скалярных значений и массивов numpy """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def _nan_to_none(obj):
+    """ копия obj, в которой NaN и бесконечность заменены на None (значения numpy - на числа python) """
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _nan_to_none(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_nan_to_none(value) for value in obj]
+    if hasattr(obj, 'tolist'):
+        return _nan_to_none(obj.tolist())
+    return obj
+
+
+class JsonCodec:
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        try:
+            return json.dumps(obj, ensure_ascii=False, default=_numpy_default, allow_nan=False)
+        except ValueError:
+            # в сообщении есть NaN или бесконечность - повтор с заменой на null
+            return json.dumps(_nan_to_none(obj), ensure_ascii=False, default=_numpy_default)
+
+    @staticmethod
+    def loads(msg):
+        return json.loads(msg)
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj, default=_numpy_default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    @staticmethod
+    def loads(msg):
+        return orjson.loads(msg)
+
+
+codecs = {JsonCodec.name: JsonCodec, OrjsonCodec.name: OrjsonCodec}
+
+
+def get_codec(name='json'):
+    """ кодек по имени; если orjson не установлен - стандартный json """
+    if name not in codecs:
+        raise ValueError(f'Unexpected JSON codec {name}, expected one of {list(codecs)}')
+    if name == OrjsonCodec.name and orjson is None:
+        logging.warning('orjson is not installed, standard json is used')
+        return JsonCodec
+    return codecs[name]
+
+
+def install_uvloop():
+    """ установка цикла событий uvloop (только Linux/macOS, если модуль установлен)
+    :return: новый цикл событий или None, если uvloop недоступен
+    """
+    if sys.platform == 'win32':
+        logging.warning('uvloop is not available on Windows, default asyncio event loop is used')
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning('uvloop is not installed, default asyncio event loop is used')
+        return None
+
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
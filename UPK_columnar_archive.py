@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+# Суточный столбцовый архив измерений
+#
+# Закрытые часовые текстовые файлы (усредненные %Y%m%d%H.txt и сырые %Y%m%d%H_raw.txt) переводятся в папку суток
+# %Y%m%d_avg_columns (%Y%m%d_raw_columns): по файлу .npy на столбец (Time.npy - время, отсортировано по возрастанию,
+# Device3_Fav_N_mean.npy, ...) и columns.json - список столбцов, количество строк и переведенные часовые файлы.
+# Столбцы устройства называются по его ID из задания (номер устройства в записи меняется при смене задания).
+# Какие устройства в записях часового файла, сервер пишет рядом в файл списков устройств (%Y%m%d%H.devices.txt,
+# DeviceLayouts): строка "время первой записи<TAB>ID<TAB>ID..." при каждом изменении списка. Часовой файл
+# переводится частями с одним списком устройств и одной шириной записи; для файлов без списков устройств (записанных
+# до их появления) столбцы называются по номеру устройства в записи.
+# Файлы .npy дописываются на месте (заголовок с запасом под размер), читаются через np.load(mmap_mode='r'):
+# интервал времени - двоичный поиск по Time.npy и срез, одно устройство - только его столбцы.
+#
+# Перевод выполняется в фоне (columnar_archive_coroutine() сервера), текстовые файлы остаются без изменений.
+
+import io
+import bisect
+import datetime
+import json
+import re
+import time
+from pathlib import Path
+
+from UPK_lazy import lazy_import
+from UPK_conversion import output_measurements_order2
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+time_column = 'Time'
+value_dtype = '<f4'  # значения записаны в текстовых архивах с точностью '%.3f'
+time_dtype = '<f8'
+npy_header_len = 128  # заголовок .npy с запасом, чтобы менять количество строк без сдвига данных
+meta_file_name = 'columns.json'
+
+hour_file_pattern = re.compile(r'^(\d{8})(\d{2})(_raw)?\.txt$')
+archive_kinds = {None: 'avg', '_raw': 'raw'}
+layout_file_suffix = '.devices.txt'
+
+
+def layout_file_name(file_name):
+    """ файл списков устройств часового файла: 2019041512_raw.txt - 2019041512_raw.devices.txt """
+    return str(file_name)[:-len('.txt')] + layout_file_suffix
+
+
+class DeviceLayouts:
+    """ списки устройств записей архива по времени: запись относится к последнему списку, начатому не позже нее """
+
+    max_entries = 100
+
+    def __init__(self):
+        self.entries = list()  # [(время первой записи, tuple() ID устройств), ...] по возрастанию времени
+
+    def note(self, record_time, device_ids):
+        """ запись с временем record_time сформирована для устройств device_ids (tuple()) """
+        if self.entries and (self.entries[-1][1] is device_ids or self.entries[-1][1] == device_ids):
+            return
+        self.entries.append((record_time, device_ids))
+        del self.entries[:-self.max_entries]
+
+    def entries_for(self, first_time, last_time):
+        """ списки, действующие для записей интервала [first_time, last_time] """
+        times = [entry_time for entry_time, _ in self.entries]
+        start = max(0, bisect.bisect_right(times, first_time) - 1)
+        return self.entries[start:bisect.bisect_right(times, last_time)]
+
+
+def encode_layouts(entries):
+    """ строки файла списков устройств """
+    return ''.join([f'{entry_time:.3f}\t' + '\t'.join([str(device_id) for device_id in device_ids]) + '\n'
+                    for entry_time, device_ids in entries])
+
+
+def read_layouts(file_name):
+    """ списки устройств часового файла
+    :return: list(), [(время первой записи, tuple() ID устройств), ...] по возрастанию времени; пустой - нет файла
+    """
+    file_name = Path(layout_file_name(file_name))
+    if not file_name.is_file():
+        return list()
+    entries = list()
+    with open(file_name) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0]:
+                entries.append((float(fields[0]), tuple(fields[1:]) if fields[1:] != [''] else tuple()))
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+def avg_column_names(device_ids, fields=output_measurements_order2):
+    """ столбцы усредненной записи (averaged_record()) для устройств с ID device_ids """
+    columns = [time_column]
+    for device_id in device_ids:
+        prefix = f'Device{device_id}_'
+        columns.append(prefix + 'n')
+        for field in fields:
+            columns.extend((prefix + field + '_mean', prefix + field + '_std'))
+        columns.extend((prefix + 'Fok_min', prefix + 'Fok_max'))
+    return columns
+
+
+def raw_column_names(device_ids):
+    """ столбцы сырой записи (время, F1 и F2 каждого устройства) """
+    columns = [time_column]
+    for device_id in device_ids:
+        columns.extend((f'Device{device_id}_F1_N', f'Device{device_id}_F2_N'))
+    return columns
+
+
+def record_devices_num(kind, width):
+    """ количество устройств в записи архива kind ('avg' или 'raw') шириной width """
+    devices_num, rest = divmod(width - 1, 3 + 2 * len(output_measurements_order2) if kind == 'avg' else 2)
+    if rest or width < 1:
+        raise ValueError(f'Unexpected {kind} record width {width}')
+    return devices_num
+
+
+def column_names(kind, device_ids):
+    """ столбцы записи архива kind ('avg' или 'raw') для устройств с ID device_ids """
+    return avg_column_names(device_ids) if kind == 'avg' else raw_column_names(device_ids)
+
+
+def day_archive_dir(directory, day, kind):
+    """ папка суточного архива, day - строка %Y%m%d """
+    return Path(directory) / f'{day}_{kind}_columns'
+
+
+def _npy_header(dtype, rows):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, rows)
+    magic = b'\x93NUMPY\x01\x00'
+    size = npy_header_len - len(magic) - 2
+    return magic + size.to_bytes(2, 'little') + header.ljust(size - 1).encode('latin1') + b'\n'
+
+
+def _append_column(file_name, dtype, rows_before, values):
+    """ дописывание значений в столбец, в котором должно быть rows_before строк (лишнее после сбоя отрезается,
+    недостающее - NaN) """
+    values = np.asarray(values, dtype=dtype)
+    mode = 'r+b' if file_name.is_file() else 'w+b'
+    with open(file_name, mode) as f:
+        f.seek(0, 2)
+        rows_in_file = max(0, (f.tell() - npy_header_len) // np.dtype(dtype).itemsize)
+        if rows_in_file < rows_before:
+            f.seek(max(f.tell(), npy_header_len))
+            f.write(np.full(rows_before - rows_in_file, np.nan, dtype=dtype).tobytes())
+        f.seek(npy_header_len + rows_before * np.dtype(dtype).itemsize)
+        f.truncate()
+        f.write(values.tobytes())
+        f.seek(0)
+        f.write(_npy_header(dtype, rows_before + len(values)))
+
+
+def read_meta(archive_dir):
+    meta_file = Path(archive_dir) / meta_file_name
+    if not meta_file.is_file():
+        return {'columns': [time_column], 'rows': 0, 'hours': []}
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def append_block(archive_dir, columns, values, source_name):
+    """ добавление блока строк в суточный архив
+    :param columns: list(), имена столбцов блока (первый - время)
+    :param values: np.ndarray(), shape (строк, len(columns))
+    :param source_name: str(), имя переведенного часового файла (записывается в columns.json)
+    """
+    archive_dir = Path(archive_dir)
+    archive_dir.mkdir(exist_ok=True)
+    meta = read_meta(archive_dir)
+    values = values[np.argsort(values[:, 0], kind='stable')]
+
+    rows_before = meta['rows']
+    if rows_before and len(values):
+        last_time = np.load(archive_dir / f'{time_column}.npy', mmap_mode='r')[rows_before - 1]
+        if values[0, 0] < last_time:
+            raise ValueError(f'{source_name} is older than the archive {archive_dir}')
+
+    # столбцы, которых нет в блоке (другой список устройств), дополняются NaN, новые столбцы - NaN в начале
+    block_columns = dict((column, num) for num, column in enumerate(columns))
+    all_columns = meta['columns'] + [column for column in columns if column not in meta['columns']]
+    for column in all_columns:
+        if column in block_columns:
+            column_values = values[:, block_columns[column]]
+        else:
+            column_values = np.full(len(values), np.nan)
+        dtype = time_dtype if column == time_column else value_dtype
+        _append_column(archive_dir / f'{column}.npy', dtype, rows_before, column_values)
+
+    meta['columns'] = all_columns
+    meta['rows'] = rows_before + len(values)
+    meta['hours'].append(source_name)
+    meta_file = archive_dir / meta_file_name
+    with open(str(meta_file) + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    Path(str(meta_file) + '.tmp').replace(meta_file)
+    return len(values)
+
+
+def read_hour_file(file_name):
+    """ значения часового текстового архива частями одной ширины записи (ширина меняется при смене задания)
+    :return: list(), [np.ndarray(), shape (строк, ширина записи), ...] в порядке следования в файле
+    """
+    with open(file_name) as f:
+        lines = [line for line in f.read().split('\n') if line and not line.startswith('Timestamp')]
+
+    parts = list()
+    start = 0
+    widths = [line.count('\t') for line in lines]
+    for end in range(1, len(lines) + 1):
+        if end < len(lines) and widths[end] == widths[start]:
+            continue
+        frame = pd.read_csv(io.StringIO('\n'.join(lines[start:end])), sep='\t', header=None, dtype=float,
+                            na_values=['nan', 'None'], engine='c')
+        parts.append(frame.to_numpy(dtype=float))
+        start = end
+    return parts
+
+
+def _row_layouts(kind, values, layouts):
+    """ номер списка устройств для каждой строки части файла: последний список, начатый не позже строки, с тем же
+    количеством устройств (записи, сформированные до смены задания, могут прийти позже ее) """
+    devices_num = record_devices_num(kind, values.shape[1])
+    suitable = [num for num, (_, device_ids) in enumerate(layouts) if len(device_ids) == devices_num]
+    if not suitable:
+        raise ValueError(f'No device list for {kind} records of {devices_num} devices')
+    suitable_times = [layouts[num][0] for num in suitable]
+    positions = np.searchsorted(suitable_times, values[:, 0], side='right') - 1
+    return np.asarray(suitable)[np.maximum(positions, 0)]
+
+
+def convert_hour_file(file_name, directory='.'):
+    """ перевод часового файла в суточный архив
+    :return: int(), количество переведенных строк
+    """
+    file_name = Path(file_name)
+    match = hour_file_pattern.match(file_name.name)
+    kind = archive_kinds[match.group(3)]
+    layouts = read_layouts(file_name)
+
+    # части с одним списком устройств и одной шириной записи, столбцы частей - по ID устройств
+    blocks = list()
+    for values in read_hour_file(file_name):
+        if not layouts:
+            device_ids = range(record_devices_num(kind, values.shape[1]))
+            blocks.append((column_names(kind, device_ids), values))
+            continue
+        row_layouts = _row_layouts(kind, values, layouts)
+        for layout_num in np.unique(row_layouts):
+            blocks.append((column_names(kind, layouts[layout_num][1]), values[row_layouts == layout_num]))
+
+    column_nums = {time_column: 0}
+    for block_columns, _ in blocks:
+        for column in block_columns:
+            column_nums.setdefault(column, len(column_nums))
+    columns = list(column_nums)
+    merged = np.full((sum([len(values) for _, values in blocks]), len(columns)), np.nan)
+    row = 0
+    for block_columns, values in blocks:
+        merged[row:row + len(values), [column_nums[column] for column in block_columns]] = values
+        row += len(values)
+    return append_block(day_archive_dir(directory, match.group(1), kind), columns, merged, file_name.name)
+
+
+def pending_hour_files(directory='.', now=None, grace_sec=300):
+    """ закрытые часовые файлы, еще не переведенные в суточный архив, по возрастанию времени
+    :param now: float(), текущее время, с (UTC), None - time.time()
+    :param grace_sec: float(), час считается закрытым через grace_sec после его окончания (запоздавшие записи)
+    """
+    now = time.time() if now is None else now
+
+    converted = dict()
+    pending = list()
+    for file_name in sorted(Path(directory).iterdir()):
+        match = hour_file_pattern.match(file_name.name)
+        if not match:
+            continue
+        hour_start = datetime.datetime.strptime(match.group(1) + match.group(2), '%Y%m%d%H').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        if hour_start + 3600 + grace_sec > now:
+            continue
+        archive_dir = day_archive_dir(directory, match.group(1), archive_kinds[match.group(3)])
+        if archive_dir not in converted:
+            converted[archive_dir] = set(read_meta(archive_dir)['hours'])
+        if file_name.name not in converted[archive_dir]:
+            pending.append(file_name)
+    return pending
+
+
+class ColumnarDayReader:
+    """ чтение суточного архива
+
+    reader = ColumnarDayReader('20190415_avg_columns')
+    times, values = reader.read('Device3_Fav_N_mean', start_time, end_time)
+    """
+
+    def __init__(self, archive_dir):
+        self.archive_dir = Path(archive_dir)
+        meta = read_meta(self.archive_dir)
+        self.columns = meta['columns']
+        self.rows = meta['rows']
+        self.hours = meta['hours']
+        self.time = self._load(time_column)
+
+    def _load(self, column):
+        if column not in self.columns:
+            raise KeyError(column)
+        if not self.rows:
+            return np.empty(0, dtype=time_dtype if column == time_column else value_dtype)
+        return np.load(self.archive_dir / f'{column}.npy', mmap_mode='r')[:self.rows]
+
+    def time_slice(self, start_time=None, end_time=None):
+        """ строки интервала [start_time, end_time) - двоичный поиск по времени """
+        start = 0 if start_time is None else int(np.searchsorted(self.time, start_time, side='left'))
+        end = self.rows if end_time is None else int(np.searchsorted(self.time, end_time, side='left'))
+        return slice(start, end)
+
+    def read(self, column, start_time=None, end_time=None):
+        """ :return: (время, значения) столбца за интервал - срезы отображенных в память файлов """
+        rows = self.time_slice(start_time, end_time)
+        return self.time[rows], self._load(column)[rows]
+
+    def device_columns(self, device_id):
+        """ столбцы одного устройства (по ID из задания) """
+        prefix = f'Device{device_id}_'
+        return [column for column in self.columns if column.startswith(prefix)]
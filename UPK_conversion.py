@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# Пересчет длин волн в измерения для списка устройств ОДТиТ одного прибора x55
+#
+# Функции модуля не используют глобальных переменных сервера, поэтому могут выполняться как в основном цикле,
+# так и в отдельном процессе (concurrent.futures.ProcessPoolExecutor) - устройства и пики передаются аргументами.
+#
+# convert_samples() выполняет поиск пиков и пересчет сразу для всех устройств и измерений пачки (UPK_device_table.py),
+# последовательно (по измерениям) вычисляется только рекомендованная температура.
+# convert_samples_by_device() - прежний пересчет по одному устройству, результат тот же.
+#
+# Устройства разных каналов не влияют на поиск пиков друг друга, поэтому пересчет можно разбить по каналам
+# (channel_partitions(), раздел - один или несколько каналов): каждый раздел пересчитывается своей пачкой
+# (channel_samples()) со своей рекомендованной температурой, независимо и параллельно с другими,
+# а merge_partition_rows() собирает строки прибора по измерениям.
+
+import statistics
+
+from UPK_lazy import lazy_import
+from UPK_device_table import DeviceTable, MATCH_FOUND, MATCH_AMBIGUOUS
+
+np = lazy_import('numpy')
+
+output_measurements_order2 = ['T_degC', 'Fav_N', 'Fbend_N', 'Ice_mm']  # последовательность выдачи данных
+t_smoothing_factor = 0.3  # вес текущего измерения при сглаживании рекомендованной температуры
+conversion_chunk_samples = 64  # измерений, пересчитываемых одной операцией (ограничивает память под пики)
+
+
+def convert_samples(devices, samples, t_recommended=None, output_fields=output_measurements_order2):
+    """ пересчет пачки измерений прибора
+    :param devices: DeviceTable или list(), устройства ODTiT прибора
+    :param samples: list(), [(measurement_time, peaks_by_channel), ...], peaks_by_channel - {канал: длины волн, нм}
+        (список или np.ndarray(), например peaks_by_channel_from_packet())
+    :param t_recommended: float(), ориентировочная температура устройств (с предыдущего вызова), None - неизвестна
+    :param output_fields: list(), поля устройства, попадающие в выходную строку
+    :return: (rows, raw_rows, t_recommended),
+        rows - [[measurement_time, поля устройства 0, поля устройства 1, ...], ...],
+        raw_rows - [[measurement_time, F1 устройства 0, F2 устройства 0, ...], ...],
+        t_recommended - ориентировочная температура для следующего вызова;
+        у ненайденных устройств - NaN
+    """
+    table = devices if isinstance(devices, DeviceTable) else DeviceTable(devices)
+
+    rows = list()
+    raw_rows = list()
+    for chunk_start in range(0, len(samples), conversion_chunk_samples):
+        chunk = samples[chunk_start:chunk_start + conversion_chunk_samples]
+        chunk_rows, chunk_raw_rows, t_recommended = _convert_chunk(table, chunk, t_recommended, output_fields)
+        rows.extend(chunk_rows)
+        raw_rows.extend(chunk_raw_rows)
+    return rows, raw_rows, t_recommended
+
+
+def _convert_chunk(table, samples, t_recommended, output_fields):
+    peaks = table.peaks_array(samples)
+    status, wls = table.match(peaks)
+    found = status == MATCH_FOUND
+    temperatures = table.temperature(wls[:, :, 0])
+
+    # рекомендованная температура зависит от предыдущего измерения - проходим по измерениям: неоднозначные случаи
+    # ищем заново с рекомендованной температурой измерения, устройства с общими пиками - через ODTiT
+    shared = table.shared
+    for sample_num in range(len(samples)):
+        if t_recommended is None:
+            # первый проход ODTiT: без рекомендованной температуры и без удаления найденных пиков
+            t_recommended = _table_first_pass_temperature(table, temperatures[sample_num], found[sample_num])
+
+        ambiguous = (status[sample_num] == MATCH_AMBIGUOUS) & ~shared
+        if t_recommended and ambiguous.any():
+            sample_status, sample_wls = table.match(peaks[sample_num:sample_num + 1], t_recommended)
+            wls[sample_num, ambiguous] = sample_wls[0, ambiguous]
+            found[sample_num, ambiguous] = sample_status[0, ambiguous] == MATCH_FOUND
+            temperatures[sample_num, ambiguous] = table.temperature(sample_wls[0, :, 0])[ambiguous]
+
+        # однозначно найденные устройства с общими пиками определяются заново - с удалением найденных пиков
+        # (пики в пм - из массива пачки, уже пересчитанного одной операцией)
+        found[sample_num, shared] = False
+        if table.shared_indexes:
+            peaks_pm = dict((channel, wls_pm[~np.isnan(wls_pm)].tolist())
+                            for channel, wls_pm in zip(table.channels, peaks[sample_num]))
+            for device_num in table.shared_indexes:
+                device = table.devices[device_num]
+                device_wls = device.find_yours_wls(peaks_pm[device.channel], device.channel, t_recommended)
+                _set_device_wls(table, sample_num, device_num, device_wls, wls, found, temperatures)
+
+        # температура для следующего измерения
+        t_recommended = smooth_temperature(t_recommended, temperatures[sample_num, found[sample_num]].tolist())
+
+    outputs = table.outputs(wls, found)
+    times = np.array([[measurement_time] for measurement_time, _ in samples], dtype=float).reshape(len(samples), 1)
+    fields = np.stack([outputs[field] for field in output_fields], axis=2).reshape(len(samples), -1)
+    raw = np.stack([outputs['F1_N'], outputs['F2_N']], axis=2).reshape(len(samples), -1)
+    return np.hstack((times, fields)).tolist(), np.hstack((times, raw)).tolist(), t_recommended
+
+
+def _set_device_wls(table, sample_num, device_num, device_wls, wls, found, temperatures):
+    """ результат ODTiT.find_yours_wls() в массивы пересчета пачки """
+    if not device_wls:
+        found[sample_num, device_num] = False
+        return
+    wls[sample_num, device_num] = device_wls
+    found[sample_num, device_num] = True
+    temperatures[sample_num, device_num] = table.devices[device_num].get_temperature(device_wls[0])
+
+
+def _table_first_pass_temperature(table, temperatures, found):
+    """ first_pass_temperature() по результату DeviceTable.match() одного измерения """
+    if found.any():
+        return statistics.median(temperatures[found].tolist())
+    if len(table):
+        return (table.devices[0].t_max + table.devices[0].t_min) / 2
+    return None
+
+
+def convert_samples_by_device(devices, samples, t_recommended=None, output_fields=output_measurements_order2):
+    """ пересчет пачки измерений прибора по одному устройству (через ODTiT), результат - как у convert_samples()
+    :param devices: list(), устройства ODTiT прибора
+    :param samples: list(), [(measurement_time, peaks_by_channel), ...], peaks_by_channel - {канал: [длины волн, нм]}
+    :param t_recommended: float(), ориентировочная температура устройств (с предыдущего вызова), None - неизвестна
+    :param output_fields: list(), поля устройства, попадающие в выходную строку
+    :return: (rows, raw_rows, t_recommended),
+        rows - [[measurement_time, поля устройства 0, поля устройства 1, ...], ...],
+        raw_rows - [[measurement_time, F1 устройства 0, F2 устройства 0, ...], ...],
+        t_recommended - ориентировочная температура для следующего вызова
+    """
+    rows = list()
+    raw_rows = list()
+
+    for measurement_time, peaks_by_channel in samples:
+        row = [measurement_time] + [None] * len(output_fields) * len(devices)
+        raw_row = [measurement_time]
+
+        # переводим пики в пикометры
+        peaks_by_channel = dict((channel, (np.asarray(wls, dtype=float) * 1000).tolist())
+                                for channel, wls in peaks_by_channel.items())
+
+        # рекомендованная температура - сглаженная по предыдущим измерениям, если ее нет (первое измерение или
+        # ни одно устройство не нашлось) - по пикам, однозначно принадлежащим устройствам (дополнительный проход)
+        if t_recommended is None:
+            t_recommended = first_pass_temperature(devices, peaks_by_channel)
+
+        # находим пики с учетом рекомендованной температуры
+        temperatures = list()
+        for device_num, device in enumerate(devices):
+            # среди всех пиков ищем 3 подходящих для текущего измерителя
+            wls = device.find_yours_wls(peaks_by_channel.get(device.channel, []), device.channel, t_recommended)
+
+            # если все три пика измерителя нашлись, то вычисляем тяжения и пр. Нет - оставляем пустышки
+            if wls:
+                device_output = device.get_tension_fav_ex(wls[1], wls[2], wls[0])
+                temperatures.append(device_output['T_degC'])
+
+                for field_num, field in enumerate(output_fields):
+                    row[1 + device_num * len(output_fields) + field_num] = device_output[field]
+
+                raw_row.append(device_output['F1_N'])
+                raw_row.append(device_output['F2_N'])
+            else:
+                raw_row.append(None)
+                raw_row.append(None)
+
+        # температура для следующего измерения
+        t_recommended = smooth_temperature(t_recommended, temperatures)
+
+        rows.append(row)
+        raw_rows.append(raw_row)
+
+    return rows, raw_rows, t_recommended
+
+
+def first_pass_temperature(devices, peaks_by_channel):
+    """ ориентировочная температура без предыдущих измерений - медиана температур устройств, у которых пики
+    находятся однозначно (без рекомендованной температуры)
+    :param peaks_by_channel: dict(), {канал: [длины волн, пм]}
+    """
+    temperatures = list()
+    for device in devices:
+        wls = device.find_yours_wls(peaks_by_channel.get(device.channel, []), delete_founded_peaks=False)
+        if wls:
+            temperatures.append(device.get_temperature(wls[0]))
+
+    if temperatures:
+        return statistics.median(temperatures)
+    if devices:
+        return (devices[0].t_max + devices[0].t_min) / 2
+    return None
+
+
+def smooth_temperature(t_recommended, temperatures):
+    """ экспоненциальное сглаживание рекомендованной температуры медианой температур устройств текущего измерения
+    :return: float() или None - устройства не нашлись, следующее измерение начнется с first_pass_temperature()
+    """
+    if not temperatures:
+        return None
+    t_measured = statistics.median(temperatures)
+    if t_recommended is None:
+        return t_measured
+    return t_recommended + t_smoothing_factor * (t_measured - t_recommended)
+
+
+def packet_peaks(peaks):
+    """ длины волн пакета пиков hyperion без поэлементного копирования
+    :param peaks: hyperion.HACQPeaksData, peak_data['data'] из очереди HCommTCPPeaksStreamer
+    :return: (wls, offsets), wls - np.ndarray(), длины волн всех каналов подряд, нм (по возможности - представление
+        данных пакета без копирования), offsets - np.ndarray(int), границы каналов: пики канала n (с 1) -
+        wls[offsets[n - 1]:offsets[n]]
+    """
+    channel_slices = peaks.channel_slices
+    offsets = np.zeros(len(channel_slices) + 1, dtype=np.intp)
+    np.cumsum([len(channel_wls) for channel_wls in channel_slices], out=offsets[1:])
+
+    # данные пакета - длины волн каналов подряд (channel_slices - их срезы)
+    data = getattr(peaks, 'data', None)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = np.frombuffer(data, dtype=np.float64)
+    if isinstance(data, np.ndarray) and data.ndim == 1 and len(data) == offsets[-1]:
+        return data, offsets
+
+    if not len(channel_slices):
+        return np.empty(0), offsets
+    return np.concatenate([np.asarray(channel_wls, dtype=float) for channel_wls in channel_slices]), offsets
+
+
+def channel_peaks(wls, offsets):
+    """ длины волн по каналам - представления массива wls (packet_peaks()) без копирования
+    :return: dict(), {канал (с 1): np.ndarray(), длины волн, нм}
+    """
+    return dict((channel + 1, wls[offsets[channel]:offsets[channel + 1]]) for channel in range(len(offsets) - 1))
+
+
+def peaks_by_channel_from_packet(peaks):
+    """ длины волн пакета пиков hyperion по каналам
+    :param peaks: hyperion.HACQPeaksData, peak_data['data'] из очереди HCommTCPPeaksStreamer
+    :return: dict(), {канал (с 1): np.ndarray(), длины волн, нм}
+    """
+    return channel_peaks(*packet_peaks(peaks))
+
+
+class ChannelPartition:
+    """ устройства прибора на части каналов - раздел пересчета """
+
+    def __init__(self, channels, device_indexes, table):
+        """
+        :param channels: tuple(), каналы раздела
+        :param device_indexes: list(), номера устройств раздела в списке устройств прибора
+        :param table: DeviceTable, устройства раздела
+        """
+        self.channels = channels
+        self.device_indexes = device_indexes
+        self.table = table
+        self.t_recommended = None  # ориентировочная температура устройств раздела
+
+    def __repr__(self):
+        return f'ChannelPartition(channels={self.channels}, devices={len(self.device_indexes)})'
+
+
+def channel_partitions(devices, coefficients=None, partitions_num=None):
+    """ разбиение устройств прибора по каналам
+    :param devices: list(), устройства ODTiT прибора
+    :param coefficients: np.ndarray(), таблица коэффициентов устройств (UPK_device_schema.CompiledDevices),
+        None - собирается по devices
+    :param partitions_num: int(), наибольшее количество разделов (каналы объединяются в разделы с близким
+        количеством устройств - у каждого раздела своя постоянная часть затрат на пачку), None - по разделу на канал
+    :return: list(), ChannelPartition по возрастанию номеров каналов
+    """
+    indexes_by_channel = dict()
+    for device_num, device in enumerate(devices):
+        indexes_by_channel.setdefault(int(device.channel), []).append(device_num)
+    if partitions_num is None:
+        partitions_num = len(indexes_by_channel)
+
+    # каналы с большим количеством устройств распределяются первыми, каждый - в наименее загруженный раздел
+    groups = [[] for _ in range(max(1, min(partitions_num, len(indexes_by_channel))))]
+    for channel in sorted(indexes_by_channel, key=lambda channel: (-len(indexes_by_channel[channel]), channel)):
+        min(groups, key=lambda group: sum([len(indexes_by_channel[group_channel]) for group_channel in group])).append(
+            channel)
+
+    if coefficients is not None:
+        coefficients = np.asarray(coefficients, dtype=float).reshape(len(devices), -1)
+    partitions = list()
+    for channels in sorted(tuple(sorted(group)) for group in groups if group):
+        device_indexes = sorted(device_num for channel in channels for device_num in indexes_by_channel[channel])
+        table = DeviceTable([devices[device_num] for device_num in device_indexes],
+                            None if coefficients is None else coefficients[device_indexes])
+        partitions.append(ChannelPartition(channels, device_indexes, table))
+    return partitions
+
+
+def channel_samples(samples, channels):
+    """ пачка измерений только с пиками каналов channels (меньше данных при передаче в процесс пересчета)
+    :param samples: list(), [(measurement_time, peaks_by_channel), ...]
+    """
+    return [(measurement_time, dict((channel, peaks_by_channel.get(channel, ())) for channel in channels))
+            for measurement_time, peaks_by_channel in samples]
+
+
+def merge_partition_rows(times, partitions, results, devices_num, output_fields=output_measurements_order2):
+    """ сборка строк прибора по измерениям из результатов пересчета разделов
+    :param times: list(), время измерений пачки (в порядке измерений)
+    :param partitions: list(), ChannelPartition
+    :param results: list(), (rows, raw_rows) convert_samples() каждого раздела по этой пачке измерений
+    :param devices_num: int(), количество устройств прибора
+    :return: (rows, raw_rows) как у convert_samples() для всех устройств прибора
+    """
+    samples_num = len(times)
+    fields_num = len(output_fields)
+    fields = np.full((samples_num, devices_num, fields_num), np.nan)
+    raw = np.full((samples_num, devices_num, 2), np.nan)
+    times = np.asarray(times, dtype=float).reshape(samples_num, 1)
+
+    for partition, (rows, raw_rows) in zip(partitions, results):
+        if len(rows) != samples_num:
+            raise ValueError(f'{partition} returned {len(rows)} rows for {samples_num} samples')
+        if not samples_num:
+            continue
+        rows = np.asarray(rows, dtype=float)
+        raw_rows = np.asarray(raw_rows, dtype=float)
+        if not np.array_equal(rows[:, :1], times):
+            raise ValueError(f'{partition} rows do not match the measurement times')
+        fields[:, partition.device_indexes] = rows[:, 1:].reshape(samples_num, -1, fields_num)
+        raw[:, partition.device_indexes] = raw_rows[:, 1:].reshape(samples_num, -1, 2)
+
+    return np.hstack((times, fields.reshape(samples_num, -1))).tolist(), \
+        np.hstack((times, raw.reshape(samples_num, -1))).tolist()
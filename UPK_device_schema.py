@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Схема описания устройства ОДТиТ в задании и сборка устройств по ней
+#
+# Для каждой версии описания устройства задан список полей: ключ задания, атрибут ODTiT (или решетки FBG) и тип.
+# Проверка проходит по всем устройствам задания сразу и возвращает все ошибки (а не первую KeyError).
+# Собранный список устройств содержит объекты ODTiT (для поиска пиков) и таблицу коэффициентов
+# (numpy, устройство - строка, столбцы - coefficient_names) для векторного пересчета.
+# Результат сборки кэшируется по хэшу описаний устройств - повторное задание не проверяется и не собирается заново
+# (из кэша выдаются копии устройств, чтобы два прибора или два задания не делили один объект ODTiT).
+
+import copy
+import hashlib
+import collections
+
+from OptenFiberOpticDevices import ODTiT
+from UPK_lazy import lazy_import
+from UPK_instruments import canonical_description
+
+np = lazy_import('numpy')
+
+index_of_reflection = 1.4682
+speed_of_light = 299792458.0
+
+# типы значений полей
+NUMBER = 'number'
+INTEGER = 'integer'
+ANY = 'any'
+
+# поля устройства: ключ задания, атрибут ODTiT (None - используется при вычислении производных атрибутов), тип
+device_fields_v01 = [
+    ('ID', 'id', ANY),
+    ('Name', 'name', ANY),
+    ('x55_channel', 'channel', INTEGER),
+    ('CTES', 'ctes', NUMBER),
+    ('E', 'e', NUMBER),
+    ('Asize', None, NUMBER),
+    ('Bsize', None, NUMBER),
+    ('Tmin', 't_min', NUMBER),
+    ('Tmax', 't_max', NUMBER),
+    ('Fmin', 'f_min', NUMBER),
+    ('Fmax', 'f_max', NUMBER),
+    ('Freserve', 'f_reserve', NUMBER),
+    ('SpanRopeDiametr', 'span_rope_diameter', NUMBER),
+    ('SpanRopeLen', 'span_len', NUMBER),
+    ('SpanRopeDensity', 'span_rope_density', NUMBER),
+    ('SpanRopeEJ', 'span_rope_EJ', NUMBER),
+    ('Bending_sensivity', 'bend_sens', NUMBER),
+    ('Distance', None, NUMBER),
+]
+device_fields_v02 = device_fields_v01 + [
+    ('Fmodel_F0', 'fmodel_f0', NUMBER),
+    ('Fmodel_F1', 'fmodel_f1', NUMBER),
+    ('Fmodel_F2', 'fmodel_f2', NUMBER),
+    ('ICEmodel_I1', 'icemodel_i1', NUMBER),
+    ('ICEmodel_I2', 'icemodel_i2', NUMBER),
+]
+
+# поля решеток: ключ описания решетки, атрибут FBG, тип
+sensor_fields_common = [
+    ('ID', 'id', ANY),
+    ('type', 'type', ANY),
+    ('name', 'name', ANY),
+    ('WL0', 'wl0', NUMBER),
+    ('T0', 't0', NUMBER),
+    ('Pmax', 'p_max', NUMBER),
+    ('Pmin', 'p_min', NUMBER),
+]
+temperature_sensor_fields = sensor_fields_common + [('ST', 'st', NUMBER)]
+strain_sensor_fields = sensor_fields_common + [('FG', 'fg', NUMBER), ('CTET', 'ctet', NUMBER)]
+
+# решетки устройства: ключ задания, номер решетки в ODTiT.sensors, поля
+sensors_v01 = [
+    ('Sensor4100', 0, temperature_sensor_fields),
+    ('Sensor3110_1', 1, strain_sensor_fields),
+    ('Sensor3110_2', 2, strain_sensor_fields),
+]
+
+device_schemas = {
+    '0.1': {'fields': device_fields_v01, 'sensors': sensors_v01},
+    '0.2': {'fields': device_fields_v02, 'sensors': sensors_v01},
+}
+
+# столбцы таблицы коэффициентов: имя - функция получения значения из ODTiT
+coefficient_getters = collections.OrderedDict([
+    ('channel', lambda d: d.channel),
+    ('t_wl0', lambda d: d.sensors[0].wl0),
+    ('t_t0', lambda d: d.sensors[0].t0),
+    ('t_st', lambda d: d.sensors[0].st),
+    ('s1_wl0', lambda d: d.sensors[1].wl0),
+    ('s1_t0', lambda d: d.sensors[1].t0),
+    ('s1_fg', lambda d: d.sensors[1].fg),
+    ('s1_ctet', lambda d: d.sensors[1].ctet),
+    ('s2_wl0', lambda d: d.sensors[2].wl0),
+    ('s2_t0', lambda d: d.sensors[2].t0),
+    ('s2_fg', lambda d: d.sensors[2].fg),
+    ('s2_ctet', lambda d: d.sensors[2].ctet),
+    ('ctes', lambda d: d.ctes),
+    ('e', lambda d: d.e),
+    ('asize', lambda d: d.size[0]),
+    ('bsize', lambda d: d.size[1]),
+    ('t_min', lambda d: d.t_min),
+    ('t_max', lambda d: d.t_max),
+    ('f_min', lambda d: d.f_min),
+    ('f_max', lambda d: d.f_max),
+    ('f_reserve', lambda d: d.f_reserve),
+    ('bend_sens', lambda d: d.bend_sens),
+    ('fmodel_f0', lambda d: d.fmodel_f0),
+    ('fmodel_f1', lambda d: d.fmodel_f1),
+    ('fmodel_f2', lambda d: d.fmodel_f2),
+    ('icemodel_i1', lambda d: d.icemodel_i1),
+    ('icemodel_i2', lambda d: d.icemodel_i2),
+])
+coefficient_names = list(coefficient_getters.keys())
+coefficient_index = dict((name, num) for num, name in enumerate(coefficient_names))
+
+compiled_cache_size = 16  # количество кэшируемых результатов сборки
+_compiled_cache = collections.OrderedDict()
+
+
+class DeviceDescriptionError(ValueError):
+    """ ошибки в описаниях устройств - все сразу, в errors """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__(f'{len(self.errors)} errors in devices description: ' + '; '.join(self.errors))
+
+
+class CompiledDevices:
+    """ устройства, собранные по описаниям из задания """
+
+    def __init__(self, digest, devices, coefficients):
+        self.digest = digest  # хэш описаний устройств
+        self.devices = devices  # list(), ODTiT
+        self.coefficients = coefficients  # np.ndarray(), shape (количество устройств, len(coefficient_names))
+
+    def __len__(self):
+        return len(self.devices)
+
+
+def _check_value(value, value_type):
+    if value_type == NUMBER:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if value_type == INTEGER:
+        if isinstance(value, float):
+            return value.is_integer()
+        return isinstance(value, int) and not isinstance(value, bool)
+    return True
+
+
+def _check_fields(description, fields, prefix, errors):
+    for key, _, value_type in fields:
+        if key not in description:
+            errors.append(f'{prefix}: key {key} did not find')
+        elif not _check_value(description[key], value_type):
+            errors.append(f'{prefix}: {key} should be {value_type}, got {description[key]!r}')
+
+
+def validate_devices(devices_descriptions, prefix=''):
+    """ проверка описаний устройств по схеме их версий
+    :param devices_descriptions: list(), описания устройств из задания
+    :param prefix: str(), начало сообщений об ошибках (например, прибор)
+    :return: list(), сообщения обо всех найденных ошибках (пустой - ошибок нет)
+    """
+    errors = list()
+    if not isinstance(devices_descriptions, list):
+        return [f'{prefix}devices should be a list']
+
+    for device_num, description in enumerate(devices_descriptions):
+        device_prefix = f'{prefix}device {device_num}'
+        if not isinstance(description, dict):
+            errors.append(f'{device_prefix}: description should be an object')
+            continue
+        if 'ID' in description:
+            device_prefix += f' (ID {description["ID"]})'
+
+        schema = device_schemas.get(description.get('version'))
+        if schema is None:
+            errors.append(f'{device_prefix}: unknown version {description.get("version")!r}, '
+                          f'expected one of {list(device_schemas)}')
+            continue
+
+        _check_fields(description, schema['fields'], device_prefix, errors)
+        for sensor_key, _, sensor_fields in schema['sensors']:
+            if not isinstance(description.get(sensor_key), dict):
+                errors.append(f'{device_prefix}: key {sensor_key} did not find')
+                continue
+            _check_fields(description[sensor_key], sensor_fields, f'{device_prefix} {sensor_key}', errors)
+
+    return errors
+
+
+def build_device(description):
+    """ создание ODTiT по проверенному описанию (validate_devices) """
+    schema = device_schemas[description['version']]
+
+    device = ODTiT(description['x55_channel'])
+    for key, attribute, _ in schema['fields']:
+        if attribute:
+            setattr(device, attribute, description[key])
+    device.size = (description['Asize'], description['Bsize'])
+    device.time_of_flight = int(-2E9 * description['Distance'] * index_of_reflection / speed_of_light)
+
+    for sensor_key, sensor_num, sensor_fields in schema['sensors']:
+        sensor = device.sensors[sensor_num]
+        for key, attribute, _ in sensor_fields:
+            setattr(sensor, attribute, description[sensor_key][key])
+    return device
+
+
+def devices_coefficients(devices):
+    """ таблица коэффициентов устройств, shape (количество устройств, len(coefficient_names)) """
+    coefficients = np.empty((len(devices), len(coefficient_names)))
+    for device_num, device in enumerate(devices):
+        coefficients[device_num] = [getter(device) for getter in coefficient_getters.values()]
+    return coefficients
+
+
+def compile_devices(devices_descriptions, prefix=''):
+    """ проверка и сборка устройств (с кэшированием по хэшу описаний)
+    :return: CompiledDevices
+    :raise DeviceDescriptionError: в описаниях есть ошибки (все ошибки - в errors)
+    """
+    digest = hashlib.sha1(canonical_description(devices_descriptions).encode('utf-8')).hexdigest()
+    if digest in _compiled_cache:
+        _compiled_cache.move_to_end(digest)
+        cached = _compiled_cache[digest]
+        return CompiledDevices(digest, copy.deepcopy(cached.devices), cached.coefficients)
+
+    errors = validate_devices(devices_descriptions, prefix)
+    if errors:
+        raise DeviceDescriptionError(errors)
+
+    devices = [build_device(description) for description in devices_descriptions]
+    coefficients = devices_coefficients(devices)
+    coefficients.flags.writeable = False  # общая для всех копий из кэша
+
+    _compiled_cache[digest] = CompiledDevices(digest, copy.deepcopy(devices), coefficients)
+    while len(_compiled_cache) > compiled_cache_size:
+        _compiled_cache.popitem(last=False)
+    return CompiledDevices(digest, devices, coefficients)
+
+
+def cached_compiled(digest):
+    """ собранные устройства из кэша по хэшу описаний (None - нет в кэше) """
+    return _compiled_cache.get(digest)
+
+
+def preload_compiled(compiled_list):
+    """ заполнение кэша сборки готовыми устройствами (например, из контрольной точки) - следующая сборка
+    тех же описаний не проверяет и не собирает их заново
+    :param compiled_list: list(), CompiledDevices
+    """
+    for compiled in compiled_list:
+        compiled.coefficients.flags.writeable = False
+        _compiled_cache[compiled.digest] = compiled
+    while len(_compiled_cache) > compiled_cache_size:
+        _compiled_cache.popitem(last=False)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Таблица устройств ОДТиТ прибора в виде столбцов numpy (по столбцу на коэффициент, по строке на устройство)
+#
+# Поиск пиков устройств и пересчет в измерения выполняются сразу для всех устройств и всех измерений пачки
+# по тем же формулам, что и в ODTiT. Неоднозначные случаи (в окне решетки несколько пиков, выбор зависит
+# от рекомендованной температуры) разрешаются повторным поиском по измерению с его рекомендованной температурой.
+# По-прежнему через ODTiT.find_yours_wls() (по одному устройству) обрабатываются устройства, окна решеток которых
+# пересекаются с окнами решеток других устройств того же канала (найденный пик удаляется из списка и влияет на поиск
+# следующих устройств).
+
+from UPK_lazy import lazy_import
+from UPK_device_schema import coefficient_names, devices_coefficients
+
+np = lazy_import('numpy')
+
+envelope_margin_pm = 1.0  # расширение окон решеток при проверке их пересечения между устройствами
+
+# статус поиска пиков устройства в измерении
+MATCH_FAILED = 0
+MATCH_FOUND = 1
+MATCH_AMBIGUOUS = 2  # нужен поиск с рекомендованной температурой
+
+
+class DeviceTable:
+    """ коэффициенты устройств прибора по столбцам: столбцы - атрибуты с именами coefficient_names
+    (channel, t_wl0, s1_fg, ...), np.ndarray() длиной в количество устройств """
+
+    def __init__(self, devices, coefficients=None):
+        """
+        :param devices: list(), устройства ODTiT прибора
+        :param coefficients: np.ndarray(), таблица коэффициентов устройств (UPK_device_schema.CompiledDevices),
+            None - собирается по devices
+        """
+        self.devices = list(devices)
+        if coefficients is None:
+            coefficients = devices_coefficients(self.devices)
+        coefficients = np.asarray(coefficients, dtype=float).reshape(len(self.devices), len(coefficient_names))
+        for name, column in zip(coefficient_names, coefficients.T):
+            setattr(self, name, column.copy())
+        self.channel = self.channel.astype(int)
+
+        # номер канала устройства в списке каналов, на которых есть устройства
+        self.channels, self.channel_column = np.unique(self.channel, return_inverse=True)
+        self.channels = self.channels.tolist()
+
+        # окно температурной решетки не зависит от измерения
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.t_wl_min = self.temperature_wl(self.t_min)
+            self.t_wl_max = self.temperature_wl(self.t_max)
+            self.shared = self._shared_devices()
+        self.shared_indexes = np.flatnonzero(self.shared).tolist()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def temperature_wl(self, temperature):
+        """ длина волны температурной решетки при заданной температуре (ODTiT._get_wl_from_value), пм """
+        return self.t_wl0 * (1 + (temperature - self.t_t0) * self.t_st)
+
+    def strain_wl(self, sensor_num, temperature, force):
+        """ длина волны натяжной решетки (1 или 2) при заданной температуре и силе (ODTiT._get_wl_from_value), пм """
+        wl0, t0, fg, ctet = self._strain_sensor(sensor_num)
+        return wl0 * (1 + (((force - self.f_reserve) * 10 / (self.e * self.asize * self.bsize * 1E-6) -
+                            (temperature - t0) * (ctet - self.ctes) / 1E+6) * fg +
+                           (temperature - self.t_t0) * self.t_st))
+
+    def temperature(self, wl_temperature_sensor):
+        """ температура устройства по длине волны температурной решетки (FBG.get_temperature) """
+        return self.t_t0 + (wl_temperature_sensor - self.t_wl0) / (self.t_wl0 * self.t_st)
+
+    def _strain_sensor(self, sensor_num):
+        if sensor_num == 1:
+            return self.s1_wl0, self.s1_t0, self.s1_fg, self.s1_ctet
+        return self.s2_wl0, self.s2_t0, self.s2_fg, self.s2_ctet
+
+    def _shared_devices(self):
+        """ устройства, окна решеток которых (во всем диапазоне температур и сил) пересекаются с окнами
+        решеток других устройств того же канала """
+        envelopes = [(self.t_wl_min, self.t_wl_max)]
+        for sensor_num in (1, 2):
+            wls = [self.strain_wl(sensor_num, temperature, force)
+                   for temperature in (self.t_min, self.t_max)
+                   for force in (self.f_min - self.f_reserve, self.f_max + self.f_reserve)]
+            envelopes.append((np.minimum.reduce(wls), np.maximum.reduce(wls)))
+        wl_min = np.concatenate([np.minimum(*envelope) for envelope in envelopes]) - envelope_margin_pm
+        wl_max = np.concatenate([np.maximum(*envelope) for envelope in envelopes]) + envelope_margin_pm
+        device = np.tile(np.arange(len(self.devices)), 3)
+        channel = self.channel[device]
+
+        overlap = (wl_min[:, None] <= wl_max[None, :]) & (wl_min[None, :] <= wl_max[:, None]) & \
+                  (channel[:, None] == channel[None, :]) & (device[:, None] != device[None, :])
+        shared = np.zeros(len(self.devices), dtype=bool)
+        shared[device[overlap.any(axis=1)]] = True
+        return shared
+
+    def peaks_array(self, samples):
+        """ пики измерений по каналам устройств
+        :param samples: list(), [(measurement_time, peaks_by_channel), ...], peaks_by_channel - {канал: длины волн, нм}
+            (список или np.ndarray())
+        :return: np.ndarray(), длины волн, пм, shape (измерений, каналов self.channels, наибольшее количество пиков),
+            недостающие пики - NaN; пересчет в пм - одной операцией на пачку
+        """
+        peaks_num = max([len(peaks_by_channel.get(channel, ())) for _, peaks_by_channel in samples
+                         for channel in self.channels] + [1])
+        peaks = np.full((len(samples), len(self.channels), peaks_num), np.nan)
+        for sample_num, (_, peaks_by_channel) in enumerate(samples):
+            for column, channel in enumerate(self.channels):
+                wls = peaks_by_channel.get(channel)
+                if wls is not None and len(wls):
+                    peaks[sample_num, column, :len(wls)] = wls
+        peaks *= 1000
+        return peaks
+
+    def match(self, peaks, t_recommended=None):
+        """ поиск пиков всех устройств во всех измерениях без удаления найденных пиков (ODTiT.find_yours_wls())
+        :param peaks: np.ndarray(), результат peaks_array()
+        :param t_recommended: float(), ориентировочная температура всех переданных измерений,
+            None - неоднозначные случаи не разрешаются (MATCH_AMBIGUOUS)
+        :return: (status, wls), status - np.ndarray(), shape (измерений, устройств), MATCH_*,
+            wls - np.ndarray(), длины волн решеток (температурная, натяжные 1 и 2), пм, shape (измерений, устройств, 3)
+        """
+        peaks = peaks[:, self.channel_column, :]  # shape (измерений, устройств, пиков)
+        peak_nums = np.arange(peaks.shape[2])
+        wls = np.full(peaks.shape[:2] + (3,), np.nan)
+        found = np.ones(peaks.shape[:2], dtype=bool)
+        ambiguous = np.zeros(peaks.shape[:2], dtype=bool)
+        excluded = np.zeros(peaks.shape, dtype=bool)  # пики, уже отнесенные к решеткам устройства
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for sensor_num in range(3):
+                if sensor_num == 0:
+                    wl_min, wl_max = self.t_wl_min, self.t_wl_max
+                    wl_recommended = self.temperature_wl(t_recommended) if t_recommended else None
+                else:
+                    cur_t = self.temperature(wls[:, :, 0])
+                    wl_min = self.strain_wl(sensor_num, cur_t, self.f_min - self.f_reserve)
+                    wl_max = self.strain_wl(sensor_num, cur_t, self.f_max + self.f_reserve)
+                    wl_recommended = self.strain_wl(sensor_num, cur_t, (self.f_min + self.f_max) / 2)
+
+                candidates = (peaks > wl_min[..., None]) & (peaks < wl_max[..., None]) & ~excluded
+                candidates_num = candidates.sum(axis=2)
+                if t_recommended:
+                    # из нескольких пиков выбирается ближайший к рекомендованной длине волны
+                    found &= candidates_num > 0
+                    distance = np.where(candidates, np.abs(peaks - wl_recommended[..., None]), np.inf)
+                    peak_num = distance.argmin(axis=2)
+                else:
+                    ambiguous |= found & (candidates_num > 1)
+                    found &= candidates_num == 1
+                    peak_num = candidates.argmax(axis=2)
+
+                wl = np.take_along_axis(peaks, peak_num[..., None], axis=2)[..., 0]
+                wls[:, :, sensor_num] = np.where(found, wl, np.nan)
+                excluded |= peak_nums == peak_num[..., None]
+
+        status = np.full(found.shape, MATCH_FAILED)
+        status[found] = MATCH_FOUND
+        status[ambiguous] = MATCH_AMBIGUOUS
+        return status, wls
+
+    def outputs(self, wls, found):
+        """ измерения устройств по длинам волн решеток (ODTiT.get_tension_fav_ex())
+        :param wls: np.ndarray(), shape (измерений, устройств, 3), пм
+        :param found: np.ndarray(bool), shape (измерений, устройств), у устройства найдены все пики
+        :return: dict(), {поле: np.ndarray(), shape (измерений, устройств)}, у ненайденных устройств - NaN
+        """
+        wl_t, wl_1, wl_2 = wls[:, :, 0], wls[:, :, 1], wls[:, :, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temperature_value = self.temperature(wl_t)
+
+            eps1 = 1E+06 * ((wl_1 - self.s1_wl0) / self.s1_wl0 - (wl_t - self.t_wl0) / self.t_wl0) / self.s1_fg + \
+                (temperature_value - self.t_t0) * (self.s1_ctet - self.ctes)
+            eps2 = 1E+06 * ((wl_2 - self.s2_wl0) / self.s2_wl0 - (wl_t - self.t_wl0) / self.t_wl0) / self.s2_fg + \
+                (temperature_value - self.t_t0) * (self.s2_ctet - self.ctes)
+
+            f1 = (eps1 * self.e * self.asize * self.bsize) / (1E+6 * 1E+6)
+            f2 = (eps2 * self.e * self.asize * self.bsize) / (1E+6 * 1E+6)
+            f_av = (f1 + f2) / 2
+
+            f_model = 10 * (self.fmodel_f0 + self.fmodel_f1 * temperature_value +
+                            self.fmodel_f2 * temperature_value ** 2)
+            f_extra = f_av - f_model
+
+            under_sqrt_seq = 4 * self.icemodel_i2 * f_extra / 10.0 + self.icemodel_i1 ** 2
+            ice_mm = np.where((self.icemodel_i2 != 0) & (under_sqrt_seq > 0),
+                              (np.sqrt(under_sqrt_seq) - self.icemodel_i1) / (2 * self.icemodel_i2), np.nan)
+            ice_mm[~((-10.0 < temperature_value) & (temperature_value < 5.0))] = 0.0
+
+            fbend = (eps1 - eps2) / (2 * self.bend_sens)
+
+        ret_value = {'T_degC': temperature_value, 'eps1_ustr': eps1, 'eps2_ustr': eps2, 'F1_N': f1, 'F2_N': f2,
+                     'Fav_N': f_av, 'Fbend_N': fbend, 'Ice_mm': ice_mm}
+        for values in ret_value.values():
+            values[~found] = np.nan
+        return ret_value
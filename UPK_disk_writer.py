@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Запись на диск в отдельном потоке
+#
+# Корутины не обращаются к диску: они готовят данные (bytes) и ставят их в ограниченную очередь (DiskWriter.write()),
+# а поток записи дописывает или заменяет файлы в порядке поступления (порядок записей в каждом файле сохраняется).
+# Медленный диск задерживает только поток записи; при заполнении очереди write() возвращает False, и корутина
+# повторяет попытку позже, не удаляя данные из своего буфера.
+#
+# Метрики (collect_metrics()): глубина очереди (текущая и наибольшая), количество записей и ошибок,
+# наибольшая длительность записи и наибольшая задержка от постановки в очередь до окончания записи.
+
+import os
+import time
+import queue
+import locale
+import logging
+import threading
+from pathlib import Path
+
+# текстовые файлы пишутся так же, как при открытии в текстовом режиме: кодировка и перевод строк системы
+text_encoding = locale.getpreferredencoding(False)
+
+MODE_APPEND = 'ab'  # дописать в конец файла
+MODE_REPLACE = 'wb'  # заменить файл целиком (через временный файл)
+
+
+def text_bytes(text):
+    """ текст для записи (как в файл, открытый в текстовом режиме) """
+    if os.linesep != '\n':
+        text = text.replace('\n', os.linesep)
+    return text.encode(text_encoding)
+
+
+class DiskWriter:
+
+    def __init__(self, capacity=1000, name='UPK_disk_writer'):
+        """
+        :param capacity: int(), максимальное количество записей в очереди
+        :param name: str(), имя потока записи
+        """
+        self.queue = queue.Queue(maxsize=capacity)
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.max_depth = 0
+        self.writes = 0
+        self.failed = 0
+        self.rejected = 0  # записи, не принятые из-за заполненной очереди
+        self.max_write_sec = 0.0
+        self.max_latency_sec = 0.0
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._thread = threading.Thread(target=self._writing_loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout_sec=None):
+        """ остановка после записи всего, что уже поставлено в очередь """
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join(timeout_sec)
+        self._thread = None
+
+    def write(self, file_name, data, mode=MODE_APPEND, header=None, timeout_sec=None, done_event=None):
+        """ постановка записи в очередь
+        :param file_name: str(), файл
+        :param data: bytes(), данные
+        :param mode: str(), MODE_APPEND или MODE_REPLACE
+        :param header: bytes(), заголовок, записываемый перед данными, если файла еще нет (MODE_APPEND)
+        :param timeout_sec: float(), ожидание места в очереди (из других потоков), None - не ждать
+        :param done_event: threading.Event(), устанавливается, когда запись выполнена (или не удалась)
+        :return: bool(), False - очередь заполнена, запись не принята
+        """
+        item = (str(file_name), data, mode, header, time.perf_counter(), done_event)
+        try:
+            if timeout_sec is None:
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=timeout_sec)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def _writing_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                file_name, data, mode, header, enqueue_time, done_event = item
+                write_start = time.perf_counter()
+                try:
+                    self._write_file(file_name, data, mode, header)
+                except OSError as e:
+                    with self._lock:
+                        self.failed += 1
+                    logging.error(f'OS error during writing {file_name} - exception: {e}')
+                    continue
+                finally:
+                    if done_event is not None:
+                        done_event.set()
+                write_end = time.perf_counter()
+                with self._lock:
+                    self.writes += 1
+                    self.max_write_sec = max(self.max_write_sec, write_end - write_start)
+                    self.max_latency_sec = max(self.max_latency_sec, write_end - enqueue_time)
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _write_file(file_name, data, mode, header):
+        if mode == MODE_REPLACE:
+            tmp_file_name = file_name + '.tmp'
+            with open(tmp_file_name, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file_name, file_name)
+            return
+
+        if header and not Path(file_name).is_file():
+            data = header + data
+        with open(file_name, 'ab') as f:
+            f.write(data)
+
+    def collect_metrics(self):
+        """ метрики с последнего опроса
+        :return: dict(), depth, max_depth, writes, failed, rejected, max_write_ms, max_latency_ms
+        """
+        with self._lock:
+            metrics = {'depth': self.queue.qsize(), 'max_depth': self.max_depth, 'writes': self.writes,
+                       'failed': self.failed, 'rejected': self.rejected,
+                       'max_write_ms': self.max_write_sec * 1000, 'max_latency_ms': self.max_latency_sec * 1000}
+            self._reset_metrics()
+        return metrics
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Форматирование записей измерений в текст с фиксированной точностью каждого поля
+#
+# Запись форматируется один раз (в строку с разделителем-табуляцией) и в таком виде хранится в буферах:
+# строка пишется в архив как есть, а для отправки на ОСМ разделитель заменяется на ', ' (osm_frame()).
+# Блок записей одинаковой длины форматируется одной операцией % над всем массивом.
+
+import re
+
+from UPK_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+delimiter = '\t'
+osm_delimiter = ', '
+
+_non_finite = re.compile(r'(?<![\w.])-?(?:nan|inf)(?![\w.])')  # NaN и бесконечность в тексте записи (формат %f)
+
+
+class RecordEncoder:
+
+    def __init__(self, formats):
+        """
+        :param formats: list(), формат printf для каждого поля записи, например ['%.3f', '%.0f']
+        """
+        self.formats = list(formats)
+        self.width = len(self.formats)
+        self.row_format = delimiter.join(self.formats)
+
+    def encode_block(self, block):
+        """ форматирование блока записей
+        :param block: np.ndarray() или list(), shape (количество записей, self.width); None - как NaN
+        :return: list(), строки записей
+        """
+        block = np.asarray(block, dtype=float)
+        if not len(block):
+            return list()
+        if block.ndim != 2 or block.shape[1] != self.width:
+            raise ValueError(f'Record width {block.shape[-1]} does not match encoder width {self.width}')
+
+        block_format = '\n'.join([self.row_format] * len(block))
+        return (block_format % tuple(block.ravel().tolist())).split('\n')
+
+    def encode(self, record):
+        return self.encode_block([record])[0]
+
+
+def averaged_record_encoder(devices_num):
+    """ усредненная запись: время блока, для каждого устройства - количество измерений, среднее и СКО
+    четырех величин, границы нормального тяжения """
+    return RecordEncoder(['%.3f'] + (['%.0f'] + ['%.3f'] * 10) * devices_num)
+
+
+def raw_record_encoder(devices_num):
+    """ сырая запись: время измерения, F1 и F2 каждого устройства """
+    return RecordEncoder(['%.3f'] + ['%.3f'] * 2 * devices_num)
+
+
+def encode_variable_record(record, value_format='%.4f'):
+    """ запись переменной длины (длины волн) - одна операция % на запись """
+    return delimiter.join([value_format] * len(record)) % tuple(record)
+
+
+def osm_frame(lines):
+    """ текстовый кадр для ОСМ из одной строки или списка строк записей """
+    if isinstance(lines, str):
+        return '[' + lines.replace(delimiter, osm_delimiter) + ']'
+    return '[' + osm_delimiter.join(['[' + line.replace(delimiter, osm_delimiter) + ']' for line in lines]) + ']'
+
+
+def json_frame(lines):
+    """ кадр osm_frame() для вставки в JSON: NaN и бесконечность (нет значения) заменены на null """
+    return _non_finite.sub('null', osm_frame(lines))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Метрики стадий обработки (корутин): количество итераций, обработанных элементов, время работы и простоя
+#
+# Стадия регистрируется один раз (register_stage() при загрузке модуля или при запуске корутины), дальше в цикле
+# используются только целочисленные счетчики и perf_counter():
+#     stage = register_stage('wls_to_measurements_coroutine')
+#     while True:
+#         await asyncio.sleep(asyncio_pause_sec)
+#         stage.iteration()
+#         ...
+#         with stage.busy():
+#             ...  # работа стадии (включая ожидание пула, выполняющего ее работу)
+#         stage.add_items(len(samples))
+# или декоратором функции (каждый вызов - итерация, время вызова - время работы): @instrumented('stage_name')
+#
+# Время простоя - время периода опроса, не занятое работой. Если стадия выполняется несколькими корутинами
+# (по корутине на прибор), время работы суммируется и загрузка может быть больше 100 %.
+#
+# С переменной окружения UPK_INSTRUMENTATION=0 учет исключается полностью: register_stage() возвращает пустую стадию,
+# а instrumented() - исходную функцию без обертки.
+
+import os
+import time
+import functools
+import asyncio
+
+enabled = os.environ.get('UPK_INSTRUMENTATION', '1') != '0'
+
+stages = dict()  # зарегистрированные стадии в порядке регистрации {имя: Stage}
+
+
+class Stage:
+    __slots__ = ('name', 'iterations', 'items', 'busy_sec', 'period_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.iterations = 0
+        self.items = 0
+        self.busy_sec = 0.0
+        self.period_start = time.perf_counter()
+
+    def iteration(self):
+        self.iterations += 1
+
+    def add_items(self, items_num):
+        self.items += items_num
+
+    def busy(self):
+        """ учет времени работы: with stage.busy(): ... """
+        return _BusyTimer(self)
+
+    def collect(self):
+        """ метрики с начала периода опроса, после чего начинается новый период
+        :return: (итераций, элементов, время работы, с, время простоя, с, длительность периода, с)
+        """
+        now = time.perf_counter()
+        period_sec = now - self.period_start
+        metrics = (self.iterations, self.items, self.busy_sec, max(0.0, period_sec - self.busy_sec), period_sec)
+        self.iterations, self.items, self.busy_sec, self.period_start = 0, 0, 0.0, now
+        return metrics
+
+
+class _BusyTimer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stage.busy_sec += time.perf_counter() - self.start
+        return False
+
+
+class _NullStage:
+    """ стадия при выключенном учете - все операции пустые """
+    __slots__ = ()
+    name = ''
+
+    def iteration(self):
+        pass
+
+    def add_items(self, items_num):
+        pass
+
+    def busy(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_stage = _NullStage()
+
+
+def register_stage(name):
+    """ стадия с именем name (повторная регистрация возвращает ту же стадию, например при перезапуске корутины) """
+    if not enabled:
+        return null_stage
+    stage = stages.get(name)
+    if stage is None:
+        stage = stages[name] = Stage(name)
+    return stage
+
+
+def instrumented(name):
+    """ декоратор функции или корутины: вызов - итерация стадии name, время вызова - время работы """
+    def decorator(function):
+        if not enabled:
+            return function
+        stage = register_stage(name)
+
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                stage.iterations += 1
+                with _BusyTimer(stage):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                stage.iterations += 1
+                with _BusyTimer(stage):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Описание приборов x55, обслуживаемых одним процессом УПК
+#
+# Задание может описывать один прибор (старый формат - IP_address и devices в корне задания)
+# или несколько приборов (список instruments, у каждого свои IP_address и devices):
+# {
+#     "SampleRate": 1,
+#     "instruments": [
+#         {"IP_address": "10.0.0.55", "devices": [...]},
+#         {"IP_address": "10.0.0.56", "devices": [...]}
+#     ]
+# }
+# Устройства всех приборов образуют один общий список (в порядке приборов), по которому формируется выдача на ОСМ.
+
+import json
+import bisect
+import itertools
+
+from UPK_buffers import make_buffer, OVERFLOW_DECIMATE
+
+# номера приборов за время работы процесса - не повторяются, даже если прибор удален из задания и добавлен новый
+# (номер входит в имена буферов и потоков прореживания прибора)
+_instrument_numbers = itertools.count()
+
+# границы интервалов гистограммы размеров пачек пакетов пиков: 1, 2-3, 4-7, ..., 64 и больше
+peak_batch_buckets = (1, 2, 4, 8, 16, 32, 64)
+
+
+def get_instruments_descriptions(instrument_description):
+    """ список описаний приборов из задания
+    :return: list(), [{'IP_address': str(), 'devices': list()}, ...]
+    """
+    if 'instruments' in instrument_description:
+        descriptions = instrument_description['instruments']
+    else:
+        descriptions = [{'IP_address': instrument_description['IP_address'],
+                         'devices': instrument_description['devices']}]
+
+    ret_value = list()
+    for description in descriptions:
+        instrument_ip = description['IP_address']
+        if not isinstance(instrument_ip, str):
+            instrument_ip = instrument_ip[0]
+        ret_value.append({'IP_address': instrument_ip, 'devices': description['devices']})
+    return ret_value
+
+
+def canonical_description(description):
+    """ каноническая запись задания или его части для сравнения (порядок ключей не важен) """
+    return json.dumps(description, sort_keys=True, ensure_ascii=False)
+
+
+class X55Instrument:
+    """ состояние одного прибора: устройства, соединение, поток пиков и стадия пересчета """
+
+    def __init__(self, ip):
+        self.num = next(_instrument_numbers)  # номер прибора, уникальный за время работы процесса
+        self.ip = ip
+        self.devices = list()  # устройства ODTiT этого прибора
+        self.device_descriptions = list()  # канонические записи описаний устройств (canonical_description)
+        self.coefficients = None  # таблица коэффициентов устройств (UPK_device_schema.CompiledDevices)
+        self.devices_digest = None  # хэш описаний устройств (UPK_device_schema.CompiledDevices.digest)
+        self.device_table = None  # UPK_device_table.DeviceTable, устройства прибора по столбцам для пересчета
+        self.partitions = list()  # UPK_conversion.ChannelPartition, разделы пересчета по каналам
+        self.device_offset = 0  # номер первого устройства прибора в общем списке устройств
+        self.h1 = None  # hyperion.AsyncHyperion, задается после подключения к прибору (None - прибор не запущен)
+        self.is_starting = False  # идет подключение к прибору (instrument_start())
+        self.peak_stream = None  # hyperion.HCommTCPPeaksStreamer
+        self.queue = None  # очередь пакетов пиков от peak_stream
+        self.tasks = list()  # корутины получения и пересчета данных прибора
+        self.spectrum_task = None  # корутина периодического получения спектра
+        self.process = None  # процесс получения и пересчета данных (режим --acquisition-process)
+        self.stop_event = None  # команда остановки процесса
+        self.ring = None  # кольцевой буфер в разделяемой памяти, через который процесс передает измерения
+        self.t_recommended = None  # ориентировочная температура устройств прибора
+
+        self.last_received_time = 0  # время (по часам прибора) последнего полученного измерения
+        self.last_measurement_time = 0  # время (по часам прибора) последнего пересчитанного измерения
+        self.last_update_time = 0  # локальное время последнего пересчета
+
+        # хранение длин волн прибора
+        self.wavelengths_buffer = make_buffer(f'wavelengths_buffer_{self.num}', 10000, OVERFLOW_DECIMATE, 1)
+
+        # размеры пачек пакетов пиков, забираемых из очереди за одно пробуждение (с момента последнего опроса метрик)
+        self.peak_batch_counts = [0] * len(peak_batch_buckets)
+        self.peak_batch_max = 0
+
+    def add_peak_batch(self, packets_num):
+        """ учет размера пачки пакетов пиков в гистограмме """
+        self.peak_batch_counts[bisect.bisect_right(peak_batch_buckets, packets_num) - 1] += 1
+        self.peak_batch_max = max(self.peak_batch_max, packets_num)
+
+    def reset_peak_batches(self):
+        self.peak_batch_counts = [0] * len(peak_batch_buckets)
+        self.peak_batch_max = 0
+
+    def __str__(self):
+        return f'x55 #{self.num} {self.ip}, {len(self.devices)} devices'
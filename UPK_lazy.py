@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Отложенная загрузка тяжелых модулей (pandas, numpy, hyperion)
+#
+# lazy_import() регистрирует модуль в sys.modules, но выполняет его только при первом обращении к атрибуту.
+# Поэтому порт websocket открывается сразу после запуска службы, а модули загружаются, когда они впервые нужны
+# (при получении задания или запуске корутин). Последующие "import numpy" в других модулях получают тот же объект.
+#
+# PyInstaller не видит модули, загружаемые по имени, - их нужно перечислить в hiddenimports (UPK_server_2019.spec).
+
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+    """ модуль, загружаемый при первом обращении к его атрибутам
+    :param name: str(), имя модуля
+    :return: модуль (уже загруженный, если он был импортирован ранее)
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
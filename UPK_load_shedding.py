@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Снижение нагрузки при отставании обработки
+#
+# Отставание - разница между временем последнего полученного от прибора измерения и последнего пересчитанного
+# (по часам прибора, наибольшая по приборам). Уровни снижения нагрузки включаются по очереди:
+#     1 - не пишется архив длин волн (wls_buffer_for_disk)
+#     2 - прореживается архив сырых измерений F1/F2 (каждая raw_decimation-я запись)
+#     3 - прореживаются измерения перед пересчетом (каждое input_decimation-е)
+# Усредненные измерения для ОСМ не затрагиваются ни на одном уровне (на уровне 3 блок усредняется по меньшему
+# количеству измерений).
+#
+# Уровень повышается на одну ступень, когда отставание больше порога следующего уровня, и понижается на одну ступень,
+# когда отставание меньше exit_ratio от порога текущего уровня дольше hold_sec (гистерезис - без переключений туда и
+# обратно на границе порога).
+
+import time
+import logging
+
+LEVEL_NORMAL = 0
+LEVEL_NO_WLS_ARCHIVE = 1
+LEVEL_RAW_DECIMATION = 2
+LEVEL_INPUT_DECIMATION = 3
+
+level_names = ('normal', 'no wls archive', 'raw archive decimated', 'input samples decimated')
+
+
+class LoadShedder:
+
+    def __init__(self, enter_lag_sec=(2, 5, 10), exit_ratio=0.5, hold_sec=10, raw_decimation=10, input_decimation=2):
+        """
+        :param enter_lag_sec: tuple(), отставание включения уровней 1, 2, 3, с (пустой - снижение нагрузки выключено)
+        :param exit_ratio: float(), доля порога уровня, ниже которой отставание должно опуститься для выхода с уровня
+        :param hold_sec: float(), время, которое отставание должно оставаться низким для понижения уровня, с
+        :param raw_decimation: int(), на уровне 2 в архив пишется каждая raw_decimation-я сырая запись
+        :param input_decimation: int(), на уровне 3 пересчитывается каждое input_decimation-е измерение
+        """
+        self.enter_lag_sec = tuple(enter_lag_sec)
+        self.exit_ratio = exit_ratio
+        self.hold_sec = hold_sec
+        self.raw_decimation = raw_decimation
+        self.input_decimation = input_decimation
+
+        self.level = LEVEL_NORMAL
+        self.lag_sec = 0.0
+        self._recovery_start = None  # начало интервала низкого отставания на текущем уровне
+        self._phases = dict()  # счет элементов прореживаемых потоков {поток: номер следующего элемента по модулю}
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.max_level = self.level
+        self.max_lag_sec = self.lag_sec
+        self.shed_counts = {'wls': 0, 'raw': 0, 'samples': 0}  # отброшенные записи и измерения
+
+    def shed_wls_archive(self, records_num):
+        """ архив длин волн не пишется на уровне 1 и выше
+        :param records_num: int(), количество записей, которые должны были попасть в архив
+        :return: bool(), True - записи отброшены
+        """
+        if self.level < LEVEL_NO_WLS_ARCHIVE:
+            return False
+        self.shed_counts['wls'] += records_num
+        return True
+
+    def update(self, lag_sec, now=None):
+        """ пересчет уровня по отставанию
+        :param lag_sec: float(), текущее отставание, с
+        :param now: float(), время, с (time.monotonic())
+        :return: bool(), уровень изменился
+        """
+        now = time.monotonic() if now is None else now
+        self.lag_sec = lag_sec
+        self.max_lag_sec = max(self.max_lag_sec, lag_sec)
+
+        new_level = self.level
+        if self.level < len(self.enter_lag_sec) and lag_sec > self.enter_lag_sec[self.level]:
+            new_level = self.level + 1
+            self._recovery_start = None
+        elif self.level > LEVEL_NORMAL and lag_sec < self.enter_lag_sec[self.level - 1] * self.exit_ratio:
+            if self._recovery_start is None:
+                self._recovery_start = now
+            if now - self._recovery_start >= self.hold_sec:
+                new_level = self.level - 1
+                self._recovery_start = now
+        else:
+            self._recovery_start = None
+
+        if new_level == self.level:
+            return False
+        logging.warning(f'Load shedding level {self.level} -> {new_level} ({level_names[new_level]}), '
+                        f'lag {lag_sec:.1f} s')
+        self.level = new_level
+        self.max_level = max(self.max_level, new_level)
+        return True
+
+    def decimate(self, stream, items, factor):
+        """ каждый factor-й элемент items, счет продолжается между вызовами для потока stream """
+        phase = self._phases.get(stream, 0)
+        self._phases[stream] = (phase + len(items)) % factor
+        return items[(-phase) % factor::factor]
+
+    def shed_raw(self, stream, raw_rows):
+        """ сырые записи для архива (на уровне 2 и выше - прореженные) """
+        if self.level < LEVEL_RAW_DECIMATION:
+            return raw_rows
+        kept = self.decimate(stream, raw_rows, self.raw_decimation)
+        self.shed_counts['raw'] += len(raw_rows) - len(kept)
+        return kept
+
+    def shed_samples(self, stream, samples):
+        """ измерения для пересчета (на уровне 3 - прореженные) """
+        if self.level < LEVEL_INPUT_DECIMATION:
+            return samples
+        kept = self.decimate(stream, samples, self.input_decimation)
+        self.shed_counts['samples'] += len(samples) - len(kept)
+        return kept
+
+    def collect_metrics(self):
+        """ метрики с последнего опроса
+        :return: dict(), level, max_level, lag_ms, max_lag_ms, shed_wls, shed_raw, shed_samples
+        """
+        metrics = {'level': self.level, 'max_level': self.max_level, 'lag_ms': self.lag_sec * 1000,
+                   'max_lag_ms': self.max_lag_sec * 1000}
+        metrics.update(('shed_' + key, count) for key, count in self.shed_counts.items())
+        self._reset_metrics()
+        return metrics
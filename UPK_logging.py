@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Журналирование без записи на диск в цикле событий
+#
+# Записи журнала ставятся в очередь (logging.handlers.QueueHandler), в файл их пишет отдельный поток
+# (QueueListener) через RotatingFileHandler - файл журнала ограничен по размеру, старые файлы хранятся с номерами
+# .1, .2, ... При заполнении очереди новые записи отбрасываются (количество - QueueDroppingHandler.dropped).
+#
+# Ошибки конвейера обработки (повторяющиеся в каждой итерации корутин) пишутся через логгер pipeline_log:
+# с одного места вызова - не чаще раза в interval_sec, количество пропущенных записей добавляется к следующей
+# записи с этого места или выводится report_suppressed().
+
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+log_format = u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s'
+
+pipeline_log = logging.getLogger('UPK.pipeline')
+
+
+class QueueDroppingHandler(logging.handlers.QueueHandler):
+    """ QueueHandler, отбрасывающий записи при заполненной очереди (вместо ошибки в потоке, который пишет в журнал) """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StoppableQueueListener(logging.handlers.QueueListener):
+    """ QueueListener, который можно останавливать повторно (явно и при выходе через atexit) """
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class RateLimitFilter(logging.Filter):
+    """ не больше одной записи за interval_sec с каждого места вызова (файл и строка) """
+
+    def __init__(self, interval_sec=10):
+        super().__init__()
+        self.interval_sec = interval_sec
+        self.sites = dict()  # (файл, строка): [время последней записи, количество пропущенных, уровень]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if getattr(record, 'suppressed_report', False):
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            state = self.sites.get(site)
+            if state is not None and now - state[0] < self.interval_sec:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state is not None else 0
+            self.sites[site] = [now, 0, record.levelno]
+
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+            record.args = None
+        return True
+
+    def report_suppressed(self, logger):
+        """ вывод количества пропущенных записей с мест вызова, с которых с тех пор ничего не записывалось """
+        now = time.monotonic()
+        with self._lock:
+            expired = [(site, state) for site, state in self.sites.items() if now - state[0] >= self.interval_sec]
+            for site, _ in expired:
+                self.sites.pop(site)
+        for (pathname, lineno), (_, suppressed, levelno) in expired:
+            if suppressed:
+                logger.log(levelno, f'{suppressed} similar messages from {pathname}:{lineno} suppressed',
+                           extra={'suppressed_report': True})
+
+
+pipeline_rate_limit = RateLimitFilter()
+pipeline_log.addFilter(pipeline_rate_limit)
+
+
+def setup_logging(file_name, level=logging.DEBUG, max_bytes=10 * 1024 * 1024, backup_count=10, queue_capacity=10000,
+                  error_interval_sec=10):
+    """ журнал в файл file_name через очередь и поток записи
+    :param max_bytes: int(), размер файла журнала, после которого начинается новый файл
+    :param backup_count: int(), количество хранимых старых файлов журнала
+    :param queue_capacity: int(), максимальное количество записей в очереди
+    :param error_interval_sec: float(), минимальный интервал между записями pipeline_log с одного места вызова
+    :return: (QueueDroppingHandler, StoppableQueueListener)
+    """
+    file_handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter(log_format))
+
+    log_queue = queue.Queue(maxsize=queue_capacity)
+    queue_handler = QueueDroppingHandler(log_queue)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = StoppableQueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    pipeline_rate_limit.interval_sec = error_interval_sec
+    return queue_handler, listener
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Семплирующий профайлер работающего процесса УПК
+#
+# Профайлер запускается по команде с websocket-соединения, в течение заданного времени снимает стеки вызовов
+# основного потока (в котором крутится цикл asyncio) и сохраняет их в файл формата collapsed stacks
+# (одна строка - один уникальный стек и количество попаданий в него, формат flamegraph.pl / speedscope).
+# Пока профайлер не запущен - поток семплирования не существует, накладные расходы нулевые.
+
+import sys
+import threading
+import datetime
+import collections
+from pathlib import Path
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+class SamplingProfiler:
+
+    def __init__(self, thread_id=None, interval_sec=0.005):
+        """
+        :param thread_id: int(), идентификатор профилируемого потока, по умолчанию - поток, создавший профайлер
+        :param interval_sec: float(), период семплирования стека, сек
+        """
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval_sec = interval_sec
+        self.stacks = collections.Counter()  # collapsed stack -> количество семплов
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            raise ProfilerBusyError('profiler is already running')
+
+        self.stacks.clear()
+        self.samples = 0
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._sampling_loop, name='UPK_profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sampling_loop(self):
+        while not self._stop_event.wait(self.interval_sec):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})')
+                frame = frame.f_back
+            del frame
+
+            # collapsed stacks записываются от корня к листу
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def save_collapsed(self, file_name):
+        with open(file_name, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def summary(self, top=20):
+        """ Сводка по самым "тяжелым" функциям
+        :param top: int(), количество функций в сводке
+        :return: list(), [[функция, доля собственного времени %, доля полного времени %], ...]
+        """
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(';')
+            self_counts[functions[-1]] += count
+            for function in set(functions):
+                total_counts[function] += count
+
+        if not self.samples:
+            return list()
+
+        ret_value = list()
+        for function, count in self_counts.most_common(top):
+            ret_value.append([function,
+                              round(100.0 * count / self.samples, 2),
+                              round(100.0 * total_counts[function] / self.samples, 2)])
+        return ret_value
+
+
+def make_profile_file_name(log_dir='.'):
+    return str(Path(log_dir) / datetime.datetime.now().strftime('UPK_profile_%Y%m%d%H%M%S.folded'))
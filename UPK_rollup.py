@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Хранилище агрегатов измерений для долгосрочных трендов (sqlite)
+#
+# Для каждого разрешения (по умолчанию 1 мин, 15 мин, сутки) хранятся накопители закрытых блоков
+# (UPK_aggregation.BlockAccumulator) - по строке на блок и устройство, по каждому полю - количество, сумма, M2,
+# минимум и максимум. Устройство определяется своим ID из задания (номер устройства меняется при смене задания).
+# Строки старше срока хранения своего разрешения удаляются.
+#
+# query() выбирает самое грубое разрешение, которое хранится за весь запрошенный интервал и дает не меньше
+# запрошенного количества точек, - месяц тяжения читается из ~3000 строк 15-минутного разрешения, а не из 720 файлов.
+
+import math
+import time
+import sqlite3
+
+from UPK_conversion import output_measurements_order2
+
+default_retention_sec = {60: 7 * 86400, 900: 180 * 86400, 86400: 3650 * 86400}
+prune_interval_sec = 3600  # период удаления устаревших строк разрешения (по времени блоков)
+accumulator_columns = ('count', 'total', 'm2', 'minimum', 'maximum')
+
+
+class RollupStore:
+
+    def __init__(self, file_name, retention_sec=None, fields=output_measurements_order2):
+        """
+        :param file_name: str(), файл базы sqlite
+        :param retention_sec: dict(), {разрешение, с: срок хранения, с}
+        :param fields: list(), поля устройства в накопителях (порядок столбцов BlockAccumulator)
+        """
+        self.retention_sec = dict(default_retention_sec if retention_sec is None else retention_sec)
+        self.fields = list(fields)
+        self.last_prune_times = dict()
+
+        # запись и чтение выполняются в отдельном потоке (ThreadPoolExecutor из одного потока)
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.columns = [f'{field}_{column}' for field in self.fields for column in accumulator_columns]
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS rollup (resolution INTEGER NOT NULL, time REAL NOT NULL, device TEXT NOT NULL, '
+            f'{", ".join(column + " REAL" for column in self.columns)}, PRIMARY KEY (resolution, device, time))')
+        self.connection.commit()
+
+    @property
+    def resolutions(self):
+        return sorted(self.retention_sec)
+
+    def add_blocks(self, blocks, device_ids):
+        """ запись закрытых блоков
+        :param blocks: list(), [(разрешение, время конца блока, BlockAccumulator), ...] (HierarchicalAggregator.add())
+        :param device_ids: list(), ID устройств (строки накопителей)
+        """
+        rows = list()
+        for resolution, block_end_time, accumulator in blocks:
+            if resolution not in self.retention_sec:
+                continue
+            stats = [getattr(accumulator, column) for column in accumulator_columns]
+            for device_num, device_id in enumerate(device_ids):
+                row = [resolution, block_end_time, str(device_id)]
+                for field_num in range(len(self.fields)):
+                    row.extend(float(values[device_num, field_num]) for values in stats)
+                rows.append(row)
+        if not rows:
+            return
+
+        self.connection.executemany(
+            f'INSERT OR REPLACE INTO rollup (resolution, time, device, {", ".join(self.columns)}) '
+            f'VALUES ({", ".join("?" * (3 + len(self.columns)))})', rows)
+        self.connection.commit()
+
+        for resolution, block_end_time, _ in blocks:
+            if block_end_time - self.last_prune_times.get(resolution, 0) >= prune_interval_sec:
+                self.prune(resolution, block_end_time)
+
+    def prune(self, resolution, now):
+        """ удаление строк разрешения старше срока хранения """
+        self.connection.execute('DELETE FROM rollup WHERE resolution = ? AND time < ?',
+                                (resolution, now - self.retention_sec[resolution]))
+        self.connection.commit()
+        self.last_prune_times[resolution] = now
+
+    def choose_resolution(self, start_time, end_time, points, now=None):
+        """ самое грубое разрешение, хранящееся с start_time и дающее не меньше points точек за интервал;
+        если точек не хватает ни в одном - самое подробное из хранящихся с start_time,
+        если интервал не хранится целиком ни в одном - разрешение с самым долгим сроком хранения """
+        now = time.time() if now is None else now
+        covering = [resolution for resolution in self.resolutions
+                    if now - self.retention_sec[resolution] <= start_time]
+        if not covering:
+            return max(self.resolutions, key=lambda resolution: self.retention_sec[resolution])
+
+        detailed_enough = [resolution for resolution in covering if (end_time - start_time) / resolution >= points]
+        return max(detailed_enough) if detailed_enough else min(covering)
+
+    def query(self, device_id, field, start_time, end_time, points=500, resolution=None):
+        """ тренд поля устройства
+        :param device_id: ID устройства из задания
+        :param field: str(), поле (output_measurements_order2)
+        :param start_time, end_time: float(), интервал по времени концов блоков, с (UTC)
+        :param points: int(), желаемое количество точек
+        :param resolution: int(), разрешение, None - выбирается choose_resolution()
+        :return: dict(), {'resolution_sec': int(), 'points': [[время, количество, среднее, СКО, минимум, максимум], ...]}
+        """
+        if field not in self.fields:
+            raise ValueError(f'Unknown field {field}, expected one of {self.fields}')
+        if resolution is None:
+            resolution = self.choose_resolution(start_time, end_time, points)
+
+        columns = ', '.join(f'{field}_{column}' for column in accumulator_columns)
+        cursor = self.connection.execute(
+            f'SELECT time, {columns} FROM rollup WHERE resolution = ? AND device = ? AND time >= ? AND time <= ? '
+            f'ORDER BY time', (resolution, str(device_id), start_time, end_time))
+
+        trend = list()
+        for block_end_time, count, total, m2, minimum, maximum in cursor:
+            count = count or 0
+            mean = total / count if count else math.nan
+            std = math.sqrt(m2 / (count - 1)) if count > 1 and m2 is not None else math.nan
+            trend.append([block_end_time, count, mean, std,
+                          math.nan if minimum is None else minimum, math.nan if maximum is None else maximum])
+        return {'resolution_sec': resolution, 'points': trend}
+
+    def close(self):
+        self.connection.close()
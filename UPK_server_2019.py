@@ -1,24 +1,53 @@
-from OptenFiberOpticDevices import ODTiT
 import logging
 import websockets
 import asyncio
 import json
-import hyperion
+import math
+import bisect
+import threading
 import datetime
-from scipy.signal import find_peaks
-import numpy as np
-import pandas as pd
 import sys
 import socket
 from pathlib import Path
-import statistics
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import sqlite3
+from UPK_lazy import lazy_import
+from UPK_profiling import SamplingProfiler, ProfilerBusyError, make_profile_file_name
+from UPK_buffers import make_buffer, buffer_put, load_spilled, insert_spilled, buffer_clear, spill_files, \
+    MemoryBudget, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL_TO_DISK, OVERFLOW_DECIMATE
+from UPK_instruments import X55Instrument, get_instruments_descriptions, canonical_description, peak_batch_buckets
+from UPK_device_schema import compile_devices, DeviceDescriptionError, CompiledDevices, cached_compiled, preload_compiled
+from UPK_device_table import DeviceTable
+from UPK_aggregation import BlockAccumulator, HierarchicalAggregator, averaged_record
+from UPK_rollup import RollupStore
+from UPK_columnar_archive import pending_hour_files, convert_hour_file, DeviceLayouts, encode_layouts, \
+    layout_file_name
+from UPK_instrumentation import register_stage, instrumented, stages
+from UPK_disk_writer import DiskWriter, text_bytes, MODE_REPLACE, MODE_APPEND
+from UPK_logging import setup_logging, pipeline_log, pipeline_rate_limit
+from UPK_load_shedding import LoadShedder
+from UPK_checkpoint import checkpoint_bytes, load_checkpoint, checkpoint_age_sec, checkpoint_file_name, unsent_bytes, \
+    unsent_file_name
+from UPK_conversion import convert_samples, peaks_by_channel_from_packet, packet_peaks, channel_peaks, \
+    channel_partitions, channel_samples, merge_partition_rows, \
+    output_measurements_order2  # последовательность выдачи данных
+from UPK_shm_ring import ShmRingBuffer, shared_memory
+from UPK_acquisition import acquisition_process_main, record_width, split_records
+from UPK_codec import get_codec, install_uvloop
+from UPK_encoder import averaged_record_encoder, raw_record_encoder, encode_variable_record, osm_frame, \
+    json_frame
+from UPK_spectrum import find_spectrum_peaks, peaks_by_channel, match_peaks, REFINE_GAUSS
+from UPK_spectrum_archive import encode_spectrum, spectrum_archive_file_name
+
+# тяжелые модули загружаются при первом обращении, чтобы порт websocket открывался сразу после запуска службы
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+hyperion = lazy_import('hyperion')
 
 # Настроечные переменные
 hostname = socket.gethostname()
 # address, port = socket.gethostbyname(hostname), 7681  # адрес websocket-сервера
-index_of_reflection = 1.4682
-speed_of_light = 299792458.0
-output_measurements_order2 = ['T_degC', 'Fav_N', 'Fbend_N', 'Ice_mm']  # последовательность выдачи данных
 DEFAULT_TIMEOUT = 10000
 instrument_description_filename = 'instrument_description.json'
 
@@ -26,25 +55,108 @@ instrument_description_filename = 'instrument_description.json'
 peak_distance_pm = 1000  # минимальное горизонтальное расстояние между соседними пиками, пм
 peak_height_dbm = 3  # минимальная высота пика, dBm
 peak_width_pm = [100, 600]  # ширина пика, пм
+peak_refine = REFINE_GAUSS  # уточнение положения пика внутри шага спектра (UPK_spectrum.refine_methods)
+peak_match_tolerance_pm = 100  # максимальное отклонение пика по спектру от пика прибора
+spectrum_archive_compression = 'zlib'  # сжатие архива спектров (zlib или lzma)
 
 # тайминги
 asyncio_pause_sec = 0.02  # длительность паузы в корутинах, чтобы другие могли работать
 x55_measurement_interval_sec = 0.1  # интервал выдачи измерений x55
 data_averaging_interval_sec = 1  # интервал усреднения данных
-one_spectrum_interval_sec = 60  # интервал получения единичного спектра
+# старшие уровни усреднения (каждый объединяет блоки предыдущего): интервал, с - вести ли архив уровня
+aggregation_levels = {60: True, 600: True, 3600: True}
+rollup_file_name = 'UPK_rollup.sqlite'  # агрегаты для долгосрочных трендов
+rollup_retention_days = {60: 7, 900: 180, 86400: 3650}  # разрешения агрегатов, с: срок хранения, сутки
+# перевод закрытых часовых файлов в суточный столбцовый архив (UPK_columnar_archive.py): период проверки, с
+# (0 - не переводить) и задержка после окончания часа для запоздавших записей, с
+columnar_archive_check_sec = 60
+columnar_archive_grace_sec = 300
+instrument_retry_sec = 10  # период повторного подключения к приборам задания, которые не удалось запустить
+spectrum_interval_sec = 0  # интервал получения спектра (архив и поиск пиков), 0 - не получать (--spectrum-interval=)
 send_pause_sec = 0.2  # пауза между отправками пакетов
+save_max_records = 3600  # максимальное количество записей, сохраняемых на диск за один проход
+profile_default_duration_sec = 10  # длительность профилирования по команде, если не указана
+profile_max_duration_sec = 600  # максимальная длительность профилирования по команде
+memory_check_interval_sec = 1  # интервал проверки общего бюджета памяти буферов
+instruments_merge_timeout_sec = 5  # прибор, не присылавший данных дольше этого времени, не задерживает усреднение
+conversion_workers = None  # количество процессов пересчета длин волн; None - по числу разделов пересчета (приборов
+# или каналов всех приборов), если их больше одного, но не больше числа ядер
+# пересчет прибора независимыми разделами по каналам (параллельно в процессах пересчета); разделов у прибора - не больше
+# числа ядер на прибор, на одном ядре прибор пересчитывается целиком
+conversion_by_channel = True
+
+# получение и пересчет данных каждого прибора в отдельном процессе с передачей измерений через разделяемую память
+# (ключ запуска --acquisition-process, требуется python 3.8+)
+acquisition_in_separate_process = False
+acquisition_ring_slots = 36000  # емкость кольцевого буфера измерений прибора, записей
+
+# ограничения буферов
+peak_queue_capacity = 1000  # максимальное количество пакетов пиков в очереди от x55
+peak_batch_max_packets = 100  # пакетов пиков, забираемых из очереди за одно пробуждение (1 - по одному пакету)
+memory_budget_mb = 512  # общий бюджет памяти на буферы измерений, МБ
+disk_writer_capacity = 1000  # максимальное количество записей в очереди потока записи на диск
+disk_writer_thread_timeout_sec = 10  # ожидание места в очереди записи из других потоков (спектры)
+
+# журнал (UPK_logging.py): размер файла, МБ, и количество хранимых старых файлов; ошибки конвейера обработки
+# с одного места - не чаще раза в log_error_interval_sec
+log_max_mb = 10
+log_backup_count = 10
+log_error_interval_sec = 10
+
+# снижение нагрузки при отставании пересчета от получения измерений (UPK_load_shedding.py): отставание включения
+# уровней (1 - без архива длин волн, 2 - прореживание сырого архива, 3 - прореживание измерений перед пересчетом), с
+# (пустой - не снижать), выход с уровня - при отставании меньше половины порога в течение load_shedding_hold_sec
+load_shedding_lag_sec = (2, 5, 10)
+load_shedding_hold_sec = 10
+load_shedding_raw_decimation = 10  # на уровне 2 в архив пишется каждая 10-я сырая запись
+load_shedding_input_decimation = 2  # на уровне 3 пересчитывается каждое 2-е измерение
+load_shedding_check_sec = 1  # период проверки отставания
+
+# контрольные точки состояния конвейера (UPK_checkpoint.py): период сохранения, с (0 - не сохранять и не
+# восстанавливать); открытый блок усреднения и рекомендованные температуры из контрольной точки старше
+# checkpoint_max_age_sec не восстанавливаются (не отправленные на ОСМ записи восстанавливаются всегда)
+checkpoint_interval_sec = 5
+checkpoint_max_age_sec = 3600
+checkpoint_journal_min_sent = 1000  # журнал не отправленных записей переписывается, если в нем больше отправленных
 
 # Глобальные переменные
+log_dir = '.'  # папка для лог-файлов и файлов профилирования
+log_queue_handler = None  # обработчик журнала с очередью (количество отброшенных записей)
+pending_checkpoint = None  # контрольная точка, загруженная при запуске и еще не восстановленная (UPK_checkpoint.py)
 master_connection = None
 instrument_description = dict()
 h1 = None
 active_channels = set()
-devices = list()
-
-# хранение длин волн
-wavelengths_buffer = dict()
-wavelengths_buffer['is_ready'] = True
-wavelengths_buffer['data'] = dict()
+devices = list()  # устройства всех приборов
+instruments = list()  # приборы x55, X55Instrument
+conversion_executor = None  # пул процессов для пересчета длин волн
+conversion_executor_workers = 0  # количество процессов в conversion_executor
+spectrum_executor = ThreadPoolExecutor(max_workers=1)  # поток разбора, поиска пиков и записи спектров
+spectrum_metrics = {'captured': 0, 'skipped': 0, 'failed': 0, 'capture_sec': 0, 'processing_sec': 0}
+codec = get_codec('json')  # сериализация сообщений websocket-соединения (ключ запуска --json=orjson)
+
+# форматирование усредненных и сырых записей (зависит от количества устройств, задается в instrument_init)
+avg_encoder = averaged_record_encoder(0)
+aggregator = None  # старшие уровни усреднения, HierarchicalAggregator
+level_subscribers = dict()  # подписки на уровни усреднения: {интервал, с: set(соединения)}
+rollup_store = None  # RollupStore, открывается при первом задании
+rollup_aggregator = None  # блоки разрешений rollup_store, HierarchicalAggregator
+rollup_executor = ThreadPoolExecutor(max_workers=1)  # поток записи и чтения rollup_store
+columnar_executor = ThreadPoolExecutor(max_workers=1)  # поток перевода часовых файлов в столбцовый архив
+columnar_failed_files = set()  # часовые файлы, которые не удалось перевести (повторно не переводятся)
+disk_writer = DiskWriter(disk_writer_capacity)  # поток записи на диск (задание, архивы измерений и спектров)
+# поток чтения и удаления файлов по запросу корутин (подгрузка выгруженного буфера ОСМ, сохранение профиля)
+file_executor = ThreadPoolExecutor(max_workers=1)
+raw_encoder = raw_record_encoder(0)
+# ID устройств в записях усредненного и сырого архивов и их изменения по времени записей (для столбцового архива)
+archive_device_ids = tuple()
+archive_layouts = {'avg': DeviceLayouts(), 'raw': DeviceLayouts()}
+
+# Буферы ограничены по количеству записей, у каждого своя политика переполнения и приоритет (0 - самый важный).
+# При нехватке общего бюджета памяти место освобождается начиная с наименее важного буфера - живые данные для ОСМ
+# вытесняются на диск последними, а архив длин волн жертвуется первым.
+
+# хранение длин волн - у каждого прибора свой буфер X55Instrument.wavelengths_buffer
 '''
 wavelengths_buffer
 <class 'dict'>: 
@@ -68,9 +180,8 @@ wavelengths_buffer
 '''
 
 # хранение пересчитанных измерений (из длин волн)
-measurements_buffer = dict()
-measurements_buffer['is_ready'] = True
-measurements_buffer['data'] = pd.DataFrame()
+measurements_buffer = make_buffer('measurements_buffer', 36000, OVERFLOW_DROP_OLDEST, 1)
+measurements_buffer['data'] = list()  # pd.DataFrame() создается в instrument_init() - до задания pandas не загружается
 '''
 measurements_buffer2
 <class 'dict'>: 
@@ -84,35 +195,48 @@ measurements_buffer2
 '''
 
 # хранение усредненных измерений
-averaged_measurements_buffer_for_OSM = dict()
-averaged_measurements_buffer_for_OSM['is_ready'] = True
-averaged_measurements_buffer_for_OSM['data'] = dict()
+averaged_measurements_buffer_for_OSM = make_buffer('averaged_measurements_buffer_for_OSM', 86400,
+                                                   OVERFLOW_SPILL_TO_DISK, 0, disk_writer)
 
 what_to_send = dict()
 
-averaged_measurements_buffer_for_disk = dict()
-averaged_measurements_buffer_for_disk['is_ready'] = True
-averaged_measurements_buffer_for_disk['data'] = dict()
+averaged_measurements_buffer_for_disk = make_buffer('averaged_measurements_buffer_for_disk', 3600,
+                                                    OVERFLOW_DROP_OLDEST, 2)
+
+# записи старших уровней усреднения для архива (у каждого уровня свой суточный файл)
+level_buffers_for_disk = dict((interval_sec, make_buffer(f'averaged_{interval_sec}s_buffer_for_disk', 1440,
+                                                         OVERFLOW_DROP_OLDEST, 2))
+                              for interval_sec, archive in aggregation_levels.items() if archive)
+
+raw_measurements_buffer_for_disk = make_buffer('raw_measurements_buffer_for_disk', 36000, OVERFLOW_DECIMATE, 3)
+
+wls_buffer_for_saving = make_buffer('wls_buffer_for_saving', 36000, OVERFLOW_DROP_OLDEST, 4)
+
+wls_buffer_for_disk = make_buffer('wls_buffer_for_disk', 36000, OVERFLOW_DROP_OLDEST, 4)
 
-raw_measurements_buffer_for_disk = dict()
-raw_measurements_buffer_for_disk['is_ready'] = True
-raw_measurements_buffer_for_disk['data'] = dict()
+# буферы, участвующие в общем бюджете памяти (measurements_buffer ограничен только количеством строк)
+bounded_buffers = [measurements_buffer, averaged_measurements_buffer_for_OSM,
+                   averaged_measurements_buffer_for_disk, raw_measurements_buffer_for_disk, wls_buffer_for_disk] + \
+                  list(level_buffers_for_disk.values())
 
-wls_buffer_for_saving = dict()
-wls_buffer_for_saving['is_ready'] = True
-wls_buffer_for_saving['data'] = dict()
+memory_budget = MemoryBudget(memory_budget_mb * 1024 * 1024,
+                             [averaged_measurements_buffer_for_OSM,
+                              averaged_measurements_buffer_for_disk, raw_measurements_buffer_for_disk,
+                              wls_buffer_for_saving, wls_buffer_for_disk] + list(level_buffers_for_disk.values()))
 
-wls_buffer_for_disk = dict()
-wls_buffer_for_disk['is_ready'] = True
-wls_buffer_for_disk['data'] = dict()
+load_shedder = LoadShedder(load_shedding_lag_sec, hold_sec=load_shedding_hold_sec,
+                           raw_decimation=load_shedding_raw_decimation,
+                           input_decimation=load_shedding_input_decimation)
 
-# сердечный ритм основных корутин - количество выполненных циклов за период опроса
-coroutine_heart_rate = dict()
+# сердечный ритм основных корутин - итерации, обработанные элементы и загрузка стадий за период опроса
+# (UPK_instrumentation.py, стадии регистрируются корутинами при запуске)
 
 loop = asyncio.get_event_loop()
 loop.set_debug(False)
-queue = asyncio.Queue(maxsize=0, loop=loop)
-peak_stream = None
+
+# профайлер основного потока, включается командой по websocket-соединению
+profiler = SamplingProfiler()
+
 
 async def connection_handler(connection, path):
     global master_connection, instrument_description, averaged_measurements_buffer_for_OSM
@@ -153,6 +277,7 @@ async def connection_handler(connection, path):
             # очищаем список соединений
             logging.info('Zeroing master connection...')
             master_connection = None
+            unsubscribe(connection)
 
             # have no instrument from now
             # instrument_description.clear()
@@ -163,20 +288,43 @@ async def connection_handler(connection, path):
 
         json_msg = dict()
         try:
-            json_msg = json.loads(msg.replace("\'", "\""))
+            json_msg = codec.loads(msg.replace("\'", "\""))
         except json.JSONDecodeError:
             logging.info('wrong JSON message has been refused')
             json_msg.clear()
             return
 
-        # сохраненеи задания на диск для последующей работы без соединения
+        # служебные команды не являются заданием - выполняем их в отдельной задаче и ждем следующего сообщения
+        if isinstance(json_msg, dict) and 'command' in json_msg:
+            loop.create_task(command_handler(connection, json_msg))
+            continue
+
+        # то же самое задание (например, ОСМ переподключился) - продолжаем работу без перезапуска и очистки буферов
+        if canonical_description(json_msg) == canonical_description(instrument_description):
+            logging.info('Received the same instrument description - keep working')
+            master_connection = tmp_master_connection
+            # приборы, к которым не удалось подключиться, пробуем запустить сразу, не дожидаясь повтора
+            if any(not instrument.h1 for instrument in instruments):
+                loop.create_task(start_instruments())
+            continue
+
+        # проверка задания до сохранения на диск, очистки буфера и применения - задание с ошибками ничего не меняет
+        checked_description = check_description(json_msg)
+        if checked_description is None:
+            master_connection = tmp_master_connection
+            continue
+
+        # сохраненеи задания на диск для последующей работы без соединения (в потоке записи)
         if 1:
-            with open(instrument_description_filename, 'w+') as f:
-                json.dump(json_msg, f, ensure_ascii=False, indent=4)
+            if not disk_writer.write(instrument_description_filename,
+                                     text_bytes(json.dumps(json_msg, ensure_ascii=False, indent=4)), MODE_REPLACE):
+                logging.error('Disk writer queue is full - instrument description is not saved')
 
         # если поступившее задание отличается от имеющегося ранее, то нужно очистить накопленный буфер
         # if json.dumps(instrument_description) != json.dumps(json_msg) and len(averaged_measurements_buffer_for_OSM['data']) > 0:
-        if len(averaged_measurements_buffer_for_OSM['data']) > 0:
+        if len(averaged_measurements_buffer_for_OSM['data']) > 0 or \
+                averaged_measurements_buffer_for_OSM['spill_pending'] or \
+                await loop.run_in_executor(file_executor, spill_files, averaged_measurements_buffer_for_OSM):
             while not averaged_measurements_buffer_for_OSM['is_ready']:
                 await asyncio.sleep(asyncio_pause_sec)
             averaged_measurements_buffer_for_OSM['is_ready'] = False
@@ -186,97 +334,231 @@ async def connection_handler(connection, path):
                     'Received another instrument decsripton - saving averaged_measurements_buffer to ' + averaged_measurements_buffer_file_name)
                 # сначала идет старое задание
                 if 0:
-                    with open(averaged_measurements_buffer_file_name, 'w+') as file:
-                        json.dump(instrument_description, file, ensure_ascii=False, indent=4)
-                        file.write('\n')
-                        for _, measurements in averaged_measurements_buffer_for_OSM['data'].items():
-                            file.write("\t".join([str(x) for x in measurements]) + '\n')
+                    dump = json.dumps(instrument_description, ensure_ascii=False, indent=4) + '\n'
+                    for _, measurements in averaged_measurements_buffer_for_OSM['data'].items():
+                        dump += measurements + '\n'
+                    disk_writer.write(averaged_measurements_buffer_file_name, text_bytes(dump), MODE_REPLACE)
 
-                averaged_measurements_buffer_for_OSM['data'].clear()
+                await loop.run_in_executor(file_executor, buffer_clear, averaged_measurements_buffer_for_OSM)
             finally:
                 averaged_measurements_buffer_for_OSM['is_ready'] = True
 
         # актуализируем задание
         instrument_description = json_msg
 
-        await instrument_init()
+        await instrument_init(checked_description)
 
         master_connection = tmp_master_connection
 
 
-async def instrument_init():
-    global instrument_description, devices, active_channels, x55_measurement_interval_sec, h1, data_averaging_interval_sec, measurements_buffer, peak_stream
+async def command_handler(connection, command_msg):
+    """ выполнение служебной команды, ответ отправляется в то же соединение """
+    command = command_msg['command']
+    answer = {'command': command}
 
-    data_averaging_interval_sec = 1.0 / instrument_description['SampleRate']
+    if command == 'profile':
+        answer.update(await profile_command(command_msg))
+    elif command in ('subscribe', 'unsubscribe'):
+        answer.update(subscribe_command(connection, command_msg))
+    elif command == 'trend':
+        answer.update(await trend_command(command_msg))
+    else:
+        answer['error'] = f'unknown command {command}'
 
-    # вытаскиваем информацию об устройствах
-    devices = list()
-    for device_description in instrument_description['devices']:
+    try:
+        await connection.send(codec.dumps(answer))
+    except websockets.exceptions.ConnectionClosed:
+        logging.info(f'No connection while sending answer for command {command}')
+
+
+def subscribe_command(connection, command_msg):
+    """ подписка соединения на записи уровня усреднения (или отказ от нее)
+    {"command": "subscribe", "interval_sec": 600} - записи уровня приходят в виде {"interval_sec": 600, "data": [...]}
+    """
+    levels = [data_averaging_interval_sec] + sorted(aggregation_levels)
+    interval_sec = command_msg.get('interval_sec')
+    # интервал базового уровня - 1 / SampleRate, у клиента он может отличаться в последних знаках
+    matched = [level for level in levels if isinstance(interval_sec, (int, float)) and
+               math.isclose(interval_sec, level, rel_tol=1e-6)]
+    if not matched:
+        return {'error': f'unknown averaging interval {interval_sec}', 'levels': levels}
+    interval_sec = matched[0]
+
+    if command_msg['command'] == 'subscribe':
+        level_subscribers.setdefault(interval_sec, set()).add(connection)
+    else:
+        level_subscribers.get(interval_sec, set()).discard(connection)
+    logging.info(f'{command_msg["command"]} {connection.remote_address[:2]} on {interval_sec} s averaging')
+    return {'interval_sec': interval_sec, 'levels': levels}
+
+
+async def trend_command(command_msg):
+    """ тренд поля устройства из агрегатов
+    {"command": "trend", "device": ID устройства, "field": "Fav_N", "start": время UTC, с, "end": время UTC, с,
+    "points": желаемое количество точек}
+    """
+    if rollup_store is None:
+        return {'error': 'rollup store is not opened'}
+    try:
+        return await loop.run_in_executor(
+            rollup_executor, rollup_store.query, command_msg['device'], command_msg['field'],
+            float(command_msg['start']), float(command_msg['end']), int(command_msg.get('points', 500)))
+    except KeyError as e:
+        return {'error': f'key {e} did not find'}
+    except (ValueError, TypeError, sqlite3.Error) as e:
+        return {'error': str(e)}
+
+
+def unsubscribe(connection):
+    """ отказ соединения от всех подписок (соединение закрыто) """
+    for subscribers in level_subscribers.values():
+        subscribers.discard(connection)
+
+
+def publish_level_record(interval_sec, line):
+    """ отправка записи уровня усреднения подписчикам """
+    subscribers = level_subscribers.get(interval_sec)
+    if not subscribers:
+        return
+    message = f'{{"interval_sec": {interval_sec:g}, "data": {json_frame(line)}}}'
+    for connection in list(subscribers):
+        loop.create_task(send_to_subscriber(connection, message))
+
+
+async def send_to_subscriber(connection, message):
+    try:
+        await connection.send(message)
+    except websockets.exceptions.ConnectionClosed:
+        logging.info(f'Subscriber {connection.remote_address[:2]} is disconnected')
+        unsubscribe(connection)
+
+
+async def profile_command(command_msg):
+    """ профилирование работающего процесса в течение duration_sec секунд
+    :param command_msg: dict(), {'command': 'profile', 'duration_sec': 30, 'top': 20}
+    :return: dict(), имя файла со стеками и сводка по самым нагруженным функциям
+    """
+    try:
+        duration_sec = min(float(command_msg.get('duration_sec', profile_default_duration_sec)), profile_max_duration_sec)
+        top = int(command_msg.get('top', 20))
+    except (TypeError, ValueError) as e:
+        return {'error': f'wrong command parameters - {e}'}
+
+    try:
+        profiler.start()
+    except ProfilerBusyError as e:
+        return {'error': str(e)}
+
+    logging.info(f'Profiling started for {duration_sec} sec')
+    try:
+        await asyncio.sleep(duration_sec)
+    finally:
+        profiler.stop()
 
-        # ToDo перенести это в класс ODTiT
-        device = None
+    profile_file_name = make_profile_file_name(log_dir)
+    try:
+        await loop.run_in_executor(file_executor, profiler.save_collapsed, profile_file_name)
+    except OSError as e:
+        logging.error(f'OS error during profile saving - exception: {e.__doc__}')
+        profile_file_name = None
+    logging.info(f'Profiling finished, {profiler.samples} samples saved to {profile_file_name}')
+
+    return {'file': profile_file_name, 'duration_sec': duration_sec, 'samples': profiler.samples,
+            'top': profiler.summary(top)}
+
+
+def check_description(description):
+    """ проверка задания и сборка устройств всех приборов до применения задания - ошибки выдаются все сразу
+    :param description: dict(), задание
+    :return: (list(), list()) - описания приборов (get_instruments_descriptions()) и их собранные устройства
+        (UPK_device_schema.CompiledDevices) или None - задание с ошибками, не применяется
+    """
+    try:
+        sample_rate = description['SampleRate']
+        instruments_descriptions = get_instruments_descriptions(description)
+    except (KeyError, IndexError, TypeError) as e:
+        return_error(f'JSON error - key {str(e)} did not find')
+        return None
+    if isinstance(sample_rate, bool) or not isinstance(sample_rate, (int, float)) or sample_rate <= 0:
+        return_error(f'JSON error - SampleRate {sample_rate!r} is not a positive number, description is not applied')
+        return None
+
+    compiled_devices = list()
+    errors = list()
+    for instrument_num, instrument in enumerate(instruments_descriptions):
         try:
-            if device_description['version'] == '0.1' or device_description['version'] == '0.2':
-                device = ODTiT(device_description['x55_channel'])
-                device.id = device_description['ID']
-                device.name = device_description['Name']
-                device.channel = device_description['x55_channel']
-                device.ctes = device_description['CTES']
-                device.e = device_description['E']
-                device.size = (device_description['Asize'], device_description['Bsize'])
-                device.t_min = device_description['Tmin']
-                device.t_max = device_description['Tmax']
-                device.f_min = device_description['Fmin']
-                device.f_max = device_description['Fmax']
-                device.f_reserve = device_description['Freserve']
-                device.span_rope_diameter = device_description['SpanRopeDiametr']
-                device.span_len = device_description['SpanRopeLen']
-                device.span_rope_density = device_description['SpanRopeDensity']
-                device.span_rope_EJ = device_description['SpanRopeEJ']
-                device.bend_sens = device_description['Bending_sensivity']
-                device.time_of_flight = int(
-                    -2E9 * device_description['Distance'] * index_of_reflection / speed_of_light)
-
-                device.sensors[0].id = device_description['Sensor4100']['ID']
-                device.sensors[0].type = device_description['Sensor4100']['type']
-                device.sensors[0].name = device_description['Sensor4100']['name']
-                device.sensors[0].wl0 = device_description['Sensor4100']['WL0']
-                device.sensors[0].t0 = device_description['Sensor4100']['T0']
-                device.sensors[0].p_max = device_description['Sensor4100']['Pmax']
-                device.sensors[0].p_min = device_description['Sensor4100']['Pmin']
-                device.sensors[0].st = device_description['Sensor4100']['ST']
-
-                device.sensors[1].id = device_description['Sensor3110_1']['ID']
-                device.sensors[1].type = device_description['Sensor3110_1']['type']
-                device.sensors[1].name = device_description['Sensor3110_1']['name']
-                device.sensors[1].wl0 = device_description['Sensor3110_1']['WL0']
-                device.sensors[1].t0 = device_description['Sensor3110_1']['T0']
-                device.sensors[1].p_max = device_description['Sensor3110_1']['Pmax']
-                device.sensors[1].p_min = device_description['Sensor3110_1']['Pmin']
-                device.sensors[1].fg = device_description['Sensor3110_1']['FG']
-                device.sensors[1].ctet = device_description['Sensor3110_1']['CTET']
-
-                device.sensors[2].id = device_description['Sensor3110_2']['ID']
-                device.sensors[2].type = device_description['Sensor3110_2']['type']
-                device.sensors[2].name = device_description['Sensor3110_2']['name']
-                device.sensors[2].wl0 = device_description['Sensor3110_2']['WL0']
-                device.sensors[2].t0 = device_description['Sensor3110_2']['T0']
-                device.sensors[2].p_max = device_description['Sensor3110_2']['Pmax']
-                device.sensors[2].p_min = device_description['Sensor3110_2']['Pmin']
-                device.sensors[2].fg = device_description['Sensor3110_2']['FG']
-                device.sensors[2].ctet = device_description['Sensor3110_2']['CTET']
-
-            if device_description['version'] == '0.2':
-                device.fmodel_f0 = device_description['Fmodel_F0']
-                device.fmodel_f1 = device_description['Fmodel_F1']
-                device.fmodel_f2 = device_description['Fmodel_F2']
-                device.icemodel_i1 = device_description['ICEmodel_I1']
-                device.icemodel_i2 = device_description['ICEmodel_I2']
-
-        except KeyError as e:
-            return_error(f'JSON error - key {str(e)} did not find')
-
-        devices.append(device)
+            compiled_devices.append(compile_devices(instrument['devices'], f'instrument {instrument_num} '))
+        except DeviceDescriptionError as e:
+            errors.extend(e.errors)
+    if errors:
+        return_error(f'JSON error - {len(errors)} errors in devices description, description is not applied:\n' +
+                     '\n'.join(errors))
+        return None
+    return instruments_descriptions, compiled_devices
+
+
+async def instrument_init(checked_description=None):
+    """ применение задания instrument_description
+    :param checked_description: результат check_description() для задания; None - задание проверяется здесь
+    """
+    global instrument_description, devices, active_channels, h1, data_averaging_interval_sec, measurements_buffer, instruments, conversion_executor, conversion_executor_workers, avg_encoder, raw_encoder, archive_device_ids, aggregator, rollup_store, rollup_aggregator, pending_checkpoint
+
+    if checked_description is None:
+        checked_description = check_description(instrument_description)
+        if checked_description is None:
+            return
+    instruments_descriptions, compiled_devices = checked_description
+
+    data_averaging_interval_sec = 1.0 / instrument_description['SampleRate']
+
+    # приборы, которых нет в новом задании, отключаем
+    instruments_ips = [description['IP_address'] for description in instruments_descriptions]
+    for instrument in instruments:
+        if instrument.ip not in instruments_ips:
+            instrument_stop(instrument)
+
+    # вытаскиваем информацию о приборах и их устройствах, уже работающие приборы сохраняют поток пиков
+    old_instruments = dict((instrument.ip, instrument) for instrument in instruments)
+    old_devices = devices
+    new_instruments = list()
+    changed_instruments = list()  # работающие приборы, у которых изменился список устройств
+    devices = list()
+    kept_devices_num = 0
+    for instrument_num, description in enumerate(instruments_descriptions):
+        instrument = old_instruments.get(description['IP_address'])
+        if instrument is None:
+            instrument = X55Instrument(description['IP_address'])
+            memory_budget.add_buffer(instrument.wavelengths_buffer)
+
+        # неизмененные устройства сохраняются (вместе с их столбцами измерений), остальные создаются заново
+        instrument_devices, device_descriptions = reuse_devices(instrument, description['devices'],
+                                                                compiled_devices[instrument_num])
+        # сохраненным считается каждое устройство, взятое из работающих, а не собранное заново
+        kept_devices_num += sum(device is not compiled_device for device, compiled_device
+                                in zip(instrument_devices, compiled_devices[instrument_num].devices))
+        if len(instrument_devices) != len(instrument.devices) or \
+                any(device is not old_device for device, old_device in zip(instrument_devices, instrument.devices)):
+            # новый объект списка - пересчет, начатый со старым списком, будет отброшен
+            instrument.devices = instrument_devices
+            if instrument.h1:
+                changed_instruments.append(instrument)
+        instrument.device_descriptions = device_descriptions
+        instrument.coefficients = compiled_devices[instrument_num].coefficients
+        instrument.devices_digest = compiled_devices[instrument_num].digest
+        instrument.device_table = DeviceTable(instrument.devices, instrument.coefficients)
+        if conversion_by_channel:
+            # рекомендованная температура раздела сохраняется при новом задании с теми же каналами раздела
+            t_by_channels = dict((partition.channels, partition.t_recommended) for partition in instrument.partitions)
+            instrument.partitions = channel_partitions(
+                instrument.devices, instrument.coefficients,
+                max(1, multiprocessing.cpu_count() // len(instruments_descriptions)))
+            for partition in instrument.partitions:
+                partition.t_recommended = t_by_channels.get(partition.channels)
+        instrument.device_offset = len(devices)
+        devices.extend(instrument.devices)
+        new_instruments.append(instrument)
+    instruments = new_instruments
+    logging.info(f'Instrument description applied: {len(devices)} devices, {kept_devices_num} kept without changes')
 
     df_columns = list()
     df_columns.append('Time')
@@ -284,15 +566,104 @@ async def instrument_init():
         for field in output_measurements_order2:
             df_columns.append('Device' + str(device_num) + '_' + field)
 
-    measurements_buffer['data'] = pd.DataFrame(columns=df_columns)
+    measurements_buffer['data'] = remap_measurements(measurements_buffer['data'], old_devices, df_columns)
+
+    avg_encoder = averaged_record_encoder(len(devices))
+    raw_encoder = raw_record_encoder(len(devices))
+    archive_device_ids = tuple(device.id for device in devices)
+
+    # открытые блоки старших уровней усреднения относятся к прежнему списку устройств
+    if aggregator is None or aggregator.base_interval_sec != data_averaging_interval_sec or \
+            len(devices) != len(old_devices) or any(device is not old_device
+                                                    for device, old_device in zip(devices, old_devices)):
+        try:
+            aggregator = HierarchicalAggregator(data_averaging_interval_sec, list(aggregation_levels))
+        except ValueError as e:
+            aggregator = None
+            return_error(f'Averaging levels are disabled - {e}')
+        try:
+            rollup_aggregator = HierarchicalAggregator(data_averaging_interval_sec, list(rollup_retention_days))
+        except ValueError as e:
+            rollup_aggregator = None
+            return_error(f'Rollup store is not updated - {e}')
+
+    if rollup_store is None:
+        try:
+            rollup_store = RollupStore(rollup_file_name, dict((resolution, days * 86400)
+                                                              for resolution, days in rollup_retention_days.items()))
+        except sqlite3.Error as e:
+            return_error(f'Rollup store {rollup_file_name} is not opened - {e}')
 
     # находим все каналы, на которых есть решетки
+    active_channels = set()
     for device in devices:
         active_channels.add(int(device.channel))
 
-    instrument_ip = instrument_description['IP_address']
-    if not isinstance(instrument_ip, str):
-        instrument_ip = instrument_ip[0]
+    # пересчет длин волн нескольких приборов (каналов) распределяется по процессам
+    workers_num = conversion_workers
+    if workers_num is None:
+        if conversion_by_channel:
+            units_num = sum([max(1, len(instrument.partitions)) for instrument in instruments])
+        else:
+            units_num = len(instruments)
+        workers_num = min(units_num, multiprocessing.cpu_count()) if units_num > 1 else 0
+    # пул пересоздается при изменении количества процессов; начатые пересчеты завершаются в прежнем пуле
+    if workers_num != conversion_executor_workers:
+        if conversion_executor is not None:
+            conversion_executor.shutdown(wait=False)
+            conversion_executor = None
+        if workers_num:
+            conversion_executor = ProcessPoolExecutor(max_workers=workers_num)
+            logging.info(f'Conversion is distributed over {workers_num} processes '
+                         f'(previously {conversion_executor_workers})')
+        else:
+            logging.info(f'Conversion process pool of {conversion_executor_workers} processes is shut down - '
+                         f'conversion runs in the main process')
+        conversion_executor_workers = workers_num
+
+    # состояние конвейера из контрольной точки, загруженной при запуске - до запуска потоков пиков
+    if pending_checkpoint is not None:
+        restore_pipeline_state(pending_checkpoint)
+        pending_checkpoint = None
+
+    # процесс получения данных пересчитывает со своей копией списка устройств - перезапускаем его
+    for instrument in changed_instruments:
+        if instrument.process is not None:
+            acquisition_start(instrument)
+
+    # поток пиков запускается только для новых приборов (новый IP_address) и приборов, которые еще не запущены
+    await start_instruments()
+
+
+async def start_instruments():
+    """ запуск приборов задания, которые еще не запущены; прибор, к которому не удалось подключиться, остается
+    не запущенным, подключение повторяется (instrument_retry_coroutine()) """
+    global h1
+
+    for instrument in list(instruments):
+        if instrument.h1 or instrument.is_starting:
+            continue
+        instrument.is_starting = True
+        try:
+            if await instrument_start(instrument):
+                logging.info(f'Instrument started: {instrument}')
+                # за время подключения прибор мог быть исключен новым заданием
+                if instrument not in instruments:
+                    instrument_stop(instrument)
+        except Exception as e:
+            return_error(f'Instrument {instrument.ip} is not started - exception: {e}')
+        finally:
+            instrument.is_starting = False
+
+    # приборы старого формата задания и получение спектра работают с первым прибором
+    h1 = instruments[0].h1 if instruments else None
+
+
+async def instrument_start(instrument):
+    """ подключение к прибору и запуск потока пиков с него
+    :return: bool(), True - прибор подключен, False - командный порт прибора недоступен
+    """
+    instrument_ip = instrument.ip
 
     # проверяем готовность прибора
     with socket.socket() as s:
@@ -302,7 +673,7 @@ async def instrument_init():
             s.connect(instrument_address)
         except socket.error:
             return_error('command port is not active on ip ' + instrument_ip)
-            pass
+            return False
 
     """
     # соединяемся с x55
@@ -349,15 +720,125 @@ async def instrument_init():
         print(channel, ds.setting_id, ds.name, ds.description, ds.boxcar_length, ds.diff_filter_length, ds.lockout, ds.ntv_period, ds.threshold, ds.mode)
     """
     logging.info(f'Instrument {await h1.get_instrument_name()} connected')
-    # запускаем процедуру периодического получения спектра
-    # await get_one_spectrum(h1)
+    # прибор считается запущенным только после ответа на команду
+    instrument.h1 = h1
 
     # await h1.set_active_full_spectrum_channel_numbers(active_channels)
 
-    # запускаем стриминг пиков
-    if not peak_stream:
-        peak_stream = hyperion.HCommTCPPeaksStreamer(instrument_ip, loop, queue)
-        await peak_stream.stream_data()
+    # периодическое получение спектра
+    if spectrum_interval_sec > 0 and instrument.spectrum_task is None:
+        instrument.spectrum_task = loop.create_task(spectrum_coroutine(instrument))
+
+    # запускаем стриминг пиков и корутины получения и пересчета данных прибора
+    if acquisition_in_separate_process and shared_memory is not None:
+        acquisition_start(instrument)
+    elif not instrument.peak_stream:
+        instrument.queue = asyncio.Queue(maxsize=peak_queue_capacity, loop=loop)
+        instrument.peak_stream = hyperion.HCommTCPPeaksStreamer(instrument_ip, loop, instrument.queue)
+        instrument.tasks.append(loop.create_task(instrument.peak_stream.stream_data()))
+        instrument.tasks.append(loop.create_task(get_wls_from_x55_coroutine(instrument)))
+        instrument.tasks.append(loop.create_task(wls_to_measurements_coroutine(instrument)))
+    return True
+
+
+def acquisition_start(instrument):
+    """ запуск (перезапуск - при новом списке устройств) процесса получения данных прибора """
+    acquisition_stop(instrument)
+
+    instrument.ring = ShmRingBuffer(slots=acquisition_ring_slots, record_width=record_width(len(instrument.devices)))
+    instrument.stop_event = multiprocessing.Event()
+    instrument.process = multiprocessing.Process(
+        target=acquisition_process_main, name=f'UPK_acquisition_{instrument.ip}', daemon=True,
+        args=(instrument.ip, instrument.devices, instrument.ring.name, instrument.stop_event, peak_queue_capacity,
+              log_dir))
+    instrument.process.start()
+    instrument.tasks.append(loop.create_task(shm_reader_coroutine(instrument)))
+    logging.info(f'Acquisition process started for {instrument}, pid {instrument.process.pid}')
+
+
+def acquisition_stop(instrument):
+    """ остановка процесса получения данных прибора """
+    if instrument.process is None:
+        return
+
+    for task in instrument.tasks:
+        task.cancel()
+    instrument.tasks.clear()
+
+    instrument.stop_event.set()
+    instrument.process.join(timeout=5)
+    if instrument.process.is_alive():
+        instrument.process.terminate()
+    instrument.process = None
+
+    # оставшиеся в буфере измерения относятся к старому списку устройств
+    instrument.ring.close()
+    instrument.ring = None
+
+
+def instrument_stop(instrument):
+    """ остановка потока пиков и корутин прибора """
+    acquisition_stop(instrument)
+    if instrument.peak_stream:
+        instrument.peak_stream.stop_streaming()
+        instrument.peak_stream = None
+    for task in instrument.tasks:
+        task.cancel()
+    instrument.tasks.clear()
+    if instrument.spectrum_task:
+        instrument.spectrum_task.cancel()
+        instrument.spectrum_task = None
+    instrument.wavelengths_buffer['data'].clear()
+    memory_budget.remove_buffer(instrument.wavelengths_buffer)
+    logging.info(f'Instrument stopped: {instrument}')
+
+
+def reuse_devices(instrument, devices_descriptions, compiled):
+    """ устройства прибора по новому заданию: для описания, совпадающего с описанием работающего устройства,
+    используется это устройство, для остальных - собранные по схеме
+    :param devices_descriptions: list(), описания устройств прибора из задания
+    :param compiled: UPK_device_schema.CompiledDevices, устройства, собранные по devices_descriptions
+    :return: (list(), list()) - устройства и канонические записи их описаний
+    """
+    old_devices = dict()
+    for device, device_description in zip(instrument.devices, instrument.device_descriptions):
+        old_devices.setdefault(device_description, list()).append(device)
+
+    instrument_devices = list()
+    device_descriptions = list()
+    for device_description, compiled_device in zip(devices_descriptions, compiled.devices):
+        canonical = canonical_description(device_description)
+        if old_devices.get(canonical):
+            instrument_devices.append(old_devices[canonical].pop(0))
+        else:
+            instrument_devices.append(compiled_device)
+        device_descriptions.append(canonical)
+    return instrument_devices, device_descriptions
+
+
+def remap_measurements(measurements, old_devices, df_columns):
+    """ накопленные измерения в столбцах нового списка устройств: столбцы сохраненных устройств переносятся
+    (устройство могло сменить номер), у новых устройств - NaN
+    :param measurements: pd.DataFrame(), измерения по старому списку устройств (или list() до первого задания)
+    :param old_devices: list(), старый список устройств
+    :param df_columns: list(), столбцы по новому списку устройств (глобальная переменная devices)
+    """
+    if not isinstance(measurements, pd.DataFrame) or not len(measurements):
+        return pd.DataFrame(columns=df_columns)
+    if list(measurements.columns) == df_columns and \
+            all(device is old_device for device, old_device in zip(devices, old_devices)):
+        return measurements
+
+    old_device_nums = dict((id(device), device_num) for device_num, device in enumerate(old_devices))
+    remapped = pd.DataFrame(index=measurements.index, columns=df_columns, dtype=float)
+    remapped['Time'] = measurements['Time']
+    for device_num, device in enumerate(devices):
+        old_device_num = old_device_nums.get(id(device))
+        if old_device_num is None:
+            continue
+        for field in output_measurements_order2:
+            remapped[f'Device{device_num}_{field}'] = measurements[f'Device{old_device_num}_{field}']
+    return remapped
 
 
 def return_error(e):
@@ -366,72 +847,85 @@ def return_error(e):
     return None
 
 
-async def get_wls_from_x55_coroutine():
+async def get_wls_from_x55_coroutine(instrument):
     """ получение длин волн от x55 c исходной частотой (складирование в буффер в памяти) """
-    global wavelengths_buffer, wls_buffer_for_saving, wls_buffer_for_disk
+    global wls_buffer_for_saving, wls_buffer_for_disk
+
+    queue = instrument.queue
+    wavelengths_buffer = instrument.wavelengths_buffer
+    stage = register_stage('get_wls_from_x55_coroutine')
 
     last_timestamp = 0
     try:
         while True:
 
             try:
-                this_function_name = sys._getframe().f_code.co_name
-                if this_function_name in coroutine_heart_rate:
-                    coroutine_heart_rate[this_function_name] += 1
-                else:
-                    coroutine_heart_rate[this_function_name] = 1
+                stage.iteration()
 
-                peak_data = await queue.get()
+                # за одно пробуждение забираем все накопившиеся пакеты (не больше peak_batch_max_packets),
+                # учет и передача в буферы выполняются один раз на пачку
+                packets = [await queue.get()]
                 queue.task_done()
-                if peak_data['data']:
-
-                    cur_timestamp = round(peak_data['timestamp'])
-                    if cur_timestamp != last_timestamp:
-                        # print('wls -', cur_timestamp)
-                        last_timestamp = cur_timestamp
-
-                    peaks_by_channel = dict()
-                    for channel in range(len(peak_data['data'].channel_slices)):
-                        wls = []
-                        for wl in peak_data['data'].channel_slices[channel]:
-                            wls.append(wl)
-                        peaks_by_channel[channel + 1] = wls
-
-                    measurement_time = peak_data['timestamp']
+                while len(packets) < peak_batch_max_packets and not queue.empty():
+                    packets.append(queue.get_nowait())
+                    queue.task_done()
+                instrument.add_peak_batch(len(packets))
+
+                with stage.busy():
+                    # длины волн пакетов - массивы numpy поверх данных пакетов, по каналам - их срезы
+                    samples = list()
+                    packets_wls = list()
+                    stream_stopped = False
+                    for peak_data in packets:
+                        if not peak_data['data']:
+                            # If the queue returns None, then the streamer has stopped.
+                            stream_stopped = True
+                            break
+                        packet_wls, channel_offsets = packet_peaks(peak_data['data'])
+                        samples.append((peak_data['timestamp'], channel_peaks(packet_wls, channel_offsets)))
+                        packets_wls.append(packet_wls)
+
+                    if samples:
+                        instrument.last_received_time = max(instrument.last_received_time, samples[-1][0])
+                        cur_timestamp = round(samples[-1][0])
+                        if cur_timestamp != last_timestamp:
+                            # print('wls -', cur_timestamp)
+                            last_timestamp = cur_timestamp
+
+                        # запись длин волн в буфер
+                        if 0:
+                            wls_buffer_for_saving['is_ready'] = False
+                            try:
+                                for measurement_time, peaks_by_channel in samples:
+                                    buffer_put(wls_buffer_for_saving, measurement_time, peaks_by_channel)
+                            finally:
+                                wls_buffer_for_saving['is_ready'] = True
 
-                    # запись длин волн в буфер
-                    if 0:
-                        wls_buffer_for_saving['is_ready'] = False
-                        try:
-                            wls_buffer_for_saving['data'][measurement_time] = peaks_by_channel
-                        finally:
-                            wls_buffer_for_saving['is_ready'] = True
+                        # запись длин волн в буфер 2 (при отставании обработки архив длин волн не пишется)
+                        if not load_shedder.shed_wls_archive(len(samples)) and wls_buffer_for_disk['is_ready']:
+                            wls_buffer_for_disk['is_ready'] = False
+                            try:
+                                for (measurement_time, _), packet_wls in zip(samples, packets_wls):
+                                    buffer_put(wls_buffer_for_disk, measurement_time,
+                                               [measurement_time] + packet_wls.tolist())
+                            finally:
+                                wls_buffer_for_disk['is_ready'] = True
 
-                    # запись длин волн в буфер 2
-                    if wls_buffer_for_disk['is_ready']:
-                        wls_buffer_for_disk['is_ready'] = False
-                        t = [measurement_time]
+                        wavelengths_buffer['is_ready'] = False
                         try:
-                            for key, value in peaks_by_channel.items():
-                                t.extend(value)
-                            wls_buffer_for_disk['data'][measurement_time] = t
+                            for measurement_time, peaks_by_channel in samples:
+                                if measurement_time not in wavelengths_buffer['data']:
+                                    buffer_put(wavelengths_buffer, measurement_time, peaks_by_channel)
+                        except KeyError as e:
+                            return_error(f'get_wls_from_x55_coroutine(): {e.__doc__}')
                         finally:
-                            wls_buffer_for_disk['is_ready'] = True
+                            wavelengths_buffer['is_ready'] = True
 
-                    wavelengths_buffer['is_ready'] = False
-                    try:
-                        if measurement_time not in wavelengths_buffer.setdefault('data', dict()):
-                            wavelengths_buffer['data'][measurement_time] = peaks_by_channel
-                    except KeyError as e:
-                        return_error(f'get_wls_from_x55_coroutine(): {e.__doc__}')
-                    finally:
-                        wavelengths_buffer['is_ready'] = True
-
-                else:
-                    # If the queue returns None, then the streamer has stopped.
+                stage.add_items(len(samples))
+                if stream_stopped:
                     break
             except Exception as e:
-                logging.error(f'Some error during getting peaks - exception: {e.__doc__}')
+                pipeline_log.error(f'Some error during getting peaks - exception: {e.__doc__}')
                 pass
 
         # если нет информации об инструменте, то не можем получать данные
@@ -443,134 +937,179 @@ async def get_wls_from_x55_coroutine():
         logging.critical(msg)
 
 
-async def wls_to_measurements_coroutine():
-    """получение пересчет длин волн в измерения"""
-    global wavelengths_buffer, measurements_buffer
-
-    # приблизительная температура устройств, используется для поиска подходящего пика на спектре
-    t_recommended = None
+async def wls_to_measurements_coroutine(instrument):
+    """получение пересчет длин волн прибора в измерения"""
+    wavelengths_buffer = instrument.wavelengths_buffer
+    stage = register_stage('wls_to_measurements_coroutine')
 
     try:
         while True:
             await asyncio.sleep(asyncio_pause_sec)
-
-            this_function_name = sys._getframe().f_code.co_name
-            if this_function_name in coroutine_heart_rate:
-                coroutine_heart_rate[this_function_name] += 1
-            else:
-                coroutine_heart_rate[this_function_name] = 1
+            stage.iteration()
 
             # ждем появления данных в буфере
             while len(wavelengths_buffer['data']) < 2:
                 await asyncio.sleep(asyncio_pause_sec)
 
-            if not t_recommended:
-                t_recommended = (devices[0].t_max + devices[0].t_min) / 2
-
             # ждем освобождения буфера
             while not wavelengths_buffer['is_ready']:
                 await asyncio.sleep(asyncio_pause_sec)
 
-            times_to_be_deleted = list()
-
-            # блокируем буфер (чтобы надежно с ним работать в многопоточном доступе)
+            # забираем из буфера все накопленные измерения (блокируем буфер, чтобы надежно с ним работать)
             wavelengths_buffer['is_ready'] = False
             try:
-                for (measurement_time, peaks_by_channel) in wavelengths_buffer['data'].items():
+                samples = list(wavelengths_buffer['data'].items())
+                wavelengths_buffer['data'].clear()
+            finally:
+                wavelengths_buffer['is_ready'] = True
+
+            # при большом отставании пересчитывается только часть измерений
+            samples = load_shedder.shed_samples(f'samples_{instrument.num}', samples)
+            if not samples:
+                continue
+
+            try:
+                with stage.busy():
+                    instrument_devices = instrument.devices
+                    device_table = instrument.device_table
+                    partitions = instrument.partitions
+                    if len(partitions) > 1:
+                        rows, raw_rows, t_by_partition = await convert_by_channel(partitions, samples,
+                                                                                  len(instrument_devices))
+                    elif conversion_executor:
+                        rows, raw_rows, t_recommended = await loop.run_in_executor(
+                            conversion_executor, convert_samples, device_table, samples, instrument.t_recommended)
+                    else:
+                        rows, raw_rows, t_recommended = convert_samples(device_table, samples, instrument.t_recommended)
+
+                    # за время пересчета пришло новое задание - результат относится к старому списку устройств
+                    if instrument.devices is not instrument_devices:
+                        continue
+                    if len(partitions) > 1:
+                        for partition, t_recommended in zip(partitions, t_by_partition):
+                            partition.t_recommended = t_recommended
+                    else:
+                        instrument.t_recommended = t_recommended
 
-                    # время усредненного блока, в которое попадает это измерение
-                    averaged_block_time = measurement_time - measurement_time % (1 / instrument_description['SampleRate'])
-                    np.append([averaged_block_time], np.zeros(len(output_measurements_order2)))
+                    await store_converted_rows(instrument, instrument_devices, rows, raw_rows)
+                stage.add_items(len(samples))
 
-                    devices_output3 = [measurement_time] + [np.nan] * len(output_measurements_order2) * len(devices)
+            except Exception as e:
+                pipeline_log.error(f'Some error during wls to measurements conversion - exception: {e.__doc__}')
+    finally:
+        msg = 'wls_to_measurements is finishing'
+        print(msg)
+        logging.critical(msg)
 
-                    raw_measurements_buffer_for_disk['data'][measurement_time] = [measurement_time]
 
-                    # переводим пики в пикометры
-                    for channel, wls in peaks_by_channel.items():
-                        peaks_by_channel[channel] = [wl*1000 for wl in wls]
-                        pass
+async def convert_by_channel(partitions, samples, devices_num):
+    """ пересчет пачки измерений прибора по каналам: разделы пересчитываются независимо (в conversion_executor -
+    параллельно), затем строки разделов собираются по измерениям
+    :param partitions: list(), UPK_conversion.ChannelPartition прибора
+    :return: (rows, raw_rows, t_by_partition), t_by_partition - рекомендованные температуры разделов
+    """
+    if conversion_executor:
+        results = await asyncio.gather(*[loop.run_in_executor(
+            conversion_executor, convert_samples, partition.table, channel_samples(samples, partition.channels),
+            partition.t_recommended) for partition in partitions])
+    else:
+        results = [convert_samples(partition.table, channel_samples(samples, partition.channels), partition.t_recommended)
+                   for partition in partitions]
 
-                    # шаг 1 - находим рекомендованную температуру
-                    temperatures = list()
-                    for device_num, device in enumerate(devices):
-                        wls = device.find_yours_wls(peaks_by_channel[device.channel], delete_founded_peaks=False)
-                        if wls:
-                            temperatures.append(device.get_temperature(wls[0]))
+    rows, raw_rows = merge_partition_rows([measurement_time for measurement_time, _ in samples], partitions,
+                                          [(rows, raw_rows) for rows, raw_rows, _ in results], devices_num)
+    return rows, raw_rows, [t_recommended for _, _, t_recommended in results]
 
-                    # из списка температур выберем одну - которую будем рекомендовать далее
-                    if len(temperatures) > 1:
-                        t_recommended = statistics.median(temperatures)
 
-                    # шаг 2 - находим пики с учетом рекомендованной температуры
-                    for device_num, device in enumerate(devices):
-                        # среди всех пиков ищем 3 подходящих для теукущего измерителя
-                        wls = device.find_yours_wls(peaks_by_channel[device.channel], device.channel, t_recommended)
+@instrumented('store_converted_rows')
+async def store_converted_rows(instrument, instrument_devices, rows, raw_rows):
+    """ запись пересчитанных измерений прибора в общие буферы измерений
+    :param instrument_devices: list(), устройства прибора, для которых выполнен пересчет
+    :param rows: list(), строки измерений прибора [время, поля устройств прибора]
+    :param raw_rows: list(), строки сырых измерений прибора [время, F1, F2 устройств прибора]
+    """
+    global measurements_buffer
 
-                        # если все три пика измерителя нашлись, то вычисляем тяжения и пр. Нет - вставляем пустышки
-                        if wls:
-                            device_output = device.get_tension_fav_ex(wls[1], wls[2], wls[0])
+    fields_num = len(output_measurements_order2)
 
-                            for field_num, filed in enumerate(output_measurements_order2):
-                                devices_output3[1 + device_num * len(output_measurements_order2) + field_num] = device_output[filed]
+    # при отставании обработки сырой архив прореживается (строки для усреднения сохраняются все)
+    raw_rows = load_shedder.shed_raw(f'raw_{instrument.num}', raw_rows)
 
-                            raw_measurements_buffer_for_disk['data'][measurement_time].append(device_output['F1_N'])
-                            raw_measurements_buffer_for_disk['data'][measurement_time].append(device_output['F2_N'])
-                        else:
-                            none_value = None
-                            for field_num, filed in enumerate(output_measurements_order2):
-                                devices_output3[1 + device_num * len(output_measurements_order2) + field_num] = none_value
+    # устройства прибора занимают свое место в общей строке устройств всех приборов
+    devices_after = len(devices) - instrument.device_offset - len(instrument_devices)
+    before, after = [None] * instrument.device_offset, [None] * devices_after
 
-                            raw_measurements_buffer_for_disk['data'][measurement_time].append(none_value)
-                            raw_measurements_buffer_for_disk['data'][measurement_time].append(none_value)
+    # сырые записи форматируются для архива один раз, всей пачкой
+    raw_lines = raw_encoder.encode_block([raw_row[:1] + before * 2 + raw_row[1:] + after * 2 for raw_row in raw_rows])
+    if raw_rows:
+        archive_layouts['raw'].note(raw_rows[0][0], archive_device_ids)
+    for raw_row, raw_line in zip(raw_rows, raw_lines):
+        buffer_put(raw_measurements_buffer_for_disk, raw_row[0], raw_line)
 
-                    if len(devices_output3) > 1:
+    rows = [row[:1] + before * fields_num + row[1:] + after * fields_num for row in rows]
 
-                        while not measurements_buffer['is_ready']:
-                            await asyncio.sleep(asyncio_pause_sec)
-                        try:
-                            measurements_buffer['is_ready'] = False
+    while not measurements_buffer['is_ready']:
+        await asyncio.sleep(asyncio_pause_sec)
+    try:
+        measurements_buffer['is_ready'] = False
+
+        df = pd.DataFrame(rows, columns=measurements_buffer['data'].columns, dtype=float)
+        measurements_buffer['data'] = pd.concat([measurements_buffer['data'], df], ignore_index=True)
+
+        # переполнение - отбрасываем самые старые строки
+        if len(measurements_buffer['data']) > measurements_buffer['capacity']:
+            measurements_buffer['overflow_count'] += 1
+            measurements_buffer['lost_count'] += \
+                len(measurements_buffer['data']) - measurements_buffer['capacity']
+            measurements_buffer['data'] = \
+                measurements_buffer['data'].iloc[-measurements_buffer['capacity']:]
+    finally:
+        measurements_buffer['is_ready'] = True
 
-                            df = pd.DataFrame([tuple(devices_output3)], columns=measurements_buffer['data'].columns)
-                            measurements_buffer['data'] = measurements_buffer['data'].append(df, ignore_index=True)
+    instrument.last_measurement_time = max(row[0] for row in rows)
+    instrument.last_update_time = datetime.datetime.now().timestamp()
 
-                            if measurement_time not in times_to_be_deleted:
-                                times_to_be_deleted.append(measurement_time)
 
-                        finally:
-                            measurements_buffer['is_ready'] = True
+async def shm_reader_coroutine(instrument):
+    """ получение пересчитанных измерений прибора из процесса получения данных (через разделяемую память) """
+    instrument_devices = instrument.devices
+    stage = register_stage('shm_reader_coroutine')
+    try:
+        while True:
+            await asyncio.sleep(asyncio_pause_sec)
+            stage.iteration()
 
-                # измерения учтены, их можно удалять
-                for time in sorted(times_to_be_deleted):
-                    wavelengths_buffer['data'].pop(time)
+            records = instrument.ring.read()
+            if not len(records):
+                continue
 
+            try:
+                with stage.busy():
+                    rows, raw_rows = split_records(records, len(instrument_devices))
+                    await store_converted_rows(instrument, instrument_devices, rows, raw_rows)
+                stage.add_items(len(records))
             except Exception as e:
-                logging.error(f'Some error during avg measurements sorting - exception: {e.__doc__}')
-
-            finally:
-                wavelengths_buffer['is_ready'] = True
+                pipeline_log.error(f'Some error during reading measurements from acquisition process - exception: {e.__doc__}')
     finally:
-        msg = 'wls_to_measurements is finishing'
+        msg = 'shm_reader_coroutine is finishing'
         print(msg)
         logging.critical(msg)
 
 
+
 async def averaging_measurements_coroutine():
     """усреднение измерений"""
     global measurements_buffer, averaged_measurements_buffer_for_OSM
 
     cur_measurements = list()
     averaged_block_end_time = None
+    stage = register_stage('averaging_measurements_coroutine')
     try:
         while True:
+            block_accumulator = None
             try:
                 await asyncio.sleep(asyncio_pause_sec)
-
-                this_function_name = sys._getframe().f_code.co_name
-                if this_function_name in coroutine_heart_rate:
-                    coroutine_heart_rate[this_function_name] += 1
-                else:
-                    coroutine_heart_rate[this_function_name] = 1
+                stage.iteration()
 
                 # ждем освобождения буфера
                 while not measurements_buffer['is_ready']:
@@ -581,7 +1120,7 @@ async def averaging_measurements_coroutine():
                     measurements_buffer['is_ready'] = False
 
                     # ждем появления данных
-                    if measurements_buffer['data'].size == 0:
+                    if len(measurements_buffer['data']) == 0:
                         await asyncio.sleep(asyncio_pause_sec)
                         continue
 
@@ -599,82 +1138,61 @@ async def averaging_measurements_coroutine():
                     if last_measurement_block <= first_measurement_block:
                         continue
 
-                    # время начала усредненного блока, в которое попадает первое измерение
-                    averaged_block_start_time = first_measurement_time - first_measurement_time % data_averaging_interval_sec
-                    averaged_block_end_time = averaged_block_start_time + data_averaging_interval_sec
-
-                    # выборка значений усредненного блока (по времени начала и конца блока)
-                    block = measurements_buffer['data'].loc[
-                        (measurements_buffer['data']['Time'] >= averaged_block_start_time) &
-                        (measurements_buffer['data']['Time'] < averaged_block_end_time)]
-
-                    # усреднение данных
-                    cur_measurements = [averaged_block_end_time]
-
-                    for device_num, device in enumerate(devices):
-
-                        t_min = 0
-                        t_max = 0
-                        ice = 0
-
-                        for field_num, field_name in enumerate(output_measurements_order2):
-                            field_name = 'Device' + str(device_num) + '_' + field_name
-
-                            if field_num == 0:
-                                n = block[field_name].count()
-                                if n == 0:
-                                    pass
-                                cur_measurements.append(n)
-
-                            block_mean = 0
-                            block_std = 0
-                            block_max = 0
-                            block_min = 0
-                            try:
-                                block_max = block[field_name].max()
-                                block_min = block[field_name].min()
-                                block_mean = block[field_name].mean()
-                                block_std = block[field_name].std()
-                            finally:
-                                cur_measurements.append(block_mean)
-                                cur_measurements.append(block_std)
-                                if 'T_degC' in field_name:
-                                    t_min = block_min
-                                    t_max = block_max
-                                if 'Ice_mm' in field_name:
-                                    ice = block_mean
-
-                        # расчет границ нормального тяжения - при котором виртуальный гололед не более 1мм
-                        # fok = f_extra(ice_threshold)
-                        ice_threshold = 1
-                        fok = 10 * (device.icemodel_i1 * ice_threshold + device.icemodel_i2 * (ice_threshold ** 2))
-                        fmodel_max = 10 * (
-                                device.fmodel_f2 * (t_max ** 2) + device.fmodel_f1 * t_max + device.fmodel_f0)
-                        fmodel_min = 10 * (
-                                device.fmodel_f2 * (t_min ** 2) + device.fmodel_f1 * t_min + device.fmodel_f0)
-                        fok_min = fmodel_min - fok
-                        fok_max = fmodel_max + fok
-
-                        cur_measurements.append(fok_min)
-                        cur_measurements.append(fok_max)
-
-                    # обработанные данные убираем из блока
-                    measurements_buffer['data'] = measurements_buffer['data'].loc[
-                        (measurements_buffer['data']['Time'] >= averaged_block_end_time)]
-
-                except KeyError:
+                    # при нескольких приборах блок закрывается, когда все работающие приборы прислали данные после него
+                    if len(instruments) > 1:
+                        cur_time = datetime.datetime.now().timestamp()
+                        instruments_last_times = [instrument.last_measurement_time for instrument in instruments
+                                                  if cur_time - instrument.last_update_time < instruments_merge_timeout_sec]
+                        if instruments_last_times and \
+                                min(instruments_last_times) < first_measurement_block + data_averaging_interval_sec:
+                            continue
+
+                    with stage.busy():
+                        # время начала усредненного блока, в которое попадает первое измерение
+                        averaged_block_start_time = \
+                            first_measurement_time - first_measurement_time % data_averaging_interval_sec
+                        averaged_block_end_time = averaged_block_start_time + data_averaging_interval_sec
+
+                        # выборка значений усредненного блока (по времени начала и конца блока)
+                        block = measurements_buffer['data'].loc[
+                            (measurements_buffer['data']['Time'] >= averaged_block_start_time) &
+                            (measurements_buffer['data']['Time'] < averaged_block_end_time)]
+
+                        # усреднение данных - накопитель блока (из него же строятся блоки старших уровней)
+                        block_values = block.drop(columns='Time').to_numpy(dtype=float).reshape(
+                            len(block), len(devices), len(output_measurements_order2))
+                        block_accumulator = BlockAccumulator.from_values(block_values)
+                        cur_measurements = averaged_record(averaged_block_end_time, block_accumulator, devices)
+
+                        # обработанные данные убираем из блока
+                        measurements_buffer['data'] = measurements_buffer['data'].loc[
+                            (measurements_buffer['data']['Time'] >= averaged_block_end_time)]
+
+                except (KeyError, ValueError):
                     pass
                 finally:
                     measurements_buffer['is_ready'] = True
 
-                print(cur_measurements)
+                # блок не усреднен (например, за время усреднения пришло новое задание)
+                if block_accumulator is None:
+                    continue
+                stage.add_items(1)
+
+                # запись форматируется один раз - эта же строка отправляется на ОСМ и пишется в архив
+                try:
+                    avg_line = avg_encoder.encode(cur_measurements)
+                except ValueError as e:
+                    # пришло новое задание с другим количеством устройств
+                    pipeline_log.error(f'Averaged block {averaged_block_end_time} is not encoded - {e}')
+                    continue
+                archive_layouts['avg'].note(averaged_block_end_time, archive_device_ids)
 
                 # запись выходных измерений в буфер для ОСМ и для записи на диск
                 while not averaged_measurements_buffer_for_OSM['is_ready']:
                     await asyncio.sleep(asyncio_pause_sec)
                 try:
                     averaged_measurements_buffer_for_OSM['is_ready'] = False
-                    averaged_measurements_buffer_for_OSM['data'][averaged_block_end_time] = cur_measurements
+                    buffer_put(averaged_measurements_buffer_for_OSM, averaged_block_end_time, avg_line)
 
                 finally:
                     averaged_measurements_buffer_for_OSM['is_ready'] = True
@@ -683,9 +1201,36 @@ async def averaging_measurements_coroutine():
                     await asyncio.sleep(asyncio_pause_sec)
                 try:
                     averaged_measurements_buffer_for_disk['is_ready'] = False
-                    averaged_measurements_buffer_for_disk['data'][averaged_block_end_time] = cur_measurements
+                    buffer_put(averaged_measurements_buffer_for_disk, averaged_block_end_time, avg_line)
                 finally:
                     averaged_measurements_buffer_for_disk['is_ready'] = True
+                publish_level_record(data_averaging_interval_sec, avg_line)
+
+                # агрегаты для долгосрочных трендов записываются в отдельном потоке
+                if rollup_store is not None and rollup_aggregator is not None:
+                    rollup_blocks = rollup_aggregator.add(averaged_block_end_time, block_accumulator)
+                    if rollup_blocks:
+                        rollup_executor.submit(rollup_store.add_blocks, rollup_blocks,
+                                               [device.id for device in devices]).add_done_callback(rollup_done)
+
+                # старшие уровни усреднения - блоки, закрытые этим блоком
+                if aggregator is None or block_accumulator is None:
+                    continue
+                for interval_sec, level_block_end_time, level_accumulator in \
+                        aggregator.add(averaged_block_end_time, block_accumulator):
+                    level_line = avg_encoder.encode(averaged_record(level_block_end_time, level_accumulator, devices))
+                    publish_level_record(interval_sec, level_line)
+
+                    level_buffer = level_buffers_for_disk.get(interval_sec)
+                    if level_buffer is None:
+                        continue
+                    while not level_buffer['is_ready']:
+                        await asyncio.sleep(asyncio_pause_sec)
+                    try:
+                        level_buffer['is_ready'] = False
+                        buffer_put(level_buffer, level_block_end_time, level_line)
+                    finally:
+                        level_buffer['is_ready'] = True
 
             finally:
                 pass
@@ -696,30 +1241,37 @@ async def averaging_measurements_coroutine():
         loop.create_task(averaging_measurements_coroutine())
 
 
+def rollup_done(future):
+    """ результат записи агрегатов (выполняется в потоке rollup_executor) """
+    if future.exception() is not None:
+        pipeline_log.error(f'Some error during rollup store update - exception: {future.exception()}')
+
+
 async def save_measurements_coroutine(buffer, file_type='avg'):
     """запись усредненных измерений на диск"""
 
-    # строка с измерениями для сохранения на диск (и время этих измерений - чтобы не сохранять одно и тоже повторно)
-    timestamp_msg, send_msg = None, ''
-
+    file_time_format = '%Y%m%d%H'  # часовые файлы
     if file_type == 'avg':
         file_prefix = ''
     elif file_type == 'raw':
         file_prefix = '_raw'
     elif file_type == 'wls':
         file_prefix = '_wls'
+    elif file_type.startswith('avg'):
+        # старший уровень усреднения (например, avg600) - суточные файлы
+        file_prefix = '_' + file_type
+        file_time_format = '%Y%m%d'
     else:
         raise Exception(ValueError, 'Value of file_type is unexpected')
+    stage = register_stage(f'save_measurements_coroutine_{file_type}')
+    # списки устройств записей (для столбцового архива) и последний записанный список по часовым файлам
+    layouts = archive_layouts.get(file_type)
+    written_layouts = dict()
 
     try:
         while True:
             await asyncio.sleep(asyncio_pause_sec)
-
-            this_function_name = sys._getframe().f_code.co_name
-            if this_function_name in coroutine_heart_rate:
-                coroutine_heart_rate[this_function_name] += 1
-            else:
-                coroutine_heart_rate[this_function_name] = 1
+            stage.iteration()
 
             # ждем появления данных в буфере
             if len(buffer['data'].keys()) < 1:
@@ -729,57 +1281,83 @@ async def save_measurements_coroutine(buffer, file_type='avg'):
             if not buffer['is_ready']:
                 continue
 
+            # строки с измерениями для сохранения на диск, сгруппированные по часовым файлам
+            lines_by_file = dict()
+            times_by_file = dict()  # время первой и последней записи часового файла
+            timestamps = list()
             try:
                 # блокируем буфер (чтобы надежно с ним работать в многопоточном доступе)
                 buffer['is_ready'] = False
 
-                timestamp_msg = sorted(buffer['data'].keys(), reverse=False)[0]
-                if file_type == 'wls':
-                    send_msg = '\t'.join(['%.4f' % x for x in buffer['data'][timestamp_msg]])
-                else:
-                    send_msg = '\t'.join(['%.3f' % x for x in buffer['data'][timestamp_msg]])
+                with stage.busy():
+                    timestamps = sorted(buffer['data'].keys(), reverse=False)[:save_max_records]
+                    for timestamp in timestamps:
+                        # усредненные и сырые записи уже отформатированы, длины волн - запись переменной длины
+                        record = buffer['data'][timestamp]
+                        line = record if isinstance(record, str) else encode_variable_record(record)
+
+                        data_arch_file_name = datetime.datetime.utcfromtimestamp(timestamp).strftime(
+                            f'{file_time_format}{file_prefix}.txt')
+                        lines_by_file.setdefault(data_arch_file_name, list()).append(line)
+                        first_time, _ = times_by_file.get(data_arch_file_name, (timestamp, timestamp))
+                        times_by_file[data_arch_file_name] = (first_time, timestamp)
             except Exception as e:
-                logging.error(f'Some error during avg measurements sorting - exception: {e.__doc__}')
+                pipeline_log.error(f'Some error during avg measurements sorting - exception: {e.__doc__}')
+                timestamps.clear()
+                lines_by_file.clear()
             finally:
                 buffer['is_ready'] = True
 
-            while send_msg != 'sent':
+            while lines_by_file:
                 await asyncio.sleep(asyncio_pause_sec)
 
-                # send data block
-                try:
-                    data_arch_file_name = datetime.datetime.utcfromtimestamp(timestamp_msg).strftime(
-                        f'%Y%m%d%H{file_prefix}.txt')
-
-                    # add header if needed
-                    if file_type == 'raw' and not Path(data_arch_file_name).is_file():
-                        header = 'Timestamp, s\t'
-                        for device in devices:
-                            header += f'{device.name}_F1, N\t{device.name}_F2, N\t'
-                        send_msg = header[:-1] + '\n' + send_msg
-
-                    with open(data_arch_file_name, 'a') as f:
-                        f.write(send_msg + '\n')
-                except OSError:
-                    logging.error('OS error during avg data saving')
-                except Exception as e:
-                    logging.error(
-                        f'Some error during avg measurements saving - measurements: {send_msg}; exception: {e.__doc__}')
-                else:
-                    send_msg = 'sent'
+                # send data block - в очередь потока записи, при заполненной очереди - повторная попытка
+                data_arch_file_name, lines = next(iter(lines_by_file.items()))
+                with stage.busy():
+                    try:
+                        # списки устройств записей файла, еще не записанные рядом с ним - до самих записей
+                        if layouts is not None:
+                            new_layouts = [entry for entry in layouts.entries_for(*times_by_file[data_arch_file_name])
+                                           if written_layouts.get(data_arch_file_name, (-1, None))[0] < entry[0]]
+                            if new_layouts:
+                                if not disk_writer.write(layout_file_name(data_arch_file_name),
+                                                         text_bytes(encode_layouts(new_layouts))):
+                                    continue
+                                written_layouts[data_arch_file_name] = new_layouts[-1]
+                                while len(written_layouts) > 2:
+                                    written_layouts.pop(next(iter(written_layouts)))
+
+                        send_msg = '\n'.join(lines)
+
+                        # add header if needed (записывается потоком, если файла еще нет)
+                        header = None
+                        if file_type == 'raw':
+                            header = 'Timestamp, s\t'
+                            for device in devices:
+                                header += f'{device.name}_F1, N\t{device.name}_F2, N\t'
+                            header = text_bytes(header[:-1] + '\n')
+
+                        queued = disk_writer.write(data_arch_file_name, text_bytes(send_msg + '\n'), header=header)
+                    except Exception as e:
+                        pipeline_log.error(
+                            f'Some error during avg measurements saving - file: {data_arch_file_name}; exception: {e.__doc__}')
+                    else:
+                        if queued:
+                            lines_by_file.pop(data_arch_file_name)
 
             # записанные измерения можно удалять
-            if not buffer['is_ready']:
-                continue
+            while not buffer['is_ready']:
+                await asyncio.sleep(asyncio_pause_sec)
             try:
                 buffer['is_ready'] = False
 
-                # удаление отправленного измерения
-                if send_msg == 'sent' and timestamp_msg in buffer['data']:
-                    buffer['data'].pop(timestamp_msg, None)
+                # удаление записанных измерений
+                for timestamp in timestamps:
+                    buffer['data'].pop(timestamp, None)
 
             finally:
                 buffer['is_ready'] = True
+            stage.add_items(len(timestamps))
 
     finally:
         send_msg = 'Function save_avg_measurements is finished'
@@ -798,21 +1376,33 @@ async def send_avg_measurements_coroutine():
     # отправка измерений пакетами (True) или по одному (False)
     send_multi_packages = False
     last_send_time = 0
+    stage = register_stage('send_avg_measurements_coroutine')
     # what_to_send = dict()
     try:
         while True:
             await asyncio.sleep(asyncio_pause_sec)
-
-            this_function_name = sys._getframe().f_code.co_name
-            if this_function_name in coroutine_heart_rate:
-                coroutine_heart_rate[this_function_name] += 1
-            else:
-                coroutine_heart_rate[this_function_name] = 1
+            stage.iteration()
 
             # ждем соединения
             if not master_connection:
                 continue
 
+            # живые данные отправляются первыми, выгруженные на диск при переполнении - когда буфер почти пуст
+            if len(averaged_measurements_buffer_for_OSM['data']) < 2 and averaged_measurements_buffer_for_OSM['is_ready']:
+                averaged_measurements_buffer_for_OSM['is_ready'] = False
+                try:
+                    # сегменты читаются в отдельном потоке, буфер заблокирован до вставки подгруженных записей
+                    free_space = min(averaged_measurements_buffer_for_OSM['capacity'] // 2,
+                                     averaged_measurements_buffer_for_OSM['capacity'] -
+                                     len(averaged_measurements_buffer_for_OSM['data']))
+                    records = await loop.run_in_executor(file_executor, load_spilled,
+                                                         averaged_measurements_buffer_for_OSM, free_space)
+                    insert_spilled(averaged_measurements_buffer_for_OSM, records)
+                except (OSError, ValueError) as e:
+                    pipeline_log.error(f'Some error during refilling OSM buffer from disk - exception: {e.__doc__}')
+                finally:
+                    averaged_measurements_buffer_for_OSM['is_ready'] = True
+
             # ждем появления данных в буфере
             if len(averaged_measurements_buffer_for_OSM['data'].keys()) < 1:
                 continue
@@ -830,15 +1420,10 @@ async def send_avg_measurements_coroutine():
                         if timestamp_msg not in what_to_send and len(what_to_send) < 5:
                             what_to_send[timestamp_msg] = averaged_measurements_buffer_for_OSM['data'][timestamp_msg]
 
-                    send_msg = '['
-                    for timestamp_msg, measurements in what_to_send.items():
-                        send_msg += '[' + ', '.join(
-                            [str(x) for x in measurements]) + '], '
-                    send_msg = send_msg[:-2] + ']'
+                    send_msg = osm_frame(list(what_to_send.values()))
                 else:
                     timestamp_msg = sorted(averaged_measurements_buffer_for_OSM['data'].keys(), reverse=True)[0]
-                    send_msg = '[' + ', '.join(
-                        [str(x) for x in averaged_measurements_buffer_for_OSM['data'][timestamp_msg]]) + ']'
+                    send_msg = osm_frame(averaged_measurements_buffer_for_OSM['data'][timestamp_msg])
 
             finally:
                 averaged_measurements_buffer_for_OSM['is_ready'] = True
@@ -858,23 +1443,19 @@ async def send_avg_measurements_coroutine():
 
                     # send data block
                     try:
-                        await master_connection.send(send_msg)
+                        with stage.busy():
+                            await master_connection.send(send_msg)
                     except websockets.exceptions.ConnectionClosed:
                         logging.info(
                             'No connection while sending data - websockets.exceptions.ConnectionClosed. Zeroing master connection')
                         master_connection = None
                     except Exception as e:
-                        logging.debug(f'Some error during measurements sending to OSM - exception: {e.__doc__}')
+                        pipeline_log.debug(f'Some error during measurements sending to OSM - exception: {e.__doc__}')
                     else:
                         send_msg = 'sent'
 
-                        # успешная отправка увеличивает счетчик
-                        this_function_name = sys._getframe().f_code.co_name
-                        counter_name = this_function_name + '_success_sent'
-                        if counter_name in coroutine_heart_rate:
-                            coroutine_heart_rate[counter_name] += 1
-                        else:
-                            coroutine_heart_rate[counter_name] = 1
+                        # успешно отправленные кадры
+                        stage.add_items(1)
 
                         last_send_time = datetime.datetime.now().timestamp()
 
@@ -916,50 +1497,6 @@ async def save_wls():
         return
 
 
-async def get_one_spectrum(hyperion_x55_async):
-    """
-    Функция получает единичный спектр, используя класс hyperion.AsyncHyperion
-    :param hyperion_x55_async: инициализированный класс hyperion.AsyncHyperion
-    :return:
-    """
-    while True:
-        await asyncio.sleep(asyncio_pause_sec)
-
-        # калибровка спектра (из попугаев в dBm)
-        await hyperion_x55_async.get_power_cal()
-
-        # спектр и пики с прибора
-        spectrum = await hyperion_x55_async.get_spectra()
-        peaks = await hyperion_x55_async.get_peaks()
-        raw_peaks = list()
-
-        spectrum_step_pm = (spectrum.wavelengths[1] - spectrum.wavelengths[0]) * 1000
-
-        # печать спектра
-        if 0:
-            for i in range(len(spectrum.wavelengths)):
-                wl = spectrum.wavelengths[i]
-                power = spectrum.data[channel][i]
-                print(i, wl, power)
-
-        for channel in spectrum.channel_map:
-            peak_indexes, peaks_properties = find_peaks(spectrum.data[channel],
-                                                        distance=peak_distance_pm / spectrum_step_pm,
-                                                        prominence=peak_height_dbm,
-                                                        width=peak_width_pm / spectrum_step_pm)
-
-            # пики по сырому спектру
-            for i in peak_indexes:
-                wl = spectrum.wavelengths[i]
-                power = spectrum.data[channel][i]
-                raw_peaks.append(wl)
-
-        print(datetime.datetime.utcnow(), spectrum.header.timestamp_int + spectrum.header.timestamp_frac * 1E-9,
-              'spectrum', spectrum.header.serial_number, raw_peaks)
-
-        await asyncio.sleep(one_spectrum_interval_sec)
-
-
 '''
 async def clock_sync():
     clock_sync_interval_sec = 3600
@@ -981,52 +1518,337 @@ async def clock_sync():
 '''
 
 
-async def save_spectrum():
-    spectrum_interval_sec = 600
-
-    while not h1:
-        await asyncio.sleep(asyncio_pause_sec)
-    while not await h1.get_is_ready():
-        await asyncio.sleep(asyncio_pause_sec)
-
-    last_spectrum_time = 0
+def process_spectrum(spectra_data, peaks):
+    """ разбор спектра, поиск пиков и запись в архив (выполняется в потоке spectrum_executor, не в цикле событий)
+    :param spectra_data: hyperion.HACQSpectrumData, спектр с прибора
+    :param peaks: hyperion.HACQPeaksData, пики, найденные прибором в момент получения спектра
+    """
+    timestamp = spectra_data.header.timestamp_frac * 1e-9 + spectra_data.header.timestamp_int
+    # в спектре только каналы channel_map (не обязательно все и подряд) - номера каналов берутся из него
+    channels = [int(channel) for channel in spectra_data.channel_map]
+    spectrum_data = np.array([spectra_data.data[channel] for channel in channels])
+
+    # спектр во всех точках, в сжатом двоичном виде (UPK_spectrum_archive.py)
+    record_to_save = encode_spectrum(timestamp, spectra_data.header.serial_number, channels, spectrum_data,
+                                     spectra_data.wavelengths, spectrum_archive_compression)
+    if not disk_writer.write(spectrum_archive_file_name(timestamp), record_to_save,
+                             timeout_sec=disk_writer_thread_timeout_sec):
+        raise OSError('Disk writer queue is full - spectrum is not saved')
+
+    # пики по сырому спектру - сразу по всем каналам
+    peak_channels, peak_wls, peak_powers = find_spectrum_peaks(
+        spectrum_data, spectra_data.wavelengths, distance_pm=peak_distance_pm, prominence_db=peak_height_dbm,
+        width_pm=peak_width_pm, refine=peak_refine, channels=channels)
+    raw_peaks = peaks_by_channel(peak_channels, peak_wls)
+
+    logging.info(f'Got spectrum {spectra_data.header.serial_number} at {timestamp}, {len(record_to_save)} bytes, '
+                 f'{len(peak_wls)} peaks')
+
+    # сравнение с пиками, найденными прибором
+    instrument_peaks = peaks_by_channel_from_packet(peaks)
+    for channel, wls in instrument_peaks.items():
+        if not len(wls) and channel not in raw_peaks:
+            continue
+        deviations_pm = match_peaks(wls, raw_peaks.get(channel, []), peak_match_tolerance_pm)
+        matched = deviations_pm[~np.isnan(deviations_pm)]
+        max_deviation_pm = np.abs(matched).max() if len(matched) else float('nan')
+        logging.info(f'Spectrum channel {channel}: {len(raw_peaks.get(channel, []))} peaks, '
+                     f'{len(matched)} of {len(wls)} instrument peaks matched, '
+                     f'max deviation {max_deviation_pm:.1f} pm')
+
+
+async def spectrum_coroutine(instrument):
+    """ периодическое получение спектра прибора; в цикле событий - только запросы к прибору, обработка спектра
+    выполняется в потоке spectrum_executor и не задерживает прием пиков и отправку измерений
+    """
+    next_spectrum_time = datetime.datetime.now().timestamp()
+    stage = register_stage('spectrum_coroutine')
     try:
         while True:
             await asyncio.sleep(asyncio_pause_sec)
+            stage.iteration()
+
             cur_time = datetime.datetime.now().timestamp()
+            if cur_time < next_spectrum_time:
+                continue
 
-            if await h1.get_is_ready() and cur_time - last_spectrum_time > spectrum_interval_sec:
-                try:
-                    # калибровка спектра (из попугаев в dBm)
-                    await h1.get_power_cal()
+            # интервалы, пропущенные из-за долгого получения или обработки предыдущего спектра
+            skipped_intervals = int((cur_time - next_spectrum_time) // spectrum_interval_sec)
+            spectrum_metrics['skipped'] += skipped_intervals
+            next_spectrum_time += (skipped_intervals + 1) * spectrum_interval_sec
 
+            h1 = instrument.h1
+            try:
+                if not h1 or not await h1.get_is_ready():
+                    spectrum_metrics['skipped'] += 1
+                    continue
+
+                with stage.busy():
+                    # калибровка спектра (из попугаев в dBm), спектр и пики с прибора
+                    capture_start_time = datetime.datetime.now().timestamp()
+                    await h1.get_power_cal()
                     spectra_data = await h1.get_spectra()
-                except Exception as e:
-                    logging.error(f'Some error in h1.get_spectra() - exception: {e.__doc__}')
+                    peaks = await h1.get_peaks()
+                    processing_start_time = datetime.datetime.now().timestamp()
+                    spectrum_metrics['capture_sec'] = max(spectrum_metrics['capture_sec'],
+                                                          processing_start_time - capture_start_time)
+
+                    await loop.run_in_executor(spectrum_executor, process_spectrum, spectra_data, peaks)
+                    spectrum_metrics['processing_sec'] = max(spectrum_metrics['processing_sec'],
+                                                             datetime.datetime.now().timestamp() - processing_start_time)
+                    spectrum_metrics['captured'] += 1
+                stage.add_items(1)
+            except Exception as e:
+                spectrum_metrics['failed'] += 1
+                pipeline_log.error(f'Some error during spectrum getting from {instrument} - exception: {e.__doc__}')
+    finally:
+        msg = f'spectrum_coroutine is finishing for {instrument}'
+        print(msg)
+        logging.critical(msg)
+
 
+async def columnar_archive_coroutine():
+    """ перевод закрытых часовых файлов в суточный столбцовый архив (в потоке columnar_executor) """
+    stage = register_stage('columnar_archive_coroutine')
+    try:
+        while True:
+            await asyncio.sleep(columnar_archive_check_sec)
+            stage.iteration()
+
+            hour_files = await loop.run_in_executor(columnar_executor, pending_hour_files, '.', None,
+                                                    columnar_archive_grace_sec)
+            for hour_file in hour_files:
+                if hour_file.name in columnar_failed_files:
+                    continue
                 try:
-                    timestamp = spectra_data.header.timestamp_frac * 1e-9 + spectra_data.header.timestamp_int
-                    str_to_save = ''
+                    with stage.busy():
+                        rows_num = await loop.run_in_executor(columnar_executor, convert_hour_file, hour_file, '.')
+                except Exception as e:
+                    columnar_failed_files.add(hour_file.name)
+                    logging.error(f'Some error during columnar archive conversion - file: {hour_file.name}; '
+                                  f'exception: {e}')
+                else:
+                    logging.info(f'{hour_file.name} converted to columnar archive, {rows_num} rows')
+                    stage.add_items(1)
+    finally:
+        send_msg = 'Function columnar_archive_coroutine is finished'
+        print(send_msg)
+        logging.critical(send_msg)
 
-                    for channel in spectra_data.channel_map:
-                        str_to_save = f'{str_to_save}{timestamp}\t{channel}\t' + '\t'.join(
-                            ['%.2f' % pwr for pwr in spectra_data.data[channel]][::4]) + '\n'
+        # restart current coroutine
+        loop.create_task(columnar_archive_coroutine())
 
-                    data_arch_file_name = datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H_spectra.txt')
-                    with open(data_arch_file_name, 'a') as f:
-                        f.write(str_to_save)
 
-                    logging.info(f'Got spectrum at {timestamp} {len(str_to_save)} bytes')
-                    last_spectrum_time = cur_time
+async def memory_budget_coroutine():
+    """ контроль общего бюджета памяти буферов """
+    try:
+        while True:
+            await asyncio.sleep(memory_check_interval_sec)
+
+            freed_bytes = memory_budget.enforce()
+            if freed_bytes:
+                pipeline_log.warning(f'Memory budget {memory_budget_mb} MB exceeded - {freed_bytes} bytes released')
+    finally:
+        send_msg = 'Function memory_budget_coroutine is finished'
+        print(send_msg)
+        logging.critical(send_msg)
+
+        # restart current coroutine
+        loop.create_task(memory_budget_coroutine())
+
+
+async def instrument_retry_coroutine():
+    """ повторное подключение к приборам задания, которые не удалось запустить """
+    try:
+        while True:
+            await asyncio.sleep(instrument_retry_sec)
+            await start_instruments()
+    finally:
+        send_msg = 'Function instrument_retry_coroutine is finished'
+        print(send_msg)
+        logging.critical(send_msg)
+
+        # restart current coroutine
+        loop.create_task(instrument_retry_coroutine())
+
+
+async def load_shedding_coroutine():
+    """ уровень снижения нагрузки по отставанию пересчета от получения измерений """
+    try:
+        while True:
+            await asyncio.sleep(load_shedding_check_sec)
+
+            # отставание по часам приборов; приборы, у которых еще нет пересчитанных измерений, не учитываются
+            lags = [instrument.last_received_time - instrument.last_measurement_time for instrument in instruments
+                    if instrument.last_measurement_time]
+            load_shedder.update(max(lags + [0.0]))
+    finally:
+        send_msg = 'Function load_shedding_coroutine is finished'
+        print(send_msg)
+        logging.critical(send_msg)
+
+        # restart current coroutine
+        loop.create_task(load_shedding_coroutine())
+
+
+def pipeline_state():
+    """ состояние конвейера для контрольной точки (UPK_checkpoint.py) """
+    compiled_devices = list()
+    for instrument in instruments:
+        compiled = cached_compiled(instrument.devices_digest)
+        if compiled is None:
+            compiled = CompiledDevices(instrument.devices_digest, instrument.devices, instrument.coefficients)
+        compiled_devices.append(compiled)
+
+    # неусредненные измерения только открытого блока (блока последнего измерения)
+    measurements = measurements_buffer['data']
+    if len(measurements):
+        last_time = measurements['Time'].max()
+        measurements = measurements.loc[measurements['Time'] >= last_time - last_time % data_averaging_interval_sec]
+
+    # не отправленные записи - в журнале (unsent_journal_records()), здесь только время самой старой из них в памяти
+    unsent = averaged_measurements_buffer_for_OSM['data']
+
+    return {
+        'description': canonical_description(instrument_description),
+        'compiled_devices': compiled_devices,
+        'instruments': dict((instrument.ip, {
+            't_recommended': instrument.t_recommended,
+            't_by_channels': dict((partition.channels, partition.t_recommended) for partition in instrument.partitions)
+        }) for instrument in instruments),
+        'measurements': measurements,
+        'aggregator': aggregator.state() if aggregator is not None else None,
+        'rollup_aggregator': rollup_aggregator.state() if rollup_aggregator is not None else None,
+        'unsent_from': next(iter(unsent)) if unsent else math.inf,
+    }
+
+
+def unsent_journal_records(journal_from, journal_to, journal_num):
+    """ записи буфера для ОСМ, которые нужно записать в журнал не отправленных записей (UPK_checkpoint.py)
+    :param journal_from: float(), время самой старой записи журнала (math.inf - журнал пуст)
+    :param journal_to: float(), время самой новой записи журнала, None - журнал нужно записать заново
+    :param journal_num: int(), количество записей в журнале
+    :return: (mode, records) - MODE_APPEND и новые записи или MODE_REPLACE и все записи буфера в памяти
+    """
+    data = averaged_measurements_buffer_for_OSM['data']
+    keys = list(data)
+
+    # записи, подгруженные из файла выгрузки (старше журнала), или время назад - журнал записывается заново
+    if journal_to is not None and (not keys or ((not journal_num or keys[0] >= journal_from) and
+                                                keys[-1] >= journal_to)):
+        journaled = bisect.bisect_right(keys, journal_to)
+        # журнал переписывается, когда отправленных записей в нем больше, чем не отправленных
+        if journal_num - journaled <= max(journaled, checkpoint_journal_min_sent):
+            return MODE_APPEND, [(key, data[key]) for key in keys[journaled:]]
+    return MODE_REPLACE, list(data.items())
+
+
+def restore_pipeline_state(checkpoint):
+    """ восстановление состояния конвейера из контрольной точки (после применения задания, до запуска потоков пиков) """
+    global measurements_buffer
+
+    if checkpoint['description'] != canonical_description(instrument_description):
+        logging.info('Checkpoint was saved with another instrument description - pipeline state is not restored')
+        return
+
+    # не отправленные на ОСМ записи (записи, отправленные после сохранения контрольной точки, отправятся повторно)
+    unsent_num = 0
+    for timestamp, avg_line in checkpoint['unsent']:
+        if timestamp not in averaged_measurements_buffer_for_OSM['data'] and \
+                buffer_put(averaged_measurements_buffer_for_OSM, timestamp, avg_line):
+            unsent_num += 1
+
+    age_sec = checkpoint_age_sec(checkpoint)
+    if age_sec > checkpoint_max_age_sec:
+        logging.info(f'Checkpoint is {age_sec:.0f} s old - {unsent_num} unsent records restored, '
+                     f'averaging and tracking state is not restored')
+        return
+
+    # рекомендованные температуры приборов и разделов пересчета
+    for instrument in instruments:
+        instrument_state = checkpoint['instruments'].get(instrument.ip)
+        if instrument_state is None:
+            continue
+        instrument.t_recommended = instrument_state['t_recommended']
+        for partition in instrument.partitions:
+            partition.t_recommended = instrument_state['t_by_channels'].get(partition.channels)
+
+    # неусредненные измерения открытого блока
+    saved_measurements = checkpoint['measurements']
+    if list(saved_measurements.columns) == list(measurements_buffer['data'].columns):
+        measurements_buffer['data'] = pd.concat([saved_measurements, measurements_buffer['data']], ignore_index=True)
+    else:
+        saved_measurements = saved_measurements.iloc[:0]
+
+    # открытые блоки старших уровней усреднения
+    for level_aggregator, level_state in ((aggregator, checkpoint['aggregator']),
+                                          (rollup_aggregator, checkpoint['rollup_aggregator'])):
+        if level_aggregator is None or level_state is None:
+            continue
+        try:
+            level_aggregator.restore(level_state)
+        except ValueError as e:
+            logging.info(f'Averaging levels are not restored from checkpoint - {e}')
+
+    logging.info(f'Pipeline state restored from checkpoint saved {age_sec:.0f} s ago: {unsent_num} unsent records, '
+                 f'{len(saved_measurements)} measurements of the open block')
+
+
+async def checkpoint_coroutine():
+    """ периодическое сохранение контрольной точки состояния конвейера """
+    stage = register_stage('checkpoint_coroutine')
+    checkpoint_written = None  # threading.Event(), запись последней контрольной точки выполнена
+    # журнал не отправленных записей: время самой старой и самой новой записи и количество записей
+    # (после перезапуска корутины журнал записывается заново)
+    journal_from, journal_to, journal_num = math.inf, None, 0
+    try:
+        while True:
+            await asyncio.sleep(checkpoint_interval_sec)
+            stage.iteration()
+
+            # нет задания или контрольная точка, загруженная при запуске, еще не восстановлена - не перезаписываем ее
+            if not instruments or pending_checkpoint is not None:
+                continue
+
+            # предыдущая контрольная точка еще в очереди записи - новая не ставится
+            if checkpoint_written is not None and not checkpoint_written.is_set():
+                continue
+
+            with stage.busy():
+                try:
+                    # снимок состояния делается без ожиданий - корутины не меняют буферы во время его записи
+                    mode, records = unsent_journal_records(journal_from, journal_to, journal_num)
+                    journal = unsent_bytes(records)
+                    data = checkpoint_bytes(pipeline_state())
                 except Exception as e:
-                    logging.error(f'Some error in h1.save_spectrum() - exception: {e.__doc__}')
+                    pipeline_log.error(f'Some error during checkpoint making - exception: {e}')
+                    continue
+
+                # журнал - до контрольной точки (поток записи выполняет записи по порядку)
+                if records or mode == MODE_REPLACE:
+                    if not disk_writer.write(unsent_file_name, journal, mode):
+                        pipeline_log.error('Disk writer queue is full - checkpoint is not saved')
+                        continue
+                    if mode == MODE_REPLACE:
+                        journal_from, journal_to, journal_num = math.inf, -math.inf, 0
+                    if records:
+                        journal_from = min(journal_from, records[0][0])
+                        journal_to = records[-1][0]
+                        journal_num += len(records)
+
+                checkpoint_written = threading.Event()
+                if not disk_writer.write(checkpoint_file_name, data, MODE_REPLACE, done_event=checkpoint_written):
+                    checkpoint_written = None
+                    pipeline_log.error('Disk writer queue is full - checkpoint is not saved')
+                    continue
+            stage.add_items(1)
     finally:
-        send_msg = 'Function save_spectrum is finished'
+        send_msg = 'Function checkpoint_coroutine is finished'
         print(send_msg)
         logging.critical(send_msg)
 
         # restart current coroutine
-        loop.create_task(save_spectrum())
+        loop.create_task(checkpoint_coroutine())
 
 
 async def heart_rate():
@@ -1034,20 +1856,40 @@ async def heart_rate():
     delimiter = ' '
     # await asyncio.sleep(heart_rate_timeout_sec)
 
-    try:
-        out_str = f'heart_rate_order: connection {delimiter.join([str(x) for x in coroutine_heart_rate.keys()])}' + delimiter
+    def heart_rate_order():
+        """ порядок значений в строках heart_rate (выводится заново при регистрации новых стадий) """
+        out_str = 'heart_rate_order: connection' + delimiter
+        out_str += ''.join([f'{name}{delimiter}{name}_items{delimiter}{name}_busy_pct{delimiter}{name}_idle_pct{delimiter}'
+                            for name in stages])
         buffers_names = ['wavelengths_buffer', 'measurements_buffer', 'averaged_measurements_buffer_for_OSM',
                          'averaged_measurements_buffer_for_disk', 'wls_buffer_for_saving']
         out_str += delimiter.join(buffers_names) + delimiter
+        out_str += 'overflow_wavelengths_buffer lost_wavelengths_buffer' + delimiter
+        out_str += delimiter.join([f'overflow_{buffer["name"]} lost_{buffer["name"]}'
+                                   for buffer in bounded_buffers]) + delimiter + 'memory_used_mb' + delimiter
+        out_str += 'spectra_captured spectra_skipped spectra_failed spectrum_capture_ms spectrum_processing_ms' + delimiter
+        out_str += delimiter.join([f'peak_batches_{bucket}' for bucket in peak_batch_buckets]) + delimiter + \
+            'peak_batch_max' + delimiter
+        out_str += 'disk_queue_depth disk_queue_max_depth disk_writes disk_write_failed disk_write_rejected ' \
+                   'disk_write_max_ms disk_write_latency_max_ms' + delimiter + 'log_dropped' + delimiter
+        out_str += 'shed_level shed_max_level lag_ms lag_max_ms shed_wls shed_raw shed_samples' + delimiter + \
+            'ring_dropped'
         print(out_str)
         logging.info(out_str)
 
+    try:
+        stages_num = len(stages)
+        heart_rate_order()
+
         last_check_time = 0
         while True:
             await asyncio.sleep(asyncio_pause_sec)
 
             cur_time = datetime.datetime.now().timestamp()
             if cur_time - last_check_time > heart_rate_timeout_sec:
+                if len(stages) != stages_num:
+                    stages_num = len(stages)
+                    heart_rate_order()
 
                 last_check_time = cur_time
                 out_str = 'heart_rate: '
@@ -1056,17 +1898,71 @@ async def heart_rate():
                 else:
                     out_str += '0 '
 
-                for key in coroutine_heart_rate:
-                    out_str += str(coroutine_heart_rate[key]) + delimiter
-                    coroutine_heart_rate[key] = 0
+                # стадии: итерации, элементы, доля времени работы и простоя за период, %
+                for stage in list(stages.values()):
+                    iterations, items, busy_sec, idle_sec, period_sec = stage.collect()
+                    period_sec = max(period_sec, 1E-9)
+                    out_str += f'{iterations}{delimiter}{items}{delimiter}{100 * busy_sec / period_sec:.1f}{delimiter}' \
+                               f'{100 * idle_sec / period_sec:.1f}{delimiter}'
 
                 out_str = out_str.rstrip() + delimiter + \
-                          str(len(wavelengths_buffer['data'])) + delimiter + \
+                          str(sum([len(instrument.wavelengths_buffer['data']) for instrument in instruments])) + \
+                          delimiter + \
                           str(len(measurements_buffer['data'])) + delimiter + \
                           str(len(averaged_measurements_buffer_for_OSM['data'])) + delimiter + \
                           str(len(averaged_measurements_buffer_for_disk['data'])) + delimiter + \
                           str(len(wls_buffer_for_saving['data'])) + delimiter
 
+                wavelengths_buffers = [instrument.wavelengths_buffer for instrument in instruments]
+                out_str += str(sum([buffer['overflow_count'] for buffer in wavelengths_buffers])) + delimiter + \
+                    str(sum([buffer['lost_count'] for buffer in wavelengths_buffers])) + delimiter
+                for buffer in bounded_buffers:
+                    out_str += f'{buffer["overflow_count"]}{delimiter}{buffer["lost_count"]}{delimiter}'
+                for buffer in wavelengths_buffers + bounded_buffers:
+                    buffer['overflow_count'] = 0
+                    buffer['lost_count'] = 0
+                out_str += '%.1f' % (memory_budget.used_bytes() / 1024 / 1024) + delimiter
+
+                # спектры: количество за период и наибольшая длительность получения и обработки
+                out_str += f'{spectrum_metrics["captured"]}{delimiter}{spectrum_metrics["skipped"]}{delimiter}' \
+                           f'{spectrum_metrics["failed"]}{delimiter}' \
+                           f'{spectrum_metrics["capture_sec"] * 1000:.0f}{delimiter}' \
+                           f'{spectrum_metrics["processing_sec"] * 1000:.0f}'
+                for key in spectrum_metrics:
+                    spectrum_metrics[key] = 0
+
+                # гистограмма размеров пачек пакетов пиков (все приборы) и наибольшая пачка
+                peak_batch_counts = [sum(counts) for counts in
+                                     zip(*[instrument.peak_batch_counts for instrument in instruments])] or \
+                    [0] * len(peak_batch_buckets)
+                out_str += delimiter + delimiter.join([str(count) for count in peak_batch_counts]) + delimiter + \
+                    str(max([instrument.peak_batch_max for instrument in instruments] + [0]))
+                for instrument in instruments:
+                    instrument.reset_peak_batches()
+
+                # поток записи на диск: очередь, записи и наибольшие длительность записи и задержка, мс
+                disk_metrics = disk_writer.collect_metrics()
+                out_str += delimiter + delimiter.join([str(disk_metrics[key]) for key in (
+                    'depth', 'max_depth', 'writes', 'failed', 'rejected')]) + delimiter + \
+                    f'{disk_metrics["max_write_ms"]:.1f}{delimiter}{disk_metrics["max_latency_ms"]:.1f}'
+
+                # записи журнала, отброшенные при заполненной очереди, и итоги по подавленным ошибкам конвейера
+                if log_queue_handler is not None:
+                    out_str += f'{delimiter}{log_queue_handler.dropped}'
+                    log_queue_handler.dropped = 0
+                pipeline_rate_limit.report_suppressed(pipeline_log)
+
+                # снижение нагрузки: уровень (текущий и наибольший), отставание, мс, отброшенные записи и измерения
+                shedding_metrics = load_shedder.collect_metrics()
+                out_str += delimiter + delimiter.join([str(shedding_metrics[key]) for key in (
+                    'level', 'max_level')]) + delimiter + \
+                    f'{shedding_metrics["lag_ms"]:.0f}{delimiter}{shedding_metrics["max_lag_ms"]:.0f}{delimiter}' + \
+                    delimiter.join([str(shedding_metrics[key]) for key in ('shed_wls', 'shed_raw', 'shed_samples')])
+
+                # записи, отброшенные процессами получения данных при заполненном буфере в разделяемой памяти
+                out_str += delimiter + str(sum([instrument.ring.collect_dropped() for instrument in instruments
+                                                if instrument.ring is not None]))
+
                 print(out_str)
                 logging.info(out_str)
     finally:
@@ -1079,9 +1975,13 @@ async def heart_rate():
 
 
 if __name__ == "__main__":
+    # пул процессов пересчета в exe-файле PyInstaller
+    multiprocessing.freeze_support()
+
     log_file_name = datetime.datetime.now().strftime('UPK_server_2019_%Y%m%d%H%M%S.log')
-    logging.basicConfig(format=u'%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s',
-                        level=logging.DEBUG, filename=log_file_name)
+    log_dir = str(Path(log_file_name).absolute().parent)
+    log_queue_handler, _ = setup_logging(log_file_name, level=logging.DEBUG, max_bytes=log_max_mb * 1024 * 1024,
+                                         backup_count=log_backup_count, error_interval_sec=log_error_interval_sec)
 
     logging.info(u'Program starts v.20200329')
 
@@ -1094,18 +1994,51 @@ if __name__ == "__main__":
         print('Restart program with two arguments (address and port, space is delimiter)')
         exit(0)
 
+    # необязательные ключи запуска
+    for option in sys.argv[3:]:
+        if option == '--uvloop':
+            new_loop = install_uvloop()
+            if new_loop:
+                loop = new_loop
+                logging.info('uvloop event loop is installed')
+        elif option.startswith('--spectrum-interval='):
+            try:
+                spectrum_interval_sec = float(option[len('--spectrum-interval='):])
+            except ValueError:
+                logging.error(f'Wrong spectrum interval {option}')
+            logging.info(f'Spectrum interval is {spectrum_interval_sec} sec')
+        elif option.startswith('--json='):
+            try:
+                codec = get_codec(option[len('--json='):])
+            except ValueError as e:
+                logging.error(str(e))
+            logging.info(f'JSON codec {codec.name} is used')
+
+    if '--acquisition-process' in sys.argv[3:]:
+        if shared_memory is None:
+            logging.error('Acquisition process needs python 3.8+ (multiprocessing.shared_memory), option ignored')
+        else:
+            acquisition_in_separate_process = True
+            logging.info('Acquisition and conversion run in a separate process for each instrument')
+
     # связь с сервером, получение описания прибора
     loop.run_until_complete(websockets.serve(connection_handler, address, port, ping_interval=None, ping_timeout=30))
     logging.info('Server {} has been started'.format((address, port)))
 
+    # поток записи на диск
+    disk_writer.start()
+
     # метрики работы функций
     loop.create_task(heart_rate())
 
-    # получение длин волн от x55 c исходной частотой (складирование в буффер в памяти)
-    loop.create_task(get_wls_from_x55_coroutine())
+    # контроль памяти, занимаемой буферами
+    loop.create_task(memory_budget_coroutine())
+
+    # получение длин волн от x55 и их пересчет в измерения запускаются для каждого прибора в instrument_start()
 
-    # получение пересчет длин волн в измерения
-    loop.create_task(wls_to_measurements_coroutine())
+    # повторное подключение к приборам, которые не удалось запустить
+    if instrument_retry_sec:
+        loop.create_task(instrument_retry_coroutine())
 
     # усреднение измерений
     loop.create_task(averaging_measurements_coroutine())
@@ -1116,17 +2049,36 @@ if __name__ == "__main__":
     # запись усредненных измерений на диск
     loop.create_task(save_measurements_coroutine(averaged_measurements_buffer_for_disk, file_type='avg'))
 
+    # запись старших уровней усреднения на диск
+    for interval_sec, level_buffer in level_buffers_for_disk.items():
+        loop.create_task(save_measurements_coroutine(level_buffer, file_type=f'avg{interval_sec:g}'))
+
     # запись неусредненных измерений F1, F2 на диск
     loop.create_task(save_measurements_coroutine(raw_measurements_buffer_for_disk, file_type='raw'))
 
     # запись длин волн на диск
     loop.create_task(save_measurements_coroutine(wls_buffer_for_disk, file_type='wls'))
 
+    # перевод закрытых часовых файлов в суточный столбцовый архив
+    if columnar_archive_check_sec:
+        loop.create_task(columnar_archive_coroutine())
+
+    # снижение нагрузки при отставании обработки
+    if load_shedding_lag_sec:
+        loop.create_task(load_shedding_coroutine())
+
+    # контрольные точки: собранные устройства - в кэш сборки сразу, остальное состояние восстанавливается
+    # при применении задания
+    if checkpoint_interval_sec:
+        pending_checkpoint = load_checkpoint(checkpoint_file_name)
+        if pending_checkpoint is not None:
+            preload_compiled(pending_checkpoint['compiled_devices'])
+        loop.create_task(checkpoint_coroutine())
+
     # x55 clock syncronization
     # loop.create_task(clock_sync())
 
-    # saving spectrum
-    # loop.create_task(save_spectrum())
+    # получение спектров запускается для каждого прибора в instrument_start() (если задан spectrum_interval_sec)
 
     # если есть задание на диске, то загрузим его и начнем работать до получения нового задания
     if Path(instrument_description_filename).is_file():
@@ -1134,7 +2086,7 @@ if __name__ == "__main__":
         logging.info('Found instrument description file')
         try:
             with open(instrument_description_filename, 'r') as f:
-                instrument_description = json.load(f)
+                instrument_description = codec.loads(f.read())
         except Exception as e:
             logging.debug(f'Some error during instrument decsription file reading; exception: {e.__doc__}')
         else:
@@ -7,7 +7,7 @@ a = Analysis(['UPK_server_2019.py'],
              pathex=['C:\\Users\\admin\\PycharmProjects\\UPK_soft'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=['numpy', 'pandas', 'hyperion'],  # загружаются через UPK_lazy.lazy_import()
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
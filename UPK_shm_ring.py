@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Кольцевой буфер записей в разделяемой памяти (multiprocessing.shared_memory, python 3.8+)
+#
+# Один писатель (процесс получения и пересчета данных прибора) и один читатель (основной процесс УПК), без блокировок:
+# писатель меняет только индекс записи, читатель - только индекс чтения. Индексы - счетчики записанных/прочитанных
+# записей (не по модулю размера буфера), поэтому заполненность буфера равна разности индексов.
+# Данные записи копируются в слот до публикации нового индекса записи, а индекс чтения сдвигается только после
+# копирования записей читателем. Запись 8-байтного выровненного индекса атомарна на x86/x64.
+
+from UPK_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python 3.7 - работа через разделяемую память недоступна
+    shared_memory = None
+
+HEADER_SIZE = 128  # байт; индексы записи и чтения разнесены по разным кэш-линиям
+WRITE_INDEX = 0
+SLOTS = 1
+RECORD_WIDTH = 2
+DROPPED_COUNT = 3  # записи, не поместившиеся в буфер, всего (пишет писатель)
+READ_INDEX = 8
+
+
+class ShmRingBuffer:
+
+    def __init__(self, name=None, slots=0, record_width=0):
+        """
+        :param name: str(), имя существующего сегмента разделяемой памяти (для подключения), None - создать новый
+        :param slots: int(), количество записей в буфере (только при создании)
+        :param record_width: int(), количество чисел float64 в записи (только при создании)
+        """
+        if shared_memory is None:
+            raise RuntimeError('multiprocessing.shared_memory is not available (python 3.8+ required)')
+
+        self.is_owner = name is None
+        if self.is_owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + slots * record_width * 8)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self._index = np.ndarray((HEADER_SIZE // 8,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.is_owner:
+            self._index[:] = 0
+            self._index[SLOTS] = slots
+            self._index[RECORD_WIDTH] = record_width
+
+        self.slots = int(self._index[SLOTS])
+        self.record_width = int(self._index[RECORD_WIDTH])
+        self._data = np.ndarray((self.slots, self.record_width), dtype=np.float64, buffer=self.shm.buf,
+                                offset=HEADER_SIZE)
+        self.dropped_count = 0  # записи, не поместившиеся в буфер (считает писатель, копия в заголовке буфера)
+        self._reported_dropped = 0  # отброшенные записи, уже выданные читателю collect_dropped()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __len__(self):
+        return int(self._index[WRITE_INDEX]) - int(self._index[READ_INDEX])
+
+    def write(self, rows):
+        """ запись (только писатель); при заполненном буфере лишние записи отбрасываются
+        :param rows: np.ndarray(), shape (n, record_width)
+        :return: int(), количество записанных записей
+        """
+        write_index = int(self._index[WRITE_INDEX])
+        free_slots = self.slots - (write_index - int(self._index[READ_INDEX]))
+        n = min(len(rows), free_slots)
+        if n < len(rows):
+            self.dropped_count += len(rows) - n
+            self._index[DROPPED_COUNT] = self.dropped_count
+        if n <= 0:
+            return 0
+
+        pos = write_index % self.slots
+        first_part = min(n, self.slots - pos)
+        self._data[pos:pos + first_part] = rows[:first_part]
+        self._data[:n - first_part] = rows[first_part:n]
+
+        # публикация записей - строго после копирования данных
+        self._index[WRITE_INDEX] = write_index + n
+        return n
+
+    def read(self, max_rows=None):
+        """ чтение (только читатель)
+        :param max_rows: int(), максимальное количество записей
+        :return: np.ndarray(), копия прочитанных записей, shape (n, record_width)
+        """
+        read_index = int(self._index[READ_INDEX])
+        n = int(self._index[WRITE_INDEX]) - read_index
+        if max_rows is not None:
+            n = min(n, max_rows)
+        if n <= 0:
+            return np.empty((0, self.record_width))
+
+        pos = read_index % self.slots
+        first_part = min(n, self.slots - pos)
+        rows = np.concatenate((self._data[pos:pos + first_part], self._data[:n - first_part]))
+
+        # слоты освобождаются только после копирования
+        self._index[READ_INDEX] = read_index + n
+        return rows
+
+    def collect_dropped(self):
+        """ записи, отброшенные писателем с прошлого вызова (только читатель) """
+        dropped = int(self._index[DROPPED_COUNT])
+        count = dropped - self._reported_dropped
+        self._reported_dropped = dropped
+        return count
+
+    def close(self):
+        # numpy-представления должны быть удалены до закрытия сегмента
+        del self._index
+        del self._data
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
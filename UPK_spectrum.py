@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Поиск пиков во всех каналах спектра x55 одновременно (numpy)
+#
+# Вместо вызова scipy.signal.find_peaks для каждого канала спектр обрабатывается как двумерный массив
+# (каналы x точки): кандидаты в пики, их высота над основанием (prominence) и ширина на половине высоты вычисляются
+# сразу для всех каналов. Положение пика уточняется внутри шага спектра - по трем точкам (гауссова форма пика,
+# в dB это парабола) или по центру тяжести мощности выше половины высоты пика.
+#
+# Критерии отбора совпадают по смыслу с find_peaks(distance=, prominence=, width=), но основание пика ищется
+# не дальше distance_pm от его вершины.
+
+from UPK_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+REFINE_NONE = 'none'  # длина волны точки спектра с максимальной мощностью
+REFINE_GAUSS = 'gauss'  # вершина параболы по трем точкам вокруг максимума (в dB)
+REFINE_CENTROID = 'centroid'  # центр тяжести мощности (мВт) точек выше половины высоты пика
+refine_methods = (REFINE_NONE, REFINE_GAUSS, REFINE_CENTROID)
+
+candidates_chunk_size = 4096  # количество кандидатов, обрабатываемых одной операцией (ограничивает объем памяти)
+
+
+def find_spectrum_peaks(data, wavelengths, distance_pm=1000, prominence_db=3, width_pm=(100, 600),
+                        refine=REFINE_GAUSS, channels=None):
+    """ поиск пиков во всех каналах спектра
+    :param data: np.ndarray(), мощность, dBm, shape (количество каналов, количество точек)
+    :param wavelengths: np.ndarray(), длины волн точек спектра (равномерная сетка), нм
+    :param distance_pm: float(), минимальное расстояние между соседними пиками канала, пм
+    :param prominence_db: float(), минимальная высота пика над основанием, dB
+    :param width_pm: [float(), float()], допустимая ширина пика на половине высоты, пм
+    :param refine: str(), способ уточнения положения пика (REFINE_NONE, REFINE_GAUSS, REFINE_CENTROID)
+    :param channels: list(), номера каналов для строк data; по умолчанию 1, 2, ...
+    :return: (channels, wavelengths, powers) - np.ndarray() одинаковой длины, пики упорядочены по каналу
+        и длине волны; длины волн в нм, мощность в вершине пика в dBm
+    """
+    if refine not in refine_methods:
+        raise ValueError(f'Unexpected peak refine method {refine}, expected one of {refine_methods}')
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data[np.newaxis, :]
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if channels is None:
+        channels = np.arange(1, len(data) + 1)
+    channels = np.asarray(channels)
+
+    points_num = data.shape[1]
+    step_pm = (wavelengths[-1] - wavelengths[0]) / (points_num - 1) * 1000
+    distance = max(1, int(round(distance_pm / step_pm)))
+    width_min, width_max = width_pm[0] / step_pm, width_pm[1] / step_pm
+
+    # шаг 1 - кандидаты: локальные максимумы, поднимающиеся над минимумом окрестности +-distance
+    # не меньше чем на prominence_db (шум у основания спектра отсекается сразу)
+    is_candidate = data - _neighbourhood_min(data, distance) >= prominence_db
+    is_candidate[:, 1:-1] &= (data[:, 1:-1] > data[:, :-2]) & (data[:, 1:-1] >= data[:, 2:])
+    is_candidate[:, [0, -1]] = False
+    rows, indexes = np.nonzero(is_candidate)
+
+    # шаг 2 - высота над основанием и ширина, порциями кандидатов
+    prominences = np.empty(len(rows))
+    half_widths = np.empty((len(rows), 2))
+    for start in range(0, len(rows), candidates_chunk_size):
+        chunk = slice(start, start + candidates_chunk_size)
+        prominences[chunk], half_widths[chunk] = _prominences_and_half_widths(data, rows[chunk], indexes[chunk],
+                                                                              distance)
+    widths = half_widths.sum(axis=1)
+
+    selected = (prominences >= prominence_db) & (widths >= width_min) & (widths <= width_max)
+    rows, indexes = rows[selected], indexes[selected]
+    prominences, half_widths = prominences[selected], half_widths[selected]
+
+    # шаг 3 - минимальное расстояние: из близких пиков канала остается самый высокий
+    kept = _apply_distance(rows, indexes, data[rows, indexes], distance)
+    rows, indexes = rows[kept], indexes[kept]
+    prominences, half_widths = prominences[kept], half_widths[kept]
+
+    # шаг 4 - уточнение положения внутри шага спектра
+    if refine == REFINE_GAUSS:
+        positions = indexes + _parabolic_offsets(data, rows, indexes)
+    elif refine == REFINE_CENTROID:
+        positions = indexes + _centroid_offsets(data, rows, indexes, prominences, half_widths)
+    else:
+        positions = indexes.astype(float)
+
+    order = np.lexsort((positions, rows))
+    rows, indexes, positions = rows[order], indexes[order], positions[order]
+    peak_wavelengths = np.interp(positions, np.arange(points_num), wavelengths)
+    return channels[rows], peak_wavelengths, data[rows, indexes]
+
+
+def _neighbourhood_min(data, radius):
+    """ нижняя оценка минимума в окне +-radius вокруг каждой точки каждого канала: минимум по блокам длиной radius,
+    затем по соседним блокам (окно блоков шире +-radius, поэтому минимум не больше точного)
+    """
+    channels_num, points_num = data.shape
+    blocks_num = -(-points_num // radius)
+    padded = np.full((channels_num, blocks_num * radius), np.inf)
+    padded[:, :points_num] = data
+
+    blocks_min = padded.reshape(channels_num, blocks_num, radius).min(axis=2)
+    neighbours_min = blocks_min.copy()
+    np.minimum(neighbours_min[:, 1:], blocks_min[:, :-1], out=neighbours_min[:, 1:])
+    np.minimum(neighbours_min[:, :-1], blocks_min[:, 1:], out=neighbours_min[:, :-1])
+    return np.repeat(neighbours_min, radius, axis=1)[:, :points_num]
+
+
+def _outward_windows(data, rows, indexes, distance):
+    """ точки спектра от вершины пика наружу (столбец 0 - вершина), за краем спектра - NaN
+    :return: (left, right), shape (количество пиков, distance + 1)
+    """
+    points_num = data.shape[1]
+    steps = np.arange(distance + 1)
+    windows = list()
+    for direction in (-1, 1):
+        positions = indexes[:, np.newaxis] + direction * steps
+        outside = (positions < 0) | (positions >= points_num)
+        window = data[rows[:, np.newaxis], np.clip(positions, 0, points_num - 1)]
+        window[outside] = np.nan
+        windows.append(window)
+    return windows
+
+
+def _prominences_and_half_widths(data, rows, indexes, distance):
+    """ высота пиков над основанием и ширина слева/справа на половине этой высоты (в шагах спектра) """
+    peaks = data[rows, indexes][:, np.newaxis]
+    left, right = _outward_windows(data, rows, indexes, distance)
+
+    # основание с каждой стороны - минимум до первой точки выше вершины (или до края окна)
+    bases = list()
+    for window in (left, right):
+        with np.errstate(invalid='ignore'):
+            higher = window > peaks
+        higher[:, 0] = False
+        limit = np.where(higher.any(axis=1), higher.argmax(axis=1), window.shape[1])
+        inside = np.arange(window.shape[1]) < limit[:, np.newaxis]
+        bases.append(np.nanmin(np.where(inside, window, np.nan), axis=1))
+    prominences = peaks[:, 0] - np.maximum(bases[0], bases[1])
+
+    # ширина - до пересечения уровня (вершина - половина высоты) с линейной интерполяцией между точками
+    levels = (peaks[:, 0] - prominences / 2)[:, np.newaxis]
+    half_widths = np.empty((len(rows), 2))
+    for side, window in enumerate((left, right)):
+        with np.errstate(invalid='ignore'):
+            below = (window <= levels) | np.isnan(window)
+        crossing = np.maximum(below.argmax(axis=1), 1)
+        crossing_row = np.arange(len(rows))
+        inner, outer = window[crossing_row, crossing - 1], window[crossing_row, crossing]
+        outer = np.where(np.isnan(outer), levels[:, 0], outer)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(inner > outer, (inner - levels[:, 0]) / (inner - outer), 0)
+        half_widths[:, side] = crossing - 1 + fraction
+    return prominences, half_widths
+
+
+def _apply_distance(rows, indexes, heights, distance):
+    """ номера пиков, остающихся после удаления более низких пиков ближе distance к более высокому пику канала """
+    kept = np.ones(len(rows), dtype=bool)
+    for peak in np.argsort(-heights, kind='stable'):
+        if not kept[peak]:
+            continue
+        too_close = (rows == rows[peak]) & (np.abs(indexes - indexes[peak]) < distance)
+        too_close[peak] = False
+        kept[too_close] = False
+    return np.nonzero(kept)[0]
+
+
+def _parabolic_offsets(data, rows, indexes):
+    """ смещение вершины параболы через три точки вокруг максимума, в шагах спектра """
+    left, center, right = data[rows, indexes - 1], data[rows, indexes], data[rows, indexes + 1]
+    denominator = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offsets = np.where(denominator < 0, 0.5 * (left - right) / denominator, 0)
+    return np.clip(offsets, -0.5, 0.5)
+
+
+def _centroid_offsets(data, rows, indexes, prominences, half_widths):
+    """ смещение центра тяжести мощности (мВт) точек выше половины высоты пика, в шагах спектра """
+    if not len(rows):
+        return np.empty(0)
+    points_num = data.shape[1]
+    reach = int(np.ceil(half_widths.max()))
+    offsets = np.arange(-reach, reach + 1)
+    positions = indexes[:, np.newaxis] + offsets
+    inside = (positions >= 0) & (positions < points_num) & \
+             (offsets >= -half_widths[:, :1]) & (offsets <= half_widths[:, 1:])
+    window = data[rows[:, np.newaxis], np.clip(positions, 0, points_num - 1)]
+
+    levels = data[rows, indexes] - prominences / 2
+    weights = 10 ** (window / 10) - 10 ** (levels[:, np.newaxis] / 10)
+    weights = np.where(inside & (weights > 0), weights, 0)
+    weights_sum = weights.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weights_sum > 0, (weights * offsets).sum(axis=1) / weights_sum, 0)
+
+
+def peaks_by_channel(channels, wavelengths):
+    """ пики в формате UPK_conversion.peaks_by_channel_from_packet()
+    :return: dict(), {канал: [длины волн, нм]}
+    """
+    ret_value = dict()
+    for channel in np.unique(channels):
+        ret_value[channel.item()] = wavelengths[channels == channel].tolist()
+    return ret_value
+
+
+def match_peaks(reference_wavelengths, wavelengths, tolerance_pm=100):
+    """ отклонение найденных пиков от опорных (например, от списка пиков прибора)
+    :param reference_wavelengths: list(), опорные длины волн одного канала, нм
+    :param wavelengths: list(), найденные длины волн того же канала, нм
+    :param tolerance_pm: float(), максимальное отклонение, при котором пики считаются одним пиком, пм
+    :return: np.ndarray(), для каждого опорного пика - отклонение ближайшего найденного, пм (NaN - не найден)
+    """
+    reference_wavelengths = np.asarray(reference_wavelengths, dtype=float)
+    wavelengths = np.sort(np.asarray(wavelengths, dtype=float))
+    if not len(wavelengths):
+        return np.full(len(reference_wavelengths), np.nan)
+
+    right = np.clip(np.searchsorted(wavelengths, reference_wavelengths), 1, len(wavelengths) - 1)
+    left = right - 1 if len(wavelengths) > 1 else right
+    candidates = np.stack((wavelengths[left], wavelengths[right]))
+    deviations = (candidates - reference_wavelengths) * 1000
+    nearest = deviations[np.abs(deviations).argmin(axis=0), np.arange(len(reference_wavelengths))]
+    return np.where(np.abs(nearest) <= tolerance_pm, nearest, np.nan)
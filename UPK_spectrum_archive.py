@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Архив спектров x55 в сжатом двоичном виде
+#
+# Файл - последовательность записей, по записи на спектр (все каналы):
+#   заголовок (record_header) - сигнатура, версия, способ сжатия, время спектра, серийный номер прибора,
+#       количество каналов и точек, сетка длин волн (начало и шаг, нм), шаг квантования мощности, dB,
+#       длина сжатых данных;
+#   номера каналов - uint16 * количество каналов;
+#   сжатые данные (zlib или lzma) - мощность в фиксированной точке (int16, шаг power_step_db), по каждому каналу
+#       первая точка и далее разности соседних точек (разности сжимаются в несколько раз лучше самих значений).
+#
+# Спектр хранится во всех точках; при шаге 0.01 dB потерь по сравнению с прежним текстовым '%.2f' нет.
+# Чтение - SpectrumArchiveReader: файл отображается в память (mmap), распаковывается только запрошенная запись.
+
+import datetime
+import lzma
+import mmap
+import struct
+import zlib
+
+from UPK_lazy import lazy_import
+
+np = lazy_import('numpy')
+
+archive_signature = b'UPKS'
+archive_version = 1
+
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+compressions = {'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+
+# сигнатура, версия, сжатие, время, серийный номер, каналов, точек, начало сетки, шаг сетки, шаг мощности, длина данных
+record_header = struct.Struct('<4sHHd16sHIddfI')
+
+default_power_step_db = 0.01
+
+
+def spectrum_archive_file_name(timestamp):
+    """ имя часового файла архива спектров (время UTC, как у архивов измерений) """
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H_spectra.bin')
+
+
+def encode_spectrum(timestamp, serial_number, channels, data, wavelengths, compression='zlib',
+                    power_step_db=default_power_step_db):
+    """ запись архива для одного спектра
+    :param timestamp: float(), время спектра (по часам прибора)
+    :param serial_number: str(), серийный номер прибора
+    :param channels: list(), номера каналов (строк data)
+    :param data: np.ndarray(), мощность, dBm, shape (количество каналов, количество точек)
+    :param wavelengths: np.ndarray(), длины волн точек спектра (равномерная сетка), нм
+    :param compression: str(), 'zlib' или 'lzma'
+    :param power_step_db: float(), шаг квантования мощности
+    :return: bytes(), запись для добавления в файл архива
+    """
+    if compression not in compressions:
+        raise ValueError(f'Unexpected compression {compression}, expected one of {list(compressions)}')
+
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    channels_num, points_num = data.shape
+    if len(channels) != channels_num or len(wavelengths) != points_num:
+        raise ValueError(f'Spectrum shape {data.shape} does not match {len(channels)} channels, '
+                         f'{len(wavelengths)} wavelengths')
+    grid_step = (wavelengths[-1] - wavelengths[0]) / (points_num - 1) if points_num > 1 else 0
+
+    # фиксированная точка и разности соседних точек (в int16 с переполнением - восстанавливаются точно)
+    fixed = np.clip(np.round(data / power_step_db), -32768, 32767).astype(np.int16)
+    deltas = fixed.copy()
+    deltas[:, 1:] = np.diff(fixed, axis=1)
+
+    raw = deltas.astype('<i2').tobytes()
+    payload = zlib.compress(raw, 6) if compression == 'zlib' else lzma.compress(raw)
+
+    header = record_header.pack(archive_signature, archive_version, compressions[compression], timestamp,
+                                str(serial_number).encode('ascii', 'replace')[:16], channels_num, points_num,
+                                wavelengths[0], grid_step, power_step_db, len(payload))
+    return header + np.asarray(channels, dtype='<u2').tobytes() + payload
+
+
+def decode_spectrum(buffer, offset=0):
+    """ разбор записи архива
+    :param buffer: bytes(), memoryview() или mmap.mmap(), содержимое файла архива
+    :param offset: int(), начало записи
+    :return: (header, data, next_offset), header - dict() с полями заголовка и номерами каналов,
+        data - np.ndarray(float32), мощность, dBm, shape (количество каналов, количество точек)
+    """
+    header, data_offset = _read_header(buffer, offset)
+    payload = buffer[data_offset:data_offset + header['payload_size']]
+    if header['compression'] == COMPRESSION_ZLIB:
+        raw = zlib.decompress(payload)
+    else:
+        raw = lzma.decompress(payload)
+
+    deltas = np.frombuffer(raw, dtype='<i2').reshape(header['channels_num'], header['points_num'])
+    fixed = np.cumsum(deltas, axis=1, dtype=np.int16)
+    data = fixed.astype(np.float32) * np.float32(header['power_step_db'])
+    return header, data, data_offset + header['payload_size']
+
+
+def _read_header(buffer, offset):
+    """ заголовок записи и начало сжатых данных """
+    fields = record_header.unpack_from(buffer, offset)
+    if fields[0] != archive_signature:
+        raise ValueError(f'No spectrum record at offset {offset}')
+    if fields[1] > archive_version:
+        raise ValueError(f'Unsupported spectrum archive version {fields[1]}')
+
+    header = dict(zip(('compression', 'timestamp', 'serial_number', 'channels_num', 'points_num',
+                       'wavelength_start', 'wavelength_step', 'power_step_db', 'payload_size'), fields[2:]))
+    header['serial_number'] = header['serial_number'].rstrip(b'\0').decode('ascii', 'replace')
+
+    channels_offset = offset + record_header.size
+    header['channels'] = np.frombuffer(buffer, dtype='<u2', count=header['channels_num'],
+                                       offset=channels_offset).tolist()
+    header['offset'] = offset
+    return header, channels_offset + 2 * header['channels_num']
+
+
+def header_wavelengths(header):
+    """ сетка длин волн спектра, нм """
+    return header['wavelength_start'] + header['wavelength_step'] * np.arange(header['points_num'])
+
+
+class SpectrumArchiveReader:
+    """ чтение архива спектров через отображение файла в память
+
+    with SpectrumArchiveReader('2019041513_spectra.bin') as reader:
+        for header, data in reader:
+            ...
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._file = open(file_name, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # пустой файл не отображается
+            self._map = b''
+
+        # заголовки всех записей (сжатые данные при этом не читаются); недописанная последняя запись пропускается
+        self.headers = list()
+        offset = 0
+        while offset + record_header.size <= len(self._map):
+            header, data_offset = _read_header(self._map, offset)
+            if data_offset + header['payload_size'] > len(self._map):
+                break
+            self.headers.append(header)
+            offset = data_offset + header['payload_size']
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, index):
+        """ :return: (header, data) """
+        header, data, _ = decode_spectrum(self._map, self.headers[index]['offset'])
+        return header, data
+
+    def __iter__(self):
+        for index in range(len(self.headers)):
+            yield self[index]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def iter_spectrum_archive(file_name, chunk_size=1 << 20):
+    """ последовательное чтение архива без отображения в память (например, из сетевого каталога)
+    :return: генератор (header, data)
+    """
+    buffer = bytearray()
+    offset = 0
+    with open(file_name, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            while True:
+                if len(buffer) - offset < record_header.size:
+                    break
+                channels_num = record_header.unpack_from(buffer, offset)[5]
+                if len(buffer) - offset < record_header.size + 2 * channels_num:
+                    break
+                header, data_offset = _read_header(buffer, offset)
+                if data_offset + header['payload_size'] > len(buffer):
+                    break
+                header, data, offset = decode_spectrum(buffer, offset)
+                yield header, data
+
+            # прочитанные записи больше не нужны
+            del buffer[:offset]
+            offset = 0
+            if not chunk:
+                return
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Сравнение пересчета пачек измерений прибора: всеми устройствами одной таблицей (convert_samples()) и разделами
+# по каналам (channel_partitions(), по разделу на процесс) в пуле процессов со сборкой строк (merge_partition_rows())
+#
+# Запуск из корня репозитория: python benchmarks/bench_channel_conversion.py [каналов] [измерений в пачке] [процессов]
+# Устройства и пики - как в bench_conversion.py (по 4 устройства на канал, посторонние пики). Рекомендованная
+# температура у разделов своя, поэтому часть неоднозначных случаев может разрешиться иначе - выводится количество
+# отличающихся значений.
+
+import sys
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+import numpy as np
+from bench_conversion import make_device, make_samples, devices_per_channel, sample_rate_hz
+from UPK_conversion import convert_samples, channel_partitions, channel_samples, merge_partition_rows
+from UPK_device_table import DeviceTable
+
+
+def convert_serial(table, batches):
+    t_recommended = None
+    results = list()
+    for samples in batches:
+        rows, raw_rows, t_recommended = convert_samples(table, samples, t_recommended)
+        results.append((rows, raw_rows))
+    return results
+
+
+def convert_partitioned(executor, partitions, devices_num, batches):
+    results = list()
+    for samples in batches:
+        futures = [executor.submit(convert_samples, partition.table, channel_samples(samples, partition.channels),
+                                   partition.t_recommended) for partition in partitions]
+        partition_results = [future.result() for future in futures]
+        for partition, (_, _, t_recommended) in zip(partitions, partition_results):
+            partition.t_recommended = t_recommended
+        results.append(merge_partition_rows([measurement_time for measurement_time, _ in samples], partitions,
+                                            [(rows, raw_rows) for rows, raw_rows, _ in partition_results],
+                                            devices_num))
+    return results
+
+
+def report(name, duration, samples_num):
+    print(f'{name:<12} {duration / samples_num * 1000:8.3f} ms/sample  '
+          f'{samples_num / duration / sample_rate_hz:8.1f} x real time at {sample_rate_hz} Hz')
+
+
+if __name__ == '__main__':
+    channels_num = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    workers_num = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    devices = [make_device(1 + num // devices_per_channel, 1500000 + (num % devices_per_channel) * 25000)
+               for num in range(channels_num * devices_per_channel)]
+    samples = make_samples(devices, 20 * batch_size)
+    batches = [samples[start:start + batch_size] for start in range(0, len(samples), batch_size)]
+    print(f'{len(devices)} devices on {channels_num} channels, {batch_size} samples per batch, {workers_num} processes')
+
+    start = time.perf_counter()
+    serial = convert_serial(DeviceTable(devices), batches)
+    report('table', time.perf_counter() - start, len(samples))
+
+    partitions = channel_partitions(devices, partitions_num=workers_num)
+    with ProcessPoolExecutor(max_workers=workers_num) as executor:
+        # запуск процессов пула не входит в измерение
+        list(executor.map(abs, range(workers_num)))
+        start = time.perf_counter()
+        partitioned = convert_partitioned(executor, partitions, len(devices), batches)
+        report('by channel', time.perf_counter() - start, len(samples))
+
+    serial_rows = np.array([row for rows, _ in serial for row in rows], dtype=float)
+    partitioned_rows = np.array([row for rows, _ in partitioned for row in rows], dtype=float)
+    differ = ~np.isclose(serial_rows, partitioned_rows, equal_nan=True)
+    print(f'values differing: {differ.sum()} of {differ.size}')
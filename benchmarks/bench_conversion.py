@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Сравнение пересчета длин волн в измерения: по одному устройству через ODTiT (convert_samples_by_device())
+# и по таблице устройств (convert_samples(), UPK_device_table.py)
+#
+# Запуск из корня репозитория: python benchmarks/bench_conversion.py [количество устройств] [измерений в пачке]
+# Устройства синтетические - по 4 на канал; пики рассчитываются по формулам ODTiT для случайных температуры и тяжения,
+# в каждом канале добавляется по 2 посторонних пика (неоднозначные случаи). Результаты обоих способов сравниваются.
+
+import sys
+import math
+import time
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from OptenFiberOpticDevices import ODTiT
+from UPK_conversion import convert_samples, convert_samples_by_device
+from UPK_device_table import DeviceTable
+
+devices_per_channel = 4
+sample_rate_hz = 10
+
+
+def make_device(channel, wl0):
+    device = ODTiT(channel)
+    device.channel = channel
+    device.e, device.ctes, device.size = 8E+11, 12, (5, 5)
+    device.f_min, device.f_max, device.f_reserve = 0, 4000, 1000
+    device.fmodel_f0, device.fmodel_f1, device.fmodel_f2 = 100, 1, 0.01
+    device.icemodel_i1, device.icemodel_i2 = 1, 0.5
+    for sensor, offset in zip(device.sensors, (0, 5000, 13000)):
+        sensor.wl0, sensor.t0 = wl0 + offset, 20
+    device.sensors[0].st = 1.8E-5
+    return device
+
+
+def make_samples(devices, samples_num, seed=1):
+    rng = random.Random(seed)
+    samples = list()
+    for sample_num in range(samples_num):
+        peaks_by_channel = dict()
+        temperature = rng.uniform(-5, 25)
+        for device in devices:
+            force = rng.uniform(500, 3000) + device.f_reserve
+            t = temperature + rng.uniform(-0.5, 0.5)
+            wls = [device._get_wl_from_value(0, t), device._get_wl_from_value(1, t, force),
+                   device._get_wl_from_value(2, t, force)]
+            peaks_by_channel.setdefault(device.channel, []).extend(wl / 1000 for wl in wls)
+        for wls in peaks_by_channel.values():
+            wls.extend(rng.uniform(1495, 1600) for _ in range(2))
+            wls.sort()
+        samples.append((sample_num / sample_rate_hz, peaks_by_channel))
+    return samples
+
+
+def same_rows(rows_a, rows_b):
+    for row_a, row_b in zip(rows_a, rows_b):
+        for a, b in zip(row_a, row_b):
+            a, b = (math.nan if a is None else a), (math.nan if b is None else b)
+            if a != b and not (math.isnan(a) and math.isnan(b)):
+                return False
+    return len(rows_a) == len(rows_b)
+
+
+def bench(name, convert, devices, batches):
+    t_recommended = None
+    results = list()
+    start = time.perf_counter()
+    for samples in batches:
+        rows, raw_rows, t_recommended = convert(devices, samples, t_recommended)
+        results.append((rows, raw_rows))
+    duration = time.perf_counter() - start
+    samples_num = sum(len(samples) for samples in batches)
+    print(f'{name:<10} {duration / samples_num * 1000:8.3f} ms/sample  '
+          f'{samples_num / duration / sample_rate_hz:8.1f} x real time at {sample_rate_hz} Hz')
+    return results
+
+
+if __name__ == '__main__':
+    devices_num = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    devices = [make_device(1 + num // devices_per_channel, 1500000 + (num % devices_per_channel) * 25000)
+               for num in range(devices_num)]
+    samples = make_samples(devices, 20 * batch_size)
+    batches = [samples[start:start + batch_size] for start in range(0, len(samples), batch_size)]
+    table = DeviceTable(devices)
+    print(f'{devices_num} devices, {batch_size} samples per batch, {len(table.shared_indexes)} devices share peaks')
+
+    by_device = bench('ODTiT', convert_samples_by_device, devices, batches)
+    by_table = bench('table', convert_samples, table, batches)
+    print('results match:', all(same_rows(a[0], b[0]) and same_rows(a[1], b[1]) for a, b in zip(by_device, by_table)))
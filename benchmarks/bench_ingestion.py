@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Сравнение разбора пакетов пиков hyperion: прежний (поэлементно в списки, пересчет в пм списком) и через массив
+# numpy поверх данных пакета со срезами по каналам (UPK_conversion.packet_peaks())
+#
+# Запуск из корня репозитория: python benchmarks/bench_ingestion.py [пиков в канале] [пакетов в пачке]
+# Пакет синтетический - с теми же атрибутами, что и hyperion.HACQPeaksData (data и channel_slices - срезы data).
+# Результаты обоих способов (запись длин волн для архива и пики каналов в пм) сравниваются.
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+import numpy as np
+from UPK_conversion import packet_peaks, channel_peaks
+
+channels_num = 16
+packets_num = 2000
+
+
+class SyntheticPeaksPacket:
+
+    def __init__(self, peaks_per_channel, rng):
+        wls = np.sort(rng.uniform(1500, 1600, size=(channels_num, peaks_per_channel)), axis=1).ravel()
+        self.data = np.frombuffer(wls.tobytes(), dtype=np.float64)
+        self.channel_slices = [self.data[start:start + peaks_per_channel]
+                               for start in range(0, len(self.data), peaks_per_channel)]
+
+
+def ingest_by_element(packets):
+    """ прежний разбор: пики каналов поэлементно в списки, длины волн для архива, пересчет в пм
+    :return: list(), для каждого пакета - (запись длин волн, {канал: пики, пм})
+    """
+    results = list()
+    for packet in packets:
+        peaks_by_channel = dict()
+        for channel in range(len(packet.channel_slices)):
+            wls = []
+            for wl in packet.channel_slices[channel]:
+                wls.append(wl)
+            peaks_by_channel[channel + 1] = wls
+        wls_record = [0.0]
+        for value in peaks_by_channel.values():
+            wls_record.extend(value)
+        results.append((wls_record, dict((channel, [wl * 1000 for wl in wls])
+                                         for channel, wls in peaks_by_channel.items())))
+    return results
+
+
+def ingest_by_array(packets):
+    """ разбор через массив пакета: срезы по каналам, длины волн для архива одной операцией, пм - на пачку
+    :return: (list(), np.ndarray()) - записи длин волн пакетов и пики, пм, shape (пакетов, каналов, пиков в канале)
+    """
+    batch = list()
+    records = list()
+    for packet in packets:
+        wls, offsets = packet_peaks(packet)
+        batch.append(channel_peaks(wls, offsets))
+        records.append([0.0] + wls.tolist())
+    peaks = np.full((len(batch), channels_num, max(len(wls) for wls in batch[0].values())), np.nan)
+    for sample_num, peaks_by_channel in enumerate(batch):
+        for column, wls in enumerate(peaks_by_channel.values()):
+            peaks[sample_num, column, :len(wls)] = wls
+    peaks *= 1000
+    return records, peaks
+
+
+def same_results(by_element, by_array):
+    """ результаты обоих способов разбора пачки совпадают """
+    records, peaks = by_array
+    for sample_num, (wls_record, peaks_by_channel) in enumerate(by_element):
+        if wls_record != records[sample_num]:
+            return False
+        for column, wls_pm in enumerate(peaks_by_channel.values()):
+            if not np.allclose(peaks[sample_num, column, :len(wls_pm)], wls_pm, rtol=0, atol=1E-9) or \
+                    not np.isnan(peaks[sample_num, column, len(wls_pm):]).all():
+                return False
+    return True
+
+
+if __name__ == '__main__':
+    peaks_per_channel = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    rng = np.random.default_rng(1)
+    packets = [SyntheticPeaksPacket(peaks_per_channel, rng) for _ in range(packets_num)]
+    print(f'{channels_num} channels, {peaks_per_channel} peaks per channel, {batch_size} packets per batch')
+    results = dict()
+    for name, ingest in (('elements', ingest_by_element), ('array', ingest_by_array)):
+        start = time.perf_counter()
+        results[name] = [ingest(packets[batch_start:batch_start + batch_size])
+                         for batch_start in range(0, packets_num, batch_size)]
+        duration = time.perf_counter() - start
+        print(f'{name:<10} {duration / packets_num * 1E+6:8.1f} us/packet')
+    print('results match:', all(same_results(by_element, by_array)
+                                for by_element, by_array in zip(results['elements'], results['array'])))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Сравнение поиска пиков в спектре: scipy.signal.find_peaks по каждому каналу (как раньше в get_one_spectrum())
+# и UPK_spectrum.find_spectrum_peaks() по всем каналам сразу с уточнением положения пика
+#
+# Запуск из корня репозитория: python benchmarks/bench_peak_detection.py [количество каналов] [количество повторов]
+# Спектр синтетический: шум -50 dBm, в каждом канале до 12 гауссовых пиков ФБР известной длины волны (шаг спектра 5 пм).
+# Точность - СКО отклонения найденных пиков от заданных длин волн.
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from scipy.signal import find_peaks
+except ImportError:
+    find_peaks = None
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from UPK_spectrum import find_spectrum_peaks, peaks_by_channel, match_peaks, refine_methods
+
+peak_distance_pm = 1000
+peak_height_dbm = 3
+peak_width_pm = [100, 600]
+
+
+def make_spectrum(channels_num, seed=1):
+    rng = np.random.RandomState(seed)
+    wavelengths = np.linspace(1500, 1600, 20001)
+    power_mw = 10 ** ((-50 + rng.normal(0, 0.3, (channels_num, len(wavelengths)))) / 10)
+
+    true_wavelengths = list()
+    for channel in range(channels_num):
+        centers = np.sort(rng.uniform(1502, 1598, 12))
+        centers = centers[np.r_[True, np.diff(centers) > 1.5]]
+        true_wavelengths.append(centers)
+        for center in centers:
+            power_mw[channel] += 10 ** (rng.uniform(-30, -10) / 10) * np.exp(-0.5 * ((wavelengths - center) / 0.1) ** 2)
+    return 10 * np.log10(power_mw), wavelengths, true_wavelengths
+
+
+def scipy_peaks(data, wavelengths):
+    """ прежний способ - find_peaks по каждому каналу, длина волны - точка спектра """
+    step_pm = (wavelengths[1] - wavelengths[0]) * 1000
+    raw_peaks = dict()
+    for channel in range(len(data)):
+        peak_indexes, _ = find_peaks(data[channel], distance=peak_distance_pm / step_pm, prominence=peak_height_dbm,
+                                     width=np.array(peak_width_pm) / step_pm)
+        raw_peaks[channel + 1] = [wavelengths[i] for i in peak_indexes]
+    return raw_peaks
+
+
+def engine_peaks(data, wavelengths, refine):
+    channels, peak_wavelengths, _ = find_spectrum_peaks(data, wavelengths, peak_distance_pm, peak_height_dbm,
+                                                        peak_width_pm, refine)
+    return peaks_by_channel(channels, peak_wavelengths)
+
+
+def bench(name, find, repeats, true_wavelengths):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        raw_peaks = find()
+    duration = (time.perf_counter() - start) / repeats
+
+    deviations_pm = np.concatenate([match_peaks(wls, raw_peaks.get(channel + 1, []))
+                                    for channel, wls in enumerate(true_wavelengths)])
+    found = ~np.isnan(deviations_pm)
+    rms_pm = np.sqrt(np.mean(deviations_pm[found] ** 2))
+    print(f'{name:<18} {duration * 1000:8.2f} ms/spectrum  found {found.sum()} of {len(deviations_pm)}  '
+          f'rms {rms_pm:6.3f} pm')
+
+
+if __name__ == '__main__':
+    channels_num = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    data, wavelengths, true_wavelengths = make_spectrum(channels_num)
+    print(f'{channels_num} channels, {data.shape[1]} points')
+
+    if find_peaks is not None:
+        bench('scipy find_peaks', lambda: scipy_peaks(data, wavelengths), repeats, true_wavelengths)
+    else:
+        print('scipy is not installed')
+    for refine in refine_methods:
+        bench(f'numpy {refine}', lambda: engine_peaks(data, wavelengths, refine), repeats, true_wavelengths)
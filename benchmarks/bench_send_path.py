@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Сравнение производительности формирования текстовых кадров для ОСМ (путь отправки усредненных измерений)
+#
+# Запуск из корня репозитория: python benchmarks/bench_send_path.py [количество устройств] [количество записей]
+# Запись имеет тот же состав, что и в averaging_measurements_coroutine(): время блока, затем для каждого устройства
+# количество измерений, среднее и СКО четырех величин, границы нормального тяжения (значения numpy, как у pandas).
+
+import sys
+import time
+import random
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from UPK_codec import JsonCodec, OrjsonCodec, orjson
+from UPK_encoder import averaged_record_encoder, osm_frame
+
+
+def make_records(devices_num, records_num):
+    records = list()
+    for record_num in range(records_num):
+        record = [1555318018.0 + record_num]
+        for _ in range(devices_num):
+            record.append(np.int64(10))
+            record.extend(np.float64(random.uniform(-100, 5000)) for _ in range(8 + 2))
+        records.append(record)
+    return records
+
+
+def legacy_encode(record):
+    return '[' + ', '.join([str(x) for x in record]) + ']'
+
+
+def bench(name, encode, records):
+    start = time.perf_counter()
+    total_bytes = 0
+    for record in records:
+        total_bytes += len(encode(record))
+    duration = time.perf_counter() - start
+    print(f'{name:<14} {len(records) / duration:12.0f} records/s {total_bytes / duration / 1e6:8.1f} MB/s')
+
+
+def bench_block(name, encoder, records):
+    """ форматирование всех записей одной операцией (как пачки сырых измерений в store_converted_rows) """
+    start = time.perf_counter()
+    total_bytes = sum(len(osm_frame(line)) for line in encoder.encode_block(records))
+    duration = time.perf_counter() - start
+    print(f'{name:<14} {len(records) / duration:12.0f} records/s {total_bytes / duration / 1e6:8.1f} MB/s')
+
+
+if __name__ == '__main__':
+    devices_num = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    records_num = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    records = make_records(devices_num, records_num)
+    print(f'{devices_num} devices, {records_num} records')
+
+    bench('str-join', legacy_encode, records)
+    bench('json', JsonCodec.dumps, records)
+    if orjson is not None:
+        bench('orjson', OrjsonCodec.dumps, records)
+    else:
+        print('orjson is not installed')
+
+    encoder = averaged_record_encoder(devices_num)
+    bench('encoder', lambda record: osm_frame(encoder.encode(record)), records)
+    bench_block('encoder-block', encoder, records)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Время запуска УПК: от старта процесса до открытия порта websocket, и память процесса в простое
+#
+# Запуск из корня репозитория: python benchmarks/bench_startup.py [порт] [количество запусков] [простой, с]
+# Сервер запускается во временной папке (без instrument_description.json - прибор не подключается, лог-файлы
+# остаются там же). Память - resident set size через psutil (если установлен) или /proc (Linux).
+
+import sys
+import time
+import socket
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+server_script = Path(__file__).absolute().parent.parent / 'UPK_server_2019.py'
+startup_timeout_sec = 60
+
+
+def wait_for_port(process, port):
+    """ :return: float(), время от запуска процесса до успешного подключения к порту, с (None - процесс завершился) """
+    start = time.perf_counter()
+    while time.perf_counter() - start < startup_timeout_sec:
+        if process.poll() is not None:
+            return None
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.1):
+                return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.005)
+    return None
+
+
+def rss_mb(pid):
+    if psutil is not None:
+        return psutil.Process(pid).memory_info().rss / 1024 / 1024
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float('nan')
+
+
+def run_once(port, idle_sec):
+    with tempfile.TemporaryDirectory() as work_dir:
+        process = subprocess.Popen([sys.executable, str(server_script), '127.0.0.1', str(port)], cwd=work_dir,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            startup_sec = wait_for_port(process, port)
+            if startup_sec is None:
+                print(process.stderr.read().decode(errors='replace')[-2000:])
+                raise RuntimeError('Server did not open the port')
+            listening_rss_mb = rss_mb(process.pid)
+            time.sleep(idle_sec)
+            idle_rss_mb = rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+    return startup_sec, listening_rss_mb, idle_rss_mb
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 7681
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    idle_sec = float(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    results = list()
+    for run in range(runs):
+        results.append(run_once(port, idle_sec))
+        print(f'run {run + 1}: port open in {results[-1][0] * 1000:7.0f} ms, '
+              f'rss {results[-1][1]:6.1f} MB at port open, {results[-1][2]:6.1f} MB after {idle_sec:.0f} s idle')
+
+    print(f'median: port open in {statistics.median(r[0] for r in results) * 1000:.0f} ms, '
+          f'idle rss {statistics.median(r[2] for r in results):.1f} MB')